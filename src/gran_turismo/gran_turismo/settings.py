@@ -121,6 +121,9 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, "static/")
 
+# Where browsers reach the race runner API, see the runraces command.
+RACE_RUNNER_URL = os.environ.get("RACE_RUNNER_URL", "/runner/")
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
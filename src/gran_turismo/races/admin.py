@@ -1,34 +1,317 @@
-from django.contrib import admin
+from django import forms
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.core.management.base import CommandError
+from django.db.models import Sum
+from django.http import HttpResponseRedirect
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils.html import format_html
 
-from . import models
+from . import changelist, diff, models, retries, runner
 
 
-class ResultAdmin(admin.ModelAdmin):
+class BaseUrlFilter(admin.SimpleListFilter):
+    # Looks starting points up in sessions, not in every result.
+    title = 'starting point'
+    parameter_name = 'session__base_url'
+
+    def lookups(self, request, model_admin):
+        base_urls = (models.RacingSession.objects.order_by('base_url')
+                     .values_list('base_url', flat=True).distinct())
+        return [(base_url, base_url) for base_url in base_urls]
+
+    def queryset(self, request, queryset):
+        if self.value() is not None:
+            return queryset.filter(session__base_url=self.value())
+
+
+class StatusCodeFilter(admin.SimpleListFilter):
+    # Looks status codes up in session rollups, not in every result.
+    title = 'status code'
+    parameter_name = 'status_code'
+
+    def lookups(self, request, model_admin):
+        status_codes = (models.RacingStatusCount.objects
+                        .order_by('status_code')
+                        .values_list('status_code', flat=True).distinct())
+        return [(str(status_code), status_code)
+                for status_code in status_codes]
+
+    def queryset(self, request, queryset):
+        if self.value() is not None:
+            try:
+                return queryset.filter(status_code=int(self.value()))
+            except ValueError as e:
+                raise IncorrectLookupParameters(e)
+
+
+class ErrorFilter(admin.SimpleListFilter):
+    title = 'error'
+    parameter_name = 'error'
+
+    def lookups(self, request, model_admin):
+        categories = sorted(
+            {category for _, category, _ in retries.ERRORS} | {'other'})
+        return [(category, category) for category in categories]
+
+    def queryset(self, request, queryset):
+        if self.value() is not None:
+            return queryset.filter(error=self.value())
+
+
+class ResultAdmin(changelist.KeysetModelAdmin):
     model = models.RacingResult
     list_display = readonly_fields = (
         "session",
         "url",
         "status_code",
+        "error",
+        "latency",
+        "redirects",
     )
     ordering = ["-session__id", "-status_code", "url"]
-    list_filter = ("session__base_url", "status_code")
+    list_filter = (BaseUrlFilter, StatusCodeFilter, ErrorFilter)
     list_display_links = None
+    # Storage of sessions listed, see RacingSession.storage.
+    storage = 'full'
 
+    def estimate_count(self, request, queryset, params):
+        """
+        Sum session rollups when only filtering by starting point or
+        status code, counting results of sessions not rolled up yet.
+        """
+        if not set(params) <= {'session__base_url', 'status_code'}:
+            return super().estimate_count(request, queryset, params)
+        sessions = models.RacingSession.objects.filter(storage=self.storage)
+        if 'session__base_url' in params:
+            sessions = sessions.filter(base_url=params['session__base_url'])
+        counts = models.RacingStatusCount.objects.filter(session__in=sessions)
+        if 'status_code' in params:
+            counts = counts.filter(status_code=params['status_code'])
+        rolled_up = counts.aggregate(results=Sum('results'))['results'] or 0
+        count, exact = changelist.estimate_count(queryset.exclude(
+            session__in=models.RacingStatusCount.objects.values('session')))
+        return rolled_up + count, exact
 
-class SessionAdmin(admin.ModelAdmin):
+
+class CompactResultAdmin(ResultAdmin):
+    model = models.CompactResult
     list_display = readonly_fields = (
+        "session",
+        "url",
+        "status_code",
+        "latency",
+        "depth",
+        "redirects",
+    )
+    ordering = ["-session__id", "url__id"]
+    list_filter = (BaseUrlFilter, StatusCodeFilter)
+    storage = 'compact'
+
+
+class QueueRaceForm(forms.ModelForm):
+    class Meta:
+        model = models.RacingSession
+        fields = ('base_url', 'arguments')
+        help_texts = {
+            'arguments': 'startrace options, e.g. --limit 1000 '
+                         '--storage compact',
+        }
+
+    def clean(self):
+        cleaned_data = super().clean()
+        try:
+            self.options = runner.parse_arguments(
+                cleaned_data.get('base_url', ''),
+                cleaned_data.get('arguments', ''))
+        except CommandError as e:
+            raise forms.ValidationError(str(e))
+        return cleaned_data
+
+
+class SessionAdmin(admin.ModelAdmin):
+    list_display = (
         "id",
         "base_url",
+        "state",
+        "watch",
         "starting_time",
         "ending_time",
         "successes",
         "redirects",
         "soft_errors",
         "hard_errors",
+        "failures",
         "crawled",
+        "storage",
+    )
+    readonly_fields = (
+        "id",
+        "base_url",
+        "state",
+        "arguments",
+        "starting_time",
+        "ending_time",
+        "successes",
+        "redirects",
+        "soft_errors",
+        "hard_errors",
+        "failures",
+        "crawled",
+        "storage",
     )
     list_display_links = None
+    list_filter = ("state",)
     ordering = ['base_url', '-ending_time']
+    actions = ['compare', 'queue_again', 'cancel']
+
+    def get_form(self, request, obj=None, **kwargs):
+        # Races are added by queuing them for the race runner.
+        if obj is None:
+            kwargs['form'] = QueueRaceForm
+        return super().get_form(request, obj, **kwargs)
+
+    def get_fields(self, request, obj=None):
+        if obj is None:
+            return QueueRaceForm.Meta.fields
+        return super().get_fields(request, obj)
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj is None:
+            return ()
+        return super().get_readonly_fields(request, obj)
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.state = 'queued'
+            obj.storage = form.options['storage']
+        super().save_model(request, obj, form, change)
+
+    def get_urls(self):
+        return [
+            path('<int:session_id>/watch/',
+                 self.admin_site.admin_view(self.watch_view),
+                 name='races_racingsession_watch'),
+        ] + super().get_urls()
+
+    def watch(self, obj):
+        if obj.state not in runner.ACTIVE_STATES:
+            return ''
+        return format_html(
+            '<a href="{}">Watch</a>',
+            reverse('admin:races_racingsession_watch', args=[obj.id]))
+
+    def watch_view(self, request, session_id):
+        """
+        Page following progress of a race from the race runner.
+        """
+        session = get_object_or_404(models.RacingSession, pk=session_id)
+        return TemplateResponse(request, 'admin/races/watch.html', {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': f'Race {session.id}: {session.base_url}',
+            'session': session,
+            'events_url':
+                f'{settings.RACE_RUNNER_URL}races/{session.id}/events'
+                f'?watch={runner.watch_token(session.id)}',
+        })
+
+    def queue_again(self, request, queryset):
+        queued = 0
+        for session in queryset.order_by('id'):
+            try:
+                runner.queue_race(session.base_url, session.arguments)
+            except CommandError as e:
+                self.message_user(
+                    request, f"Race {session.id}: {e}", messages.ERROR)
+            else:
+                queued += 1
+        self.message_user(request, f"Queued {queued} races")
+    queue_again.short_description = "Queue selected races again"
+
+    def cancel(self, request, queryset):
+        cancelled = runner.cancel_races(queryset)
+        self.message_user(request, f"Cancelled {cancelled} races")
+    cancel.short_description = "Cancel selected races"
+
+    def compare(self, request, queryset):
+        sessions = list(queryset.order_by('id'))
+        if len(sessions) != 2:
+            self.message_user(
+                request, "Select two races to compare", messages.ERROR)
+            return None
+        try:
+            race_diff = diff.diff_sessions(*sessions)
+        except diff.RaceRunning as e:
+            self.message_user(request, str(e), messages.ERROR)
+            return None
+        return HttpResponseRedirect(
+            reverse('admin:races_racingdiffentry_changelist')
+            + f'?diff__id__exact={race_diff.id}')
+    compare.short_description = "Compare selected races, older first"
+
+
+class DiffAdmin(admin.ModelAdmin):
+    list_display = readonly_fields = (
+        "id",
+        "before_race",
+        "after_race",
+        "new",
+        "fixed",
+        "changed",
+        "entries",
+    )
+    list_display_links = None
+    ordering = ['-id']
+
+    def before_race(self, obj):
+        return f'{obj.before_id}: {obj.before}'
+
+    def after_race(self, obj):
+        return f'{obj.after_id}: {obj.after}'
+
+    def entries(self, obj):
+        return format_html(
+            '<a href="{}?diff__id__exact={}">Differences</a>',
+            reverse('admin:races_racingdiffentry_changelist'), obj.id)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(
+            'before', 'after')
+
+
+class DiffEntryAdmin(changelist.KeysetModelAdmin):
+    list_display = readonly_fields = (
+        "diff",
+        "kind",
+        "before_status",
+        "after_status",
+        "url",
+    )
+    ordering = ["-diff__id", "kind", "url"]
+    list_filter = ("diff", "kind")
+    list_display_links = None
+
+    def estimate_count(self, request, queryset, params):
+        """
+        Sum diff counters when only filtering by diff or kind.
+        """
+        if not set(params) <= {'diff__id__exact', 'kind__exact'}:
+            return super().estimate_count(request, queryset, params)
+        diffs = models.RacingDiff.objects.all()
+        if 'diff__id__exact' in params:
+            diffs = diffs.filter(id=params['diff__id__exact'])
+        kinds = [kind for kind, _ in models.DIFF_KINDS]
+        if 'kind__exact' in params:
+            kinds = [kind for kind in kinds if kind == params['kind__exact']]
+        counts = diffs.aggregate(**{kind: Sum(kind) for kind in kinds})
+        return sum(count or 0 for count in counts.values()), True
 
 admin.site.register(models.RacingResult, ResultAdmin)
+admin.site.register(models.CompactResult, CompactResultAdmin)
 admin.site.register(models.RacingSession, SessionAdmin)
+admin.site.register(models.RacingDiff, DiffAdmin)
+admin.site.register(models.RacingDiffEntry, DiffEntryAdmin)
@@ -0,0 +1,106 @@
+"""
+arena.py - Keep frontier items compact in memory.
+
+Items waiting in the frontier, (url, max_redirects, depth, attempt)
+tuples, are packed into segments: URLs are UTF-8 encoded into a single
+bytes buffer with an array of their offsets, other fields go into an
+array of integers. Items are referred to by integer ids, given in the
+order they are added, and a segment is dropped as soon as every item of
+it was taken out.
+"""
+from array import array
+
+
+# Number of items of a segment.
+SEGMENT_SIZE = 4096
+
+
+class Segment:
+    """
+    Buffers holding up to SEGMENT_SIZE consecutive items of an arena.
+    """
+    __slots__ = ('data', 'offsets', 'fields', 'live')
+
+    def __init__(self):
+        self.data = bytearray()
+        # End of every URL in data, after the start of the first one.
+        self.offsets = array('I', [0])
+        # max_redirects, depth and attempt of every item
+        self.fields = array('i')
+        self.live = 0
+
+
+class UrlArena:
+    """
+    Store of frontier items referred to by integer ids.
+
+    Init Attributes:
+        segment_size    Number of items of a segment. Smaller segments are
+                        dropped sooner when items are taken out of order.
+    """
+    def __init__(self, segment_size=SEGMENT_SIZE):
+        self.segment_size = segment_size
+        self.segments = {}
+        self.tail = None
+        self.next_id = 0
+
+        # Initialize items count
+        self.live = 0
+
+    def __len__(self):
+        return self.live
+
+    def add(self, item):
+        """
+        Store a (url, max_redirects, depth, attempt) item. Returns its id.
+        """
+        url, max_redirects, depth, attempt = item
+        index, slot = divmod(self.next_id, self.segment_size)
+        if not slot:
+            # Tail was kept while being filled, even when empty.
+            if self.tail is not None and not self.tail.live:
+                del self.segments[index - 1]
+            self.tail = self.segments[index] = Segment()
+        segment = self.tail
+        segment.data += url.encode('utf-8')
+        segment.offsets.append(len(segment.data))
+        segment.fields.extend((max_redirects, depth, attempt))
+        segment.live += 1
+        self.live += 1
+        item_id = self.next_id
+        self.next_id += 1
+        return item_id
+
+    def get(self, item_id):
+        """
+        Item of given id.
+        """
+        index, slot = divmod(item_id, self.segment_size)
+        segment = self.segments[index]
+        url = segment.data[
+            segment.offsets[slot]:segment.offsets[slot + 1]].decode('utf-8')
+        fields = segment.fields[slot * 3:slot * 3 + 3]
+        return url, fields[0], fields[1], fields[2]
+
+    def pop(self, item_id):
+        """
+        Take an item out. Its id must not be used anymore.
+        """
+        item = self.get(item_id)
+        index = item_id // self.segment_size
+        segment = self.segments[index]
+        segment.live -= 1
+        self.live -= 1
+        if not segment.live and segment is not self.tail:
+            del self.segments[index]
+        return item
+
+    def clear(self):
+        """
+        Drop every item. Ids keep growing.
+        """
+        self.segments.clear()
+        self.tail = None
+        self.live = 0
+        # Next item starts a new segment.
+        self.next_id += -self.next_id % self.segment_size
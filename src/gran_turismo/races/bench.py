@@ -0,0 +1,184 @@
+"""
+bench.py - Measure races and link extraction for benchmarks.
+"""
+from asyncio import gather, get_event_loop, sleep
+import os
+import resource
+import time
+import tracemalloc
+
+import aiohttp
+
+from .drivers import AsyncDriver
+from .scheduler import HostScheduler, UrlPriority
+from .transport import use_loop
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process, in bytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 2 ** 10
+
+
+def current_rss():
+    """
+    Resident set size of this process, in bytes.
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def percentile(values, p):
+    """
+    Nearest-rank p-th percentile of values, or None if there are none.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(0, int(round(p / 100 * len(values) + 0.5)) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def latency_trace(latencies):
+    """
+    aiohttp.TraceConfig appending the seconds every request took to
+    latencies.
+    """
+    async def on_request_start(session, context, params):
+        context.started = get_event_loop().time()
+
+    async def on_request_end(session, context, params):
+        latencies.append(get_event_loop().time() - context.started)
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    trace.on_request_exception.append(on_request_end)
+    return trace
+
+
+async def monitor_lag(lags, interval=0.01):
+    """
+    Append how late the event loop wakes up from a sleep to lags,
+    until cancelled.
+    """
+    loop = get_event_loop()
+    while True:
+        started = loop.time()
+        await sleep(interval)
+        lags.append(max(0, loop.time() - started - interval))
+
+
+async def drain(results):
+    """
+    Consume results of a race until it is over.
+    """
+    while await results.get() is not None:
+        pass
+
+
+def run_race(root_url, options, conn, loop_name='asyncio'):
+    """
+    Race against root_url with AsyncDriver options on the loop_name event
+    loop, and send a report through conn. Runs in its own process, so its
+    peak memory is not mixed with other races.
+    """
+    use_loop(loop_name)
+    loop = get_event_loop()
+
+    # Initialize measurements
+    latencies = []
+    lags = []
+
+    baseline = current_rss()
+    driver = AsyncDriver(
+        root_url, trace_configs=[latency_trace(latencies)], **options)
+    monitor = loop.create_task(monitor_lag(lags))
+    started = time.perf_counter()
+    loop.run_until_complete(gather(driver.drive(), drain(driver.results)))
+    elapsed = time.perf_counter() - started
+    monitor.cancel()
+    loop.close()
+    resolver = driver.resolver
+
+    def ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 3)
+
+    conn.send({
+        'crawled': driver.crawled,
+        'twos': driver.twos,
+        'threes': driver.threes,
+        'fours': driver.fours,
+        'fives': driver.fives,
+        'elapsed': round(elapsed, 3),
+        'pages_per_second': round(driver.crawled / elapsed, 2),
+        'fetch_latency_p50_ms': ms(percentile(latencies, 50)),
+        'fetch_latency_p99_ms': ms(percentile(latencies, 99)),
+        'peak_rss_mb': round((peak_rss() - baseline) / 2 ** 20, 2),
+        'loop_lag_p50_ms': ms(percentile(lags, 50)),
+        'loop_lag_p99_ms': ms(percentile(lags, 99)),
+        'loop_lag_max_ms': ms(max(lags, default=None)),
+        'dns_hits': resolver.hits if resolver else None,
+        'dns_misses': resolver.misses if resolver else None,
+        'redirect_hits': driver.redirect_hits,
+        'redirect_misses': driver.redirect_misses,
+    })
+    conn.close()
+
+
+def run_frontier(site, root_url, conn, max_redirects=3):
+    """
+    Crawl the link graph of a synthetic site breadth first through a
+    HostScheduler, fetching nothing, and send through conn how much memory
+    the frontier took when largest. Runs in its own process, so memory
+    of other runs is not traced.
+    """
+    use_loop('asyncio')
+    loop = get_event_loop()
+    priority = UrlPriority()
+    # Allocated before tracing, as the seen-set is not measured.
+    seen = bytearray(site.pages)
+    prefix = f'{root_url}p/'
+
+    # Initialize measurements
+    crawled = 0
+    peak_queued = 0
+    peak_bytes = 0
+
+    async def crawl():
+        nonlocal crawled, peak_queued, peak_bytes
+        q = HostScheduler(per_host=1)
+        seen[0] = 1
+        q.put_nowait((f'{prefix}0', max_redirects, 0, 0), 0)
+        while q.qsize():
+            url, redirects, depth, _ = await q.get()
+            for link in site.links[int(url[len(prefix):])]:
+                if not seen[link]:
+                    seen[link] = 1
+                    link_url = f'{prefix}{link}'
+                    q.put_nowait((link_url, redirects, depth + 1, 0),
+                                 priority(link_url, depth + 1))
+            q.task_done(url)
+            crawled += 1
+            if q.qsize() > peak_queued:
+                peak_queued = q.qsize()
+                peak_bytes = tracemalloc.get_traced_memory()[0] - baseline
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    loop.run_until_complete(crawl())
+    elapsed = time.perf_counter() - started
+    tracemalloc.stop()
+    loop.close()
+
+    conn.send({
+        'crawled': crawled,
+        'peak_queued': peak_queued,
+        'peak_frontier_mb': round(peak_bytes / 2 ** 20, 2),
+        'bytes_per_queued_url': round(peak_bytes / max(peak_queued, 1), 1),
+        'elapsed': round(elapsed, 3),
+        'urls_per_second': round(crawled / elapsed, 2),
+    })
+    conn.close()
@@ -0,0 +1,98 @@
+"""
+canonical.py - Turn URL variants pointing to the same page into one URL.
+"""
+from fnmatch import translate
+from functools import lru_cache
+from urllib.parse import unquote_plus, urlsplit, urlunsplit
+import re
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+# Tracking and session parameters dropped by default.
+DROP_PARAMS = (
+    'utm_*', 'gclid', 'fbclid', 'msclkid', 'sid', 'sessionid',
+    '*sessid', '*session_id',
+)
+
+
+def param_name(param):
+    """
+    Decoded name of a raw 'name=value' query parameter.
+    """
+    return unquote_plus(param.split('=', 1)[0])
+
+
+class Canonicalizer:
+    """
+    Callable returning the canonical form of a URL: lowercase scheme and
+    host, no default port nor fragment, query parameters sorted by name
+    without the dropped ones and a normalized trailing slash. Parameters
+    are kept as written, neither decoded nor encoded again, as the
+    canonical form is the one fetched. Results are cached.
+
+    Init Attributes:
+        drop_params     Glob patterns of query parameters to drop, matched
+                        case insensitively.
+        trailing_slash  What to do with trailing slashes of non-root paths:
+                        'keep', 'strip' or 'add'.
+        cache_size      Number of URLs whose canonical form is cached.
+    """
+    TRAILING_SLASH = ('keep', 'strip', 'add')
+
+    def __init__(self, drop_params=DROP_PARAMS, trailing_slash='keep',
+                 cache_size=65536):
+        if trailing_slash not in self.TRAILING_SLASH:
+            raise ValueError(f"Unknown trailing slash policy: "
+                             f"{trailing_slash}")
+        self.trailing_slash = trailing_slash
+        self.drop_params = list(drop_params or ())
+        self.drop_regex = None
+        if drop_params:
+            self.drop_regex = re.compile(
+                '|'.join(translate(param) for param in drop_params),
+                re.IGNORECASE)
+        self.canonicalize = lru_cache(maxsize=cache_size)(self.canonicalize)
+
+    def __call__(self, url):
+        return self.canonicalize(url)
+
+    def canonicalize(self, url):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+
+        # Lowercase host, dropping default port.
+        try:
+            port = parts.port
+        except ValueError:
+            # Leave broken ports alone, fetching will fail anyway.
+            return url
+        netloc = parts.hostname or ''
+        if ':' in netloc:
+            netloc = f'[{netloc}]'
+        if port and port != DEFAULT_PORTS.get(scheme):
+            netloc = f'{netloc}:{port}'
+        if parts.username:
+            userinfo = parts.username
+            if parts.password:
+                userinfo = f'{userinfo}:{parts.password}'
+            netloc = f'{userinfo}@{netloc}'
+
+        path = parts.path or '/'
+        if path != '/':
+            if self.trailing_slash == 'strip':
+                path = path.rstrip('/') or '/'
+            elif self.trailing_slash == 'add' and not path.endswith('/'):
+                path += '/'
+
+        query = parts.query
+        if query:
+            params = [param for param in query.split('&') if param]
+            if self.drop_regex is not None:
+                params = [param for param in params
+                          if not self.drop_regex.match(param_name(param))]
+            # Values of repeated parameters keep their order.
+            query = '&'.join(sorted(params, key=param_name))
+
+        return urlunsplit((scheme, netloc, path, query, ''))
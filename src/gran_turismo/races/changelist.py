@@ -0,0 +1,158 @@
+"""
+changelist.py - Admin change lists staying fast on tables of millions of rows.
+
+Django admin pages through results with OFFSET, which scans every skipped
+row, and counts them all with COUNT(*) on every page load. Keyset change
+lists seek past the last row shown instead, and only estimate counts.
+"""
+import base64
+import json
+
+from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models import Q
+
+
+# Query string parameter of the last row of the previous page.
+CURSOR_VAR = 'after'
+
+# Counts are exact up to this number of rows, estimated beyond.
+EXACT_COUNT = 10000
+
+
+def estimate_count(queryset):
+    """
+    Number of rows of queryset and whether it is exact. Large counts are
+    taken from the query planner on PostgreSQL, and capped to EXACT_COUNT
+    elsewhere, exact being None as the count is only a lower bound.
+    """
+    queryset = queryset.order_by()
+    count = queryset[:EXACT_COUNT + 1].count()
+    if count <= EXACT_COUNT:
+        return count, True
+    if connection.vendor != 'postgresql':
+        return EXACT_COUNT, None
+    plan = json.loads(queryset.explain(format='json'))
+    return max(count, int(plan[0]['Plan']['Plan Rows'])), False
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(
+        json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, ValueError) as e:
+        raise IncorrectLookupParameters(e)
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Change list paging with a cursor holding the ordering values of the
+    last row shown, so every page is an index seek. Pages can only be
+    walked forward from the first one, in the model admin ordering.
+    """
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # Filters and other links restart from the first page.
+        if not new_params or CURSOR_VAR not in new_params:
+            remove = list(remove or []) + [CURSOR_VAR]
+        return super().get_query_string(new_params, remove)
+
+    def get_keys(self):
+        """
+        (lookup, descending) pairs of the list ordering.
+        """
+        keys = []
+        for field in self.queryset.query.order_by:
+            if not isinstance(field, str):
+                raise ImproperlyConfigured(
+                    f"Keyset change lists cannot order by {field}")
+            if field.startswith('-'):
+                keys.append((field[1:], True))
+            else:
+                keys.append((field, False))
+        return keys
+
+    def get_results(self, request):
+        self.keys = self.get_keys()
+        self.cursor = request.GET.get(CURSOR_VAR)
+
+        queryset = self.queryset
+        if self.cursor:
+            values = decode_cursor(self.cursor)
+            if not isinstance(values, list) or len(values) != len(self.keys):
+                raise IncorrectLookupParameters(self.cursor)
+            queryset = queryset.filter(self.after(values))
+
+        # One extra row tells whether there is a next page.
+        rows = list(queryset[:self.list_per_page + 1])
+        self.result_list = rows[:self.list_per_page]
+        self.next_cursor = None
+        if len(rows) > self.list_per_page:
+            self.next_cursor = encode_cursor(
+                [self.key_value(rows[self.list_per_page - 1], lookup)
+                 for lookup, _ in self.keys])
+
+        self.result_count, self.result_count_exact = \
+            self.model_admin.estimate_count(
+                request, self.queryset, self.get_filters_params())
+        self.full_result_count = None
+        self.show_all = self.can_show_all = False
+        self.multi_page = bool(self.cursor or self.next_cursor)
+        self.paginator = None
+
+    def after(self, values):
+        """
+        Condition on rows coming after those with given ordering values.
+        """
+        condition = Q()
+        equal = Q()
+        for (lookup, descending), value in zip(self.keys, values):
+            condition |= equal & Q(**{
+                f"{lookup}__{'lt' if descending else 'gt'}": value})
+            equal &= Q(**{lookup: value})
+        return condition
+
+    @staticmethod
+    def key_value(row, lookup):
+        value = row
+        for name in lookup.split('__'):
+            value = getattr(value, name)
+        return value
+
+    def first_page_url(self):
+        return self.get_query_string(remove=[CURSOR_VAR])
+
+    def next_page_url(self):
+        return self.get_query_string({CURSOR_VAR: self.next_cursor})
+
+
+class KeysetModelAdmin(admin.ModelAdmin):
+    """
+    Model admin listing with a KeysetChangeList. Columns are not sortable,
+    the ordering should match an index of the model.
+    """
+    change_list_template = 'admin/keyset_change_list.html'
+    show_full_result_count = False
+    sortable_by = ()
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def estimate_count(self, request, queryset, params):
+        """
+        Number of rows listed given filter params, and whether it is exact
+        (None for a lower bound).
+        """
+        return estimate_count(queryset)
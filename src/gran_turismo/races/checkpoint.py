@@ -0,0 +1,160 @@
+"""
+checkpoint.py - Keep race state on disk so a race can be resumed.
+"""
+from functools import partial
+from threading import Lock
+import mmap
+import os
+import sqlite3
+
+
+class Checkpoint:
+    """
+    On-disk state of a race. Frontier is kept as an append-only SQLite log
+    of queued and crawled URLs, the seen-set (e.g. bloom filter bit array)
+    is snapshotted to a file and loaded back memory-mapped.
+
+    Changes are buffered in memory and written in a single transaction
+    on every snapshot, so the log always matches a consistent point of
+    the race. A URL whose results are being collected is only logged as
+    crawled once they are stored, so results are never lost on resume.
+
+    Init Attributes:
+        path            Directory where race state is kept.
+    """
+    COUNTERS = (
+        'twos', 'threes', 'fours', 'fives', 'failures', 'crawled', 'retries',
+    )
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.db_path = os.path.join(path, 'frontier.sqlite3')
+        self.seen_path = os.path.join(path, 'seen_urls.snapshot')
+        self.lock = Lock()
+
+        # Initialize changes since last snapshot
+        self.queued = []
+        self.crawled = []
+
+        # Initialize number of results of URLs not stored yet, and URLs
+        # crawled waiting for them
+        self.unstored = {}
+        self.waiting = set()
+
+        with self.connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS frontier ("
+                       "id INTEGER PRIMARY KEY, "
+                       "url TEXT NOT NULL, "
+                       "max_redirects INTEGER NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS crawled ("
+                       "url TEXT PRIMARY KEY) WITHOUT ROWID")
+            db.execute("CREATE TABLE IF NOT EXISTS counters ("
+                       "name TEXT PRIMARY KEY, "
+                       "value INTEGER NOT NULL)")
+
+    def connect(self):
+        return sqlite3.connect(self.db_path)
+
+    def queue(self, url, max_redirects):
+        """
+        Remember a URL added to the frontier.
+        """
+        self.queued.append((url, max_redirects))
+
+    def crawl(self, url):
+        """
+        Remember a URL already crawled, once its results are stored.
+        """
+        if url in self.unstored:
+            self.waiting.add(url)
+        else:
+            self.crawled.append((url,))
+
+    def collect(self, url):
+        """
+        Hold a URL as not crawled until a result of it being collected is
+        stored.
+        """
+        self.unstored[url] = self.unstored.get(url, 0) + 1
+
+    def stored(self, results):
+        """
+        Release URLs of results stored by the collector.
+        """
+        for result in results:
+            url = result[0]
+            count = self.unstored.get(url)
+            if count is None:
+                continue
+            if count > 1:
+                self.unstored[url] = count - 1
+                continue
+            del self.unstored[url]
+            if url in self.waiting:
+                self.waiting.discard(url)
+                self.crawled.append((url,))
+
+    def snapshot(self, driver):
+        """
+        Take changes since last snapshot along with driver counters and
+        seen-set. Returns a callable writing them to disk, which
+        is safe to run outside the event loop.
+        """
+        queued, self.queued = self.queued, []
+        crawled, self.crawled = self.crawled, []
+        counters = [(name, getattr(driver, name)) for name in self.COUNTERS]
+        seen = driver.seen_urls.snapshot()
+        return partial(self.write, queued, crawled, counters, seen)
+
+    def write(self, queued, crawled, counters, seen):
+        """
+        Append a snapshot to disk.
+        """
+        with self.lock:
+            db = self.connect()
+            try:
+                with db:
+                    db.executemany(
+                        "INSERT INTO frontier (url, max_redirects) "
+                        "VALUES (?, ?)", queued)
+                    db.executemany(
+                        "INSERT OR IGNORE INTO crawled (url) VALUES (?)",
+                        crawled)
+                    db.executemany(
+                        "INSERT OR REPLACE INTO counters (name, value) "
+                        "VALUES (?, ?)", counters)
+            finally:
+                db.close()
+
+            # Seen-set goes last: if we die in between, an older snapshot
+            # only means some URLs could be crawled twice.
+            tmp_path = self.seen_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(seen)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.seen_path)
+
+    def restore(self, driver):
+        """
+        Load race state back into driver. Returns frontier items that
+        were queued but not crawled yet.
+        """
+        db = self.connect()
+        try:
+            for name, value in db.execute(
+                    "SELECT name, value FROM counters"):
+                setattr(driver, name, value)
+            pending = db.execute(
+                "SELECT url, max_redirects FROM frontier "
+                "WHERE url NOT IN (SELECT url FROM crawled) "
+                "ORDER BY id").fetchall()
+        finally:
+            db.close()
+
+        if os.path.exists(self.seen_path):
+            with open(self.seen_path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                driver.seen_urls.restore(m)
+
+        return pending
@@ -1,27 +1,305 @@
 """
 collector.py - Take care of bringing race results into DB
+
+Results are inserted as plain tuples, without building model instances:
+with COPY FROM STDIN on PostgreSQL, and a single executemany elsewhere,
+one transaction per batch. SQLite databases are switched to write-ahead
+logging, so the admin can read while results are written.
 """
-from itertools import islice
+from asyncio import TimeoutError, get_event_loop, wait_for
+from concurrent.futures import ThreadPoolExecutor
+import io
+import time
+
+from django.db import connections, router, transaction
 
 from . import models
 
 
+# URL hashes looked up at once, below SQLite limit of query parameters.
+INTERN_CHUNK = 500
+
+# Bounds of batch sizes, see Collector.resize().
+MIN_BATCH = 50
+MAX_BATCH = 50000
+
+# Characters escaped in COPY text format.
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def copy_line(row):
+    """
+    Line of a COPY text format stream holding values of row.
+    """
+    return '\t'.join(
+        '\\N' if value is None else str(value).translate(COPY_ESCAPES)
+        for value in row) + '\n'
+
+
+def prepare_connection(connection):
+    """
+    Tune a DB connection for bulk inserts. On SQLite, the write-ahead log
+    lets readers go on during writes, and is only synced at checkpoints.
+    """
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+
+
+def bulk_insert(model, fields, rows, ignore_conflicts=False):
+    """
+    Insert rows, lists of tuples of values of fields of model, without
+    building model instances. Rows conflicting with existing ones are
+    skipped with ignore_conflicts, which COPY cannot do.
+    """
+    connection = connections[router.db_for_write(model)]
+    ops = connection.ops
+    table = ops.quote_name(model._meta.db_table)
+    columns = ', '.join(ops.quote_name(model._meta.get_field(name).column)
+                        for name in fields)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql' and not ignore_conflicts:
+            stream = io.StringIO()
+            stream.writelines(copy_line(row) for row in rows)
+            stream.seek(0)
+            cursor.copy_expert(f'COPY {table} ({columns}) FROM STDIN', stream)
+        else:
+            values = ', '.join(['%s'] * len(fields))
+            suffix = ops.ignore_conflicts_suffix_sql(ignore_conflicts)
+            cursor.executemany(
+                f'{ops.insert_statement(ignore_conflicts)} {table} '
+                f'({columns}) VALUES ({values}) {suffix}'.rstrip(), rows)
+
+
+def store_session(session_id, driver, ending_time, state='finished'):
+    """
+    Store counters of a race into its session and roll its results up.
+    """
+    models.RacingSession.objects.filter(pk=session_id).update(
+        ending_time=ending_time,
+        state=state,
+        successes=driver.twos,
+        redirects=driver.threes,
+        soft_errors=driver.fours,
+        hard_errors=driver.fives,
+        failures=driver.failures,
+        crawled=driver.crawled,
+    )
+    models.RacingStatusCount.rollup(session_id)
+
+
+def carry_over(previous, session_id, storage, visited, batch_size=500):
+    """
+    Copy results of a previous racing session whose URLs were not crawled
+    again, visited holding RacingUrl hashes of URLs crawled. Returns the
+    number of results copied. Pages of results read follow the size of
+    batches written.
+    """
+    writer = Collector(session_id, None, batch_size, storage=storage)
+    results = previous.result_model.objects.filter(session_id=previous.id)
+    if previous.storage == 'compact':
+        fields = ('id', 'url__url', 'url__hash', 'status_code', 'latency',
+                  'depth', 'redirects')
+    else:
+        fields = ('id', 'url', 'status_code', 'error', 'latency',
+                  'redirects')
+    last_id = 0
+    while True:
+        rows = list(results.filter(id__gt=last_id).order_by('id')
+                    .values_list(*fields)[:writer.batch_size])
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        if previous.storage == 'compact':
+            batch = [(url, status_code, '', latency / 1000, depth, redirects)
+                     for _, url, url_hash, status_code, latency, depth,
+                     redirects in rows
+                     if url_hash not in visited]
+        else:
+            batch = [(url, status_code, error, latency / 1000, 0, redirects)
+                     for _, url, status_code, error, latency, redirects
+                     in rows
+                     if models.RacingUrl.hash_url(url) not in visited]
+        if batch:
+            writer.write(batch)
+    return writer.collected
+
+
 class Collector:
+    """
+    Streaming stage that drains race results while the race is running
+    and stores them into DB in batches.
+
+    Init Attributes:
+        session_id      Id of the RacingSession results belong to.
+        results         asyncio.Queue of (url, status_code, error, latency,
+                        depth, redirects) tuples fed by the driver, latency
+                        being in seconds and redirects the text of hops
+                        followed from url, see drivers.format_chain(). A
+                        None item marks the end of the race.
+        batch_size      Flush pending results once this many are buffered.
+        flush_interval  Flush pending results at least every these seconds.
+        storage         Store RacingResult rows ('full'), or CompactResult
+                        rows and interned URLs ('compact').
+        commit_target   Seconds storing a batch should take. Batch size is
+                        adjusted towards it as batches are stored, or kept
+                        when 0.
+        on_commit       Optional callable taking every batch once stored,
+                        called from the event loop, e.g.
+                        checkpoint.Checkpoint.stored.
+    """
+
+    def __init__(self, session_id, results, batch_size=250,
+                 flush_interval=5.0, storage='full', commit_target=0.5,
+                 on_commit=None):
+        self.session_id = session_id
+        self.results = results
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.storage = storage
+        self.commit_target = commit_target
+        self.on_commit = on_commit
+        # A single DB writer keeps batches in order and lets the queue
+        # fill up (and engines slow down) whenever DB is lagging behind.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.prepared = False
+
+        # Initialize progress counters
+        self.collected = 0
+        self.write_time = 0.0
+
+    @property
+    def rate(self):
+        """
+        Results stored per second spent writing.
+        """
+        return self.collected / max(self.write_time, 1e-6)
+
+    async def collect(self):
+        """
+        Drain results until the end of the race, flushing by size or time.
+        The next batch fills up while the previous one is being written.
+        """
+        loop = get_event_loop()
+        batch = []
+        writing = written = None
+        deadline = time.monotonic() + self.flush_interval
+        try:
+            while True:
+                # Only wait on the queue when there is nothing to drain.
+                if not self.results.empty():
+                    result = self.results.get_nowait()
+                else:
+                    timeout = max(deadline - time.monotonic(), 0)
+                    try:
+                        result = await wait_for(self.results.get(), timeout)
+                    except TimeoutError:
+                        result = ()
+                if result:
+                    batch.append(result)
+
+                # Flush by size, by time or because race has ended.
+                if result is None or len(batch) >= self.batch_size \
+                        or time.monotonic() >= deadline:
+                    if batch:
+                        if writing is not None:
+                            await writing
+                            self.committed(written)
+                        writing = loop.run_in_executor(
+                            self.executor, self.write, batch)
+                        written = batch
+                    batch = []
+                    deadline = time.monotonic() + self.flush_interval
+
+                if result is None:
+                    break
+            if writing is not None:
+                await writing
+                self.committed(written)
+        finally:
+            await loop.run_in_executor(self.executor, connections.close_all)
+            self.executor.shutdown()
+
+    def committed(self, batch):
+        """
+        Let on_commit know a batch was stored.
+        """
+        if self.on_commit is not None:
+            self.on_commit(batch)
+
+    def write(self, batch):
+        """
+        Store a batch of results in a single transaction. Runs in the
+        writer thread.
+        """
+        started = time.monotonic()
+        model = models.CompactResult if self.storage == 'compact' \
+            else models.RacingResult
+        using = router.db_for_write(model)
+        if not self.prepared:
+            prepare_connection(connections[using])
+            self.prepared = True
+        with transaction.atomic(using=using):
+            if self.storage == 'compact':
+                self.write_compact(batch)
+            else:
+                bulk_insert(
+                    model, ('session', 'url', 'status_code', 'error',
+                            'latency', 'redirects'),
+                    [(self.session_id, url, status_code, error,
+                      round(latency * 1000), redirects)
+                     for url, status_code, error, latency, _, redirects
+                     in batch])
+        elapsed = time.monotonic() - started
+        self.write_time += elapsed
+        self.collected += len(batch)
+        # Batches flushed by time tell little about the pace of DB.
+        if self.commit_target and len(batch) >= self.batch_size:
+            self.resize(len(batch), elapsed)
+
+    def resize(self, rows, seconds):
+        """
+        Size batches to be stored in about commit_target seconds, given
+        rows stored in seconds, at most doubling or halving them at once.
+        """
+        target = rows * self.commit_target / max(seconds, 1e-6)
+        target = min(max(target, self.batch_size / 2), self.batch_size * 2)
+        self.batch_size = int(min(max(target, MIN_BATCH), MAX_BATCH))
 
-    def __init__(self, session_id, results):
-        self.results = (
-            models.RacingResult(
-                session_id=session_id,
-                url=result[0],
-                status_code=result[1],
-            ) for result in results
-        )
-        self.batch_size = 250
-        
-    def collect(self):
-        while True:
-            batch = list(islice(self.results, self.batch_size))
-            if not batch:
-                break
-            models.RacingResult.objects.bulk_create(batch, self.batch_size)
+    def write_compact(self, batch):
+        url_ids = self.intern([result[0] for result in batch])
+        bulk_insert(
+            models.CompactResult,
+            ('session', 'url', 'status_code', 'latency', 'depth',
+             'redirects'),
+            [(self.session_id, url_ids[url], status_code,
+              round(latency * 1000), depth, redirects)
+             for url, status_code, _, latency, depth, redirects in batch])
 
+    def intern(self, urls):
+        """
+        Ids of RacingUrl rows of urls, storing those not seen before.
+        """
+        hashes = {models.RacingUrl.hash_url(url): url for url in urls}
+        url_hashes = list(hashes)
+        ids = {}
+        for start in range(0, len(url_hashes), INTERN_CHUNK):
+            chunk = url_hashes[start:start + INTERN_CHUNK]
+            known = dict(models.RacingUrl.objects.filter(hash__in=chunk)
+                         .values_list('hash', 'id'))
+            missing = [url_hash for url_hash in chunk
+                       if url_hash not in known]
+            if missing:
+                # Another writer may store them meanwhile, ask again.
+                bulk_insert(
+                    models.RacingUrl, ('hash', 'url'),
+                    [(url_hash, hashes[url_hash]) for url_hash in missing],
+                    ignore_conflicts=True)
+                known.update(models.RacingUrl.objects
+                             .filter(hash__in=missing)
+                             .values_list('hash', 'id'))
+            for url_hash, url_id in known.items():
+                ids[hashes[url_hash]] = url_id
+        return ids
@@ -0,0 +1,146 @@
+"""
+concurrency.py - Adapt the number of requests in flight to the target.
+"""
+from asyncio import get_event_loop
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+def retry_after(value, maximum=300):
+    """
+    Seconds to wait according to a Retry-After header, given either as
+    seconds or as an HTTP date. None if it cannot be parsed.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        seconds = int(value)
+    else:
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        seconds = (when - datetime.now(timezone.utc)).total_seconds()
+    return min(max(seconds, 0), maximum)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD controller of the number of requests in flight. Engines take a
+    permit before fetching and give it back when done.
+
+    Every interval, responses seen are checked for congestion: a share of
+    429s, 5xx and timeouts above error_threshold, or a median latency
+    above latency_tolerance times the best one seen so far. The limit is
+    then cut by the decrease factor. Otherwise, if engines were actually
+    using every permit, it doubles during slow start and grows by one
+    afterwards.
+
+    Init Attributes:
+        minimum         Lowest number of permits.
+        maximum         Highest number of permits.
+        interval        Seconds between two adjustments.
+        error_threshold Share of congestion errors cutting the limit.
+        latency_tolerance
+                        Ratio over the baseline latency cutting the limit.
+        decrease        Factor the limit is multiplied by on congestion.
+    """
+    def __init__(self, minimum, maximum, interval=1.0, error_threshold=0.05,
+                 latency_tolerance=2.0, decrease=0.7):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.error_threshold = error_threshold
+        self.latency_tolerance = latency_tolerance
+        self.decrease = decrease
+
+        self.limit = float(minimum)
+        self.slow_start = True
+        self.baseline = None
+        self.in_flight = 0
+        self.waiters = []
+
+        # Initialize current window
+        self.window_start = None
+        self.latencies = []
+        self.errors = 0
+        self.busiest = 0
+
+        # (seconds since start, permits) every time permits change.
+        self.started = None
+        self.history = []
+
+    @property
+    def permits(self):
+        return int(self.limit)
+
+    async def acquire(self):
+        loop = get_event_loop()
+        if self.started is None:
+            self.started = self.window_start = loop.time()
+            self.history.append((0, self.permits))
+        while self.in_flight >= self.permits:
+            waiter = loop.create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                self.waiters.remove(waiter)
+        self.in_flight += 1
+        self.busiest = max(self.busiest, self.in_flight)
+
+    def release(self):
+        self.in_flight -= 1
+        self.wakeup()
+
+    def wakeup(self):
+        free = self.permits - self.in_flight
+        for waiter in self.waiters:
+            if free <= 0:
+                break
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def observe(self, latency, congested):
+        """
+        Account for a response, or a failure, taking latency seconds.
+        """
+        self.latencies.append(latency)
+        self.errors += congested
+        now = get_event_loop().time()
+        if self.window_start is not None \
+                and now - self.window_start >= self.interval:
+            self.adjust(now)
+
+    def adjust(self, now):
+        latencies = sorted(self.latencies)
+        latency = latencies[len(latencies) // 2]
+        error_rate = self.errors / len(latencies)
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        else:
+            # Let the baseline follow slow changes of the target.
+            self.baseline += (latency - self.baseline) * 0.05
+
+        before = self.permits
+        if error_rate > self.error_threshold \
+                or latency > self.baseline * self.latency_tolerance:
+            self.slow_start = False
+            self.limit = max(self.minimum, self.limit * self.decrease)
+        elif self.busiest >= before:
+            if self.slow_start:
+                self.limit = min(self.maximum, self.limit * 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1)
+        if self.permits != before:
+            self.history.append((round(now - self.started, 1), self.permits))
+            self.wakeup()
+
+        self.window_start = now
+        self.latencies = []
+        self.errors = 0
+        self.busiest = self.in_flight
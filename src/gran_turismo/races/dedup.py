@@ -0,0 +1,362 @@
+"""
+dedup.py - Remember which URLs the driver has already seen.
+
+Every backend supports `in` and add(), reports how full it is and its
+estimated false positive rate, and can be snapshotted to bytes and
+restored from any buffer (e.g. an mmap) for checkpoints.
+"""
+from array import array
+from hashlib import blake2b
+import math
+import mmap
+import os
+import struct
+import tempfile
+
+
+def hash_pair(url):
+    """
+    Two independent 64-bit hashes of url. The second one is odd so that
+    double hashing walks through every bit of a slice.
+    """
+    digest = blake2b(url.encode(), digest_size=16).digest()
+    return (int.from_bytes(digest[:8], 'little'),
+            int.from_bytes(digest[8:], 'little') | 1)
+
+
+def hash64(url):
+    """
+    Non-zero 64-bit hash of url.
+    """
+    digest = blake2b(url.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+class BloomSlice:
+    """
+    A plain bloom filter sized for a capacity and an error rate.
+    """
+    HEADER = struct.Struct('<QQQQQ')
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.num_bits = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_probes = max(1, int(math.ceil(
+            self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        self.set_bits = 0
+
+    def probes(self, hashes):
+        h1, h2 = hashes
+        num_bits = self.num_bits
+        return ((h1 + i * h2) % num_bits for i in range(self.num_probes))
+
+    def contains(self, hashes):
+        bits = self.bits
+        for bitno in self.probes(hashes):
+            if not bits[bitno >> 3] & (1 << (bitno & 7)):
+                return False
+        return True
+
+    def add(self, hashes):
+        bits = self.bits
+        for bitno in self.probes(hashes):
+            byteno, mask = bitno >> 3, 1 << (bitno & 7)
+            if not bits[byteno] & mask:
+                bits[byteno] |= mask
+                self.set_bits += 1
+        self.count += 1
+
+    @property
+    def fill_ratio(self):
+        return self.set_bits / self.num_bits
+
+    @property
+    def error_rate(self):
+        return self.fill_ratio ** self.num_probes
+
+    def snapshot(self):
+        header = self.HEADER.pack(
+            self.capacity, self.num_bits, self.num_probes,
+            self.count, self.set_bits)
+        return header + bytes(self.bits)
+
+    @classmethod
+    def restore(cls, buffer, offset=0):
+        """
+        Load a slice from buffer. Returns it along with the offset where
+        it ends.
+        """
+        capacity, num_bits, num_probes, count, set_bits = \
+            cls.HEADER.unpack_from(buffer, offset)
+        offset += cls.HEADER.size
+        size = (num_bits + 7) // 8
+        bloom = cls.__new__(cls)
+        bloom.capacity = capacity
+        bloom.num_bits = num_bits
+        bloom.num_probes = num_probes
+        bloom.count = count
+        bloom.set_bits = set_bits
+        bloom.bits = bytearray(buffer[offset:offset + size])
+        return bloom, offset + size
+
+
+class BloomFilter:
+    """
+    Fixed size bloom filter. Its false positive rate grows past the
+    configured one once more than expected_urls are added.
+
+    Init Attributes:
+        expected_urls   Capacity of the bloom filter.
+        error_rate      Expected error rate in false positives.
+    """
+    MAGIC = b'GTBF'
+
+    def __init__(self, expected_urls, error_rate, path=None):
+        self.slice = BloomSlice(expected_urls, error_rate)
+
+    def __contains__(self, url):
+        return self.slice.contains(hash_pair(url))
+
+    def __len__(self):
+        return self.slice.count
+
+    def add(self, url):
+        self.slice.add(hash_pair(url))
+
+    @property
+    def fill_ratio(self):
+        return self.slice.fill_ratio
+
+    @property
+    def error_rate(self):
+        return self.slice.error_rate
+
+    def snapshot(self):
+        return self.MAGIC + self.slice.snapshot()
+
+    def restore(self, buffer):
+        if bytes(buffer[:4]) != self.MAGIC:
+            raise ValueError("Snapshot was not taken from a bloom filter")
+        bloom, _ = BloomSlice.restore(buffer, 4)
+        if bloom.num_bits != self.slice.num_bits:
+            raise ValueError("Bloom filter options differ from snapshot")
+        self.slice = bloom
+
+
+class ScalableBloomFilter:
+    """
+    Bloom filter adding slices as it fills up. Each new slice is larger and
+    has a tighter error rate, so the compound false positive rate stays
+    under the configured one however many URLs are added.
+
+    Init Attributes:
+        expected_urls   Capacity of the first slice.
+        error_rate      Expected error rate in false positives.
+        growth          Capacity ratio between two consecutive slices.
+        tightening      Error rate ratio between two consecutive slices.
+    """
+    MAGIC = b'GTSB'
+    COUNT = struct.Struct('<Q')
+
+    def __init__(self, expected_urls, error_rate, path=None,
+                 growth=2, tightening=0.8):
+        self.expected_urls = expected_urls
+        self.target_error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.slices = []
+        self.grow()
+
+    def grow(self):
+        n = len(self.slices)
+        self.slices.append(BloomSlice(
+            self.expected_urls * self.growth ** n,
+            self.target_error_rate * (1 - self.tightening)
+            * self.tightening ** n,
+        ))
+
+    def __contains__(self, url):
+        hashes = hash_pair(url)
+        for bloom in reversed(self.slices):
+            if bloom.contains(hashes):
+                return True
+        return False
+
+    def __len__(self):
+        return sum(bloom.count for bloom in self.slices)
+
+    def add(self, url):
+        hashes = hash_pair(url)
+        bloom = self.slices[-1]
+        if bloom.count >= bloom.capacity:
+            self.grow()
+            bloom = self.slices[-1]
+        bloom.add(hashes)
+
+    @property
+    def fill_ratio(self):
+        """
+        Fill ratio of the slice being filled.
+        """
+        return self.slices[-1].fill_ratio
+
+    @property
+    def error_rate(self):
+        rate = 1
+        for bloom in self.slices:
+            rate *= 1 - bloom.error_rate
+        return 1 - rate
+
+    def snapshot(self):
+        return b''.join(
+            [self.MAGIC, self.COUNT.pack(len(self.slices))]
+            + [bloom.snapshot() for bloom in self.slices])
+
+    def restore(self, buffer):
+        if bytes(buffer[:4]) != self.MAGIC:
+            raise ValueError(
+                "Snapshot was not taken from a scalable bloom filter")
+        num_slices, = self.COUNT.unpack_from(buffer, 4)
+        offset = 4 + self.COUNT.size
+        slices = []
+        for _ in range(num_slices):
+            bloom, offset = BloomSlice.restore(buffer, offset)
+            slices.append(bloom)
+        self.slices = slices
+
+
+class HashSet:
+    """
+    Exact set of 64-bit URL hashes in an open addressing table, doubling
+    its size whenever it gets half full. Costs 16 to 32 bytes per URL.
+
+    Init Attributes:
+        expected_urls   Initial capacity of the table.
+    """
+    MAGIC = b'GTHS'
+    HEADER = struct.Struct('<QQ')
+    MAX_LOAD = 0.5
+
+    def __init__(self, expected_urls, error_rate=None, path=None):
+        self.count = 0
+        self.table = self.allocate(self.table_size(expected_urls))
+
+    @staticmethod
+    def table_size(urls):
+        size = 8
+        while size * HashSet.MAX_LOAD < urls:
+            size *= 2
+        return size
+
+    def allocate(self, size):
+        return array('Q', bytes(8 * size))
+
+    def release(self, table):
+        pass
+
+    def slot(self, table, key):
+        """
+        Index of key in table, or of the empty slot it would go in.
+        """
+        mask = len(table) - 1
+        index = key & mask
+        while True:
+            value = table[index]
+            if value == key or not value:
+                return index
+            index = (index + 1) & mask
+
+    def __contains__(self, url):
+        key = hash64(url)
+        return self.table[self.slot(self.table, key)] == key
+
+    def __len__(self):
+        return self.count
+
+    def add(self, url):
+        key = hash64(url)
+        index = self.slot(self.table, key)
+        if self.table[index] == key:
+            return
+        self.table[index] = key
+        self.count += 1
+        if self.count > len(self.table) * self.MAX_LOAD:
+            self.resize(len(self.table) * 2)
+
+    def resize(self, size):
+        old, self.table = self.table, self.allocate(size)
+        for key in old:
+            if key:
+                self.table[self.slot(self.table, key)] = key
+        self.release(old)
+
+    @property
+    def fill_ratio(self):
+        return self.count / len(self.table)
+
+    @property
+    def error_rate(self):
+        # Only two distinct URLs sharing a 64-bit hash can be mistaken.
+        return self.count / 2 ** 64
+
+    def snapshot(self):
+        header = self.HEADER.pack(len(self.table), self.count)
+        return self.MAGIC + header + self.table.tobytes()
+
+    def restore(self, buffer):
+        if bytes(buffer[:4]) != self.MAGIC:
+            raise ValueError("Snapshot was not taken from a hash set")
+        size, count = self.HEADER.unpack_from(buffer, 4)
+        offset = 4 + self.HEADER.size
+        table = self.allocate(size)
+        memoryview(table).cast('B')[:] = buffer[offset:offset + 8 * size]
+        self.release(self.table)
+        self.table = table
+        self.count = count
+
+
+class MmapHashSet(HashSet):
+    """
+    HashSet whose table lives in a memory-mapped temporary file, so runs
+    larger than RAM are paged in and out by the OS.
+
+    Init Attributes:
+        expected_urls   Initial capacity of the table.
+        path            Directory for the table file. Defaults to the
+                        system temporary directory.
+    """
+
+    def __init__(self, expected_urls, error_rate=None, path=None):
+        self.path = path
+        self.maps = {}
+        super().__init__(expected_urls)
+
+    def allocate(self, size):
+        fd, filename = tempfile.mkstemp(
+            prefix='seen_urls-', suffix='.table', dir=self.path)
+        try:
+            os.ftruncate(fd, 8 * size)
+            buffer = mmap.mmap(fd, 8 * size)
+        finally:
+            os.close(fd)
+            # File lives as long as the mapping does.
+            os.unlink(filename)
+        table = memoryview(buffer).cast('Q')
+        self.maps[id(table)] = buffer
+        return table
+
+    def release(self, table):
+        buffer = self.maps.pop(id(table))
+        table.release()
+        buffer.close()
+
+
+BACKENDS = {
+    'bloom': BloomFilter,
+    'scalable': ScalableBloomFilter,
+    'exact': HashSet,
+    'mmap': MmapHashSet,
+}
@@ -0,0 +1,105 @@
+"""
+diff.py - Compare results of two racing sessions.
+
+URLs erroring (4xx, 5xx or no response) after but not before are new
+errors, the other way around fixed ones. URLs whose status otherwise
+differs are changed. A URL without a result in a session counts as not
+erroring, since races only store successes with --collect-all.
+
+Sessions are joined by URL in the database, which writes differences
+straight into RacingDiffEntry rows: Python never holds any result.
+"""
+from django.db import connection, transaction
+from django.db.models import Count
+
+from . import models
+
+
+class RaceRunning(Exception):
+    """
+    Sessions still running cannot be compared.
+    """
+
+
+def results_sql(session):
+    """
+    Query of (url, status_code) results of session, and its params.
+    """
+    if session.storage == 'compact':
+        return (
+            f"SELECT u.url AS url, r.status_code AS status_code "
+            f"FROM {models.CompactResult._meta.db_table} r "
+            f"JOIN {models.RacingUrl._meta.db_table} u ON u.id = r.url_id "
+            f"WHERE r.session_id = %s"
+        ), [session.id]
+    return (
+        f"SELECT url, status_code "
+        f"FROM {models.RacingResult._meta.db_table} "
+        f"WHERE session_id = %s"
+    ), [session.id]
+
+
+def erroring(column):
+    return f"({column} IS NOT NULL AND ({column} = 0 OR {column} >= 400))"
+
+
+def diff_sql(diff, before, after):
+    before_sql, before_params = results_sql(before)
+    after_sql, after_params = results_sql(after)
+    sql = (
+        f"WITH a AS ({before_sql}), b AS ({after_sql}) "
+        f"INSERT INTO {models.RacingDiffEntry._meta.db_table} "
+        f"(diff_id, url, kind, before_status, after_status) "
+        f"SELECT %s, url, kind, before_status, after_status FROM ("
+        f"SELECT url, before_status, after_status, CASE "
+        f"WHEN {erroring('after_status')} "
+        f"AND NOT {erroring('before_status')} THEN 'new' "
+        f"WHEN {erroring('before_status')} "
+        f"AND NOT {erroring('after_status')} THEN 'fixed' "
+        f"WHEN before_status <> after_status THEN 'changed' "
+        f"END AS kind FROM ("
+        # URLs of the first session, with or without a result after
+        f"SELECT a.url AS url, a.status_code AS before_status, "
+        f"b.status_code AS after_status "
+        f"FROM a LEFT JOIN b ON b.url = a.url "
+        f"UNION ALL "
+        # URLs only found by the second session
+        f"SELECT b.url, NULL, b.status_code FROM b "
+        f"WHERE NOT EXISTS (SELECT 1 FROM a WHERE a.url = b.url)"
+        f") pairs) kinds WHERE kind IS NOT NULL"
+    )
+    return sql, before_params + after_params + [diff.id]
+
+
+def diff_sessions(before, after, refresh=False):
+    """
+    RacingDiff of two racing sessions, computed unless a diff of both is
+    still up to date.
+    """
+    for session in (before, after):
+        if session.ending_time is None:
+            raise RaceRunning(f"Race {session.id} has not ended yet")
+    diff = models.RacingDiff.objects.filter(
+        before=before, after=after).first()
+    if diff is not None and not refresh \
+            and diff.before_ending == before.ending_time \
+            and diff.after_ending == after.ending_time:
+        return diff
+
+    with transaction.atomic():
+        models.RacingDiff.objects.filter(before=before, after=after).delete()
+        diff = models.RacingDiff.objects.create(
+            before=before,
+            after=after,
+            before_ending=before.ending_time,
+            after_ending=after.ending_time,
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(*diff_sql(diff, before, after))
+        counts = dict(models.RacingDiffEntry.objects.filter(diff=diff)
+                      .order_by().values_list('kind')
+                      .annotate(Count('id')))
+        for kind, _ in models.DIFF_KINDS:
+            setattr(diff, kind, counts.get(kind, 0))
+        diff.save()
+    return diff
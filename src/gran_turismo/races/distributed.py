@@ -0,0 +1,208 @@
+"""
+distributed.py - Spread a race across several nodes sharing a frontier.
+
+A Coordinator seeds a frontier.* backend and rolls up what workers report
+into one racing session. Every worker runs a FrontierDriver, leasing
+batches of URLs from the frontier and reporting results back.
+"""
+from asyncio import Queue, get_event_loop, sleep
+
+from .drivers import AsyncDriver, format_chain
+from .frontier import COUNTERS
+from .shards import SeenStats
+
+
+class FrontierDriver(AsyncDriver):
+    """
+    A crawling driver taking its URLs from a shared frontier. Discovered
+    links and results are reported to the frontier instead of being
+    queued and streamed locally.
+
+    Init Attributes:
+        frontier        Backend of the shared frontier, see frontier.py.
+        worker          Name of this worker, unique across the race.
+        lease_size      Number of URLs leased at once.
+        lease_ttl       Seconds leased URLs are kept by a silent worker
+                        before being handed over to others.
+        flush_interval  Seconds between two reports.
+        Any other AsyncDriver option.
+    """
+    def __init__(self, frontier, worker, lease_size=100, lease_ttl=60,
+                 flush_interval=1.0, **options):
+        # Only the frontier decides what is new. The local seen-set just
+        # avoids reporting the same link twice, so it must be exact.
+        options['dedup'] = 'exact'
+        super().__init__(**options)
+        self.frontier = frontier
+        self.worker = worker
+        self.lease_size = lease_size
+        self.lease_ttl = lease_ttl
+        self.flush_interval = flush_interval
+
+        # Initialize leased URLs, mapped to their lease tokens, and those
+        # being retried, keeping their lease
+        self.leased = {}
+        self.retrying = set()
+
+        # Initialize changes since last report
+        self.done = []
+        self.found = []
+        self.outcomes = []
+        self.reported = dict.fromkeys(COUNTERS, 0)
+
+    def discover(self, url, max_redirects, depth=0):
+        """
+        Report URL to the frontier unless we reported it before.
+        """
+        if url in self.seen_urls:
+            return
+        self.seen_urls.add(url)
+        self.found.append((url, max_redirects))
+
+    def claim(self, url, max_redirects, depth=0):
+        """
+        Report redirect targets to the frontier, which decides who crawls
+        them.
+        """
+        self.discover(url, max_redirects, depth)
+        return False
+
+    def enqueue(self, url, max_redirects, depth=0, attempt=0, delay=0):
+        if attempt:
+            # Retries stay with this worker, which keeps their lease.
+            self.retrying.add(url)
+            super().enqueue(url, max_redirects, depth, attempt, delay)
+        else:
+            self.found.append((url, max_redirects))
+
+    def task_done(self, url):
+        super().task_done(url)
+        if url in self.retrying:
+            self.retrying.discard(url)
+            return
+        token = self.leased.pop(url, None)
+        if token is not None:
+            self.done.append(token)
+
+    async def update_results_and_log(self, url, status_code, store=False,
+                                     error='', latency=0, depth=0,
+                                     redirects=()):
+        """
+        Keep results to be reported and update progress counters.
+        """
+        if self.collect_all or store:
+            self.outcomes.append((url, status_code, error, latency, depth,
+                                  format_chain(redirects)))
+        self.crawled += 1
+        self.remaining -= 1
+
+    async def finish_line(self):
+        """
+        Lease URLs and report back until the race is over.
+        """
+        loop = get_event_loop()
+        while True:
+            await loop.run_in_executor(None, self.report)
+            if self.q.qsize() < self.lease_size:
+                items = await loop.run_in_executor(
+                    None, self.frontier.lease,
+                    self.worker, self.lease_size, self.lease_ttl)
+                for url, max_redirects, token in items:
+                    self.leased[url] = token
+                    self.q.put_nowait((url, max_redirects, 0, 0),
+                                      self.priority(url, 0))
+                    self.remaining += 1
+                if not items and not self.leased and not self.found:
+                    if await loop.run_in_executor(None, self.frontier.over):
+                        break
+            await sleep(self.flush_interval)
+        await self.q.join()
+        await loop.run_in_executor(None, self.report)
+
+    def report(self):
+        """
+        Hand changes since last report over to the frontier, renewing
+        our leases.
+        """
+        done, self.done = self.done, []
+        found, self.found = self.found, []
+        outcomes, self.outcomes = self.outcomes, []
+        counters = {}
+        for name in COUNTERS:
+            value = getattr(self, name)
+            counters[name] = value - self.reported[name]
+            self.reported[name] = value
+        self.frontier.report(
+            self.worker, self.lease_ttl, done, outcomes, found, counters)
+
+
+class Coordinator:
+    """
+    Runs a race whose URLs are crawled by workers sharing a frontier.
+    Exposes results and counters like AsyncDriver does, summing those of
+    every worker.
+
+    Init Attributes:
+        frontier        Backend of the shared frontier, see frontier.py.
+        root_url        Starting point of the race.
+        options         Race options workers drive with, e.g. max_redirects,
+                        limit, collect_all or canonicalization rules.
+        canonicalize    Callable giving the canonical form of URLs.
+        results_size    Maximum number of results waiting to be collected.
+        poll_interval   Seconds between two looks at the frontier.
+    """
+    def __init__(self, frontier, root_url, options, canonicalize,
+                 results_size=1000, poll_interval=0.5):
+        self.frontier = frontier
+        self.root_url = root_url
+        self.options = dict(options, root_url=root_url)
+        self.canonicalize = canonicalize
+        self.poll_interval = poll_interval
+
+        # Initialize counters, summed across workers
+        for name in COUNTERS:
+            setattr(self, name, 0)
+
+        # Initialize results stream. A None item marks the end of the race.
+        self.results = Queue(maxsize=results_size)
+
+        # Frontier seen-set is exact.
+        self.seen_urls = SeenStats()
+
+    async def drive(self):
+        """
+        Seed the frontier, then gather what workers report until no work
+        is left.
+        """
+        loop = get_event_loop()
+        await loop.run_in_executor(
+            None, self.frontier.configure, self.options)
+        await loop.run_in_executor(None, self.frontier.seed, [
+            (self.canonicalize(self.root_url), self.options['max_redirects']),
+        ])
+
+        finishing = False
+        while True:
+            results = await loop.run_in_executor(None, self.frontier.absorb)
+            for result in results:
+                await self.results.put(result)
+            counters = await loop.run_in_executor(
+                None, self.frontier.counters)
+            for name, value in counters.items():
+                setattr(self, name, value)
+            if not finishing and self.crawled >= self.options['limit']:
+                # Drop what is left in the queue, wait for leased URLs.
+                await loop.run_in_executor(
+                    None, self.frontier.finish, True)
+                finishing = True
+            await loop.run_in_executor(None, self.frontier.reclaim)
+            if not await loop.run_in_executor(
+                    None, self.frontier.outstanding):
+                break
+            await sleep(self.poll_interval)
+
+        await loop.run_in_executor(None, self.frontier.finish)
+        self.frontier.close()
+
+        # Let the collector know that no more results are coming.
+        await self.results.put(None)
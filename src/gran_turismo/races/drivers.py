@@ -4,15 +4,26 @@ drivers.py - where the crawling logic lives.
 Heavily inspired by following article:
 http://www.aosabook.org/en/500L/a-web-crawler-with-asyncio-coroutines.html
 """
-from asyncio import Queue, Task
-from urllib.parse import urlparse, urljoin
+from asyncio import Queue, Semaphore, Task, get_event_loop, sleep
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urljoin
 import logging
 import re
+import time
 
-from lxml import html as lh
-from bloom_filter import BloomFilter
+from lxml import etree, html as lh
 import aiohttp
 
+from .canonical import Canonicalizer
+from .concurrency import AdaptiveConcurrency, retry_after
+from .dedup import BACKENDS as DEDUP_BACKENDS
+from .metrics import FAST_BUCKETS, Registry, start_server
+from .retries import RETRY_STATUSES, backoff, classify_error
+from .scheduler import HostScheduler, UrlPriority
+from .sitemaps import MAX_SITEMAPS, RobotsRules, SitemapParser
+from .transport import CachingResolver, check_transport, client_session
+
 
 logger = logging.getLogger("races.driver.asyncdriver")
 
@@ -27,86 +38,458 @@ USER_AGENT = (f'Mozilla/5.0 (compatible; GranTurismoRacingDriver/'
               '{DRIVER_VERSION}; by efkin with <3')
 
 
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+
+
+CHUNK_SIZE = 2 ** 16
+
+
+class LinkTarget:
+    """
+    lxml parser target collecting hrefs of anchors and the document base
+    while HTML is fed, without building a DOM.
+    """
+    def __init__(self):
+        self.base = None
+        self.hrefs = []
+
+    def start(self, tag, attrib):
+        if tag == 'a':
+            href = attrib.get('href')
+            # Skip links that contain hashtags
+            if href is not None and '#' not in href:
+                self.hrefs.append(href)
+        elif tag == 'base' and self.base is None:
+            self.base = attrib.get('href')
+
+    def end(self, tag):
+        pass
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        return self
+
+
+def dom_hrefs(html, encoding=None):
+    """
+    Document base and anchor hrefs of raw HTML, building its DOM.
+    """
+    parser = lh.HTMLParser(encoding=encoding) if encoding else None
+    dom = lh.fromstring(html, parser=parser)
+    base = dom.xpath("//base/@href")
+    # Gather all links that does not contain hashtags
+    xpath_query = "//a[not(contains(@href, '#'))]/@href"
+    return (base[0] if base else None), dom.xpath(xpath_query)
+
+
+def sax_hrefs(html, encoding=None):
+    """
+    Document base and anchor hrefs of raw HTML, through a parser target.
+    """
+    parser = etree.HTMLParser(target=LinkTarget(), encoding=encoding)
+    parser.feed(html)
+    target = parser.close()
+    return target.base, target.hrefs
+
+
+LINK_ENGINES = {
+    'dom': dom_hrefs,
+    'sax': sax_hrefs,
+}
+
+
+def extract_links(html, page_url, root_url, encoding=None, engine='sax'):
+    """
+    Collect all non-internal links under root_url in raw HTML. Lives at
+    module level so it can run in a process pool.
+    """
+    base, hrefs = LINK_ENGINES[engine](html, encoding)
+    return filter_links(hrefs, page_url, root_url, base)
+
+
+def format_chain(hops):
+    """
+    Text of redirect hops, (status_code, url, latency) tuples, one
+    'status_code url' line each.
+    """
+    return '\n'.join(f'{status_code} {url}' for status_code, url, _ in hops)
+
+
+def filter_links(hrefs, page_url, root_url, base=None):
+    """
+    Resolve hrefs against the document base, keeping those under
+    root_url that are not static files.
+    """
+    if base:
+        page_url = urljoin(page_url, base.strip())
+    found_links = set()
+    # Resolve every distinct href once.
+    for href in set(hrefs):
+        link = urljoin(page_url, href.strip())
+        if link.startswith(root_url) and not STATIC_REGEX.search(link):
+            found_links.add(link)
+    return found_links
+
+
 class AsyncDriver:
     """
     A crawling driver built on top asyncio library. Uses bloom filters for
-    URL deduplication. 
+    URL deduplication by default.
 
     Init Attributes:
         root_url        Starting point for the driver. Expects URL string.
-        expected_urls   Maximum capacity of the bloom filter.  
-        error_rate      Expected error rate in false positives of the 
-                        bloom filter.
+        expected_urls   Expected number of URLs in the seen-set. Maximum
+                        capacity of a plain bloom filter.
+        error_rate      Expected error rate in false positives of the
+                        bloom filters.
         max_redirects   Maximum number of redirects that the driver is
-                        following.
-        max_engines     Concurrency level.
+                        following, inline within the engine fetching the
+                        redirecting URL.
+        redirect_cache_size
+                        Maximum number of resolved redirect chains kept in
+                        memory, least recently used ones being evicted.
+                        Redirects to a URL whose chain is kept are not
+                        followed again.
+        max_engines     Concurrency level. Upper bound of it when
+                        min_engines is given.
+        min_engines     Lower bound of concurrency. When given, the number
+                        of requests in flight adapts to the latency and
+                        congestion errors of the target.
         limit           Limit number of crawled URLs.
+        collect_all     Whether to stream every result or only 4xx and 5xx.
+        results_size    Maximum number of results waiting to be collected.
+                        Engines wait for room when the queue is full.
+        checkpoint      Optional checkpoint.Checkpoint keeping race state
+                        on disk. Race is resumed from it if not empty.
+        checkpoint_interval
+                        Seconds between two checkpoint snapshots.
+        per_host_engines
+                        Maximum number of engines fetching from the same
+                        host at once. Defaults to max_engines.
+        host_delay      Minimum seconds between two requests to the same
+                        host.
+        priority        Callable scoring a URL and its depth, lower scores
+                        are fetched first. Defaults to a
+                        scheduler.UrlPriority going breadth first.
+        max_retries     Number of times transient failures (timeouts,
+                        connection errors, 429, 502, 503 and 504) are
+                        retried before being recorded.
+        retry_backoff   Seconds of backoff before the first retry, doubled
+                        on every retry.
+        connector_options
+                        Keyword arguments for aiohttp.TCPConnector, e.g.
+                        limit, limit_per_host, ttl_dns_cache and
+                        keepalive_timeout.
+        transport       HTTP client, one of transport.TRANSPORTS: aiohttp,
+                        or httpx multiplexing requests over HTTP/2.
+        dns_ttl         Seconds addresses of hosts are cached by a
+                        transport.CachingResolver, warmed up with the root
+                        host. aiohttp transport only. Lookups are not
+                        cached when 0, and the connector cache is used when
+                        None.
+        trace_configs   Optional list of aiohttp.TraceConfig following
+                        requests of the HTTP session.
+        parse_workers   Number of processes parsing HTML. Parsing blocks
+                        the event loop when 0.
+        parse_budget    Maximum number of documents being parsed at once.
+                        Defaults to twice parse_workers.
+        max_page_size   Maximum number of bytes read from a page, the rest
+                        of it is ignored.
+        link_engine     How links are extracted, one of LINK_ENGINES:
+                        building a DOM, or collecting hrefs from parser
+                        events as the page arrives.
+        dedup           Seen-set backend, one of dedup.BACKENDS.
+        dedup_path      Directory for seen-sets stored on disk.
+        canonicalize    Callable giving the canonical form of URLs before
+                        looking them up in the seen-set. Defaults to a
+                        canonical.Canonicalizer with default rules.
+        http_cache      Optional httpcache.HttpCache. Cached pages are
+                        asked conditionally and their links are reused
+                        when they did not change.
+        metrics_port    Port serving race metrics in Prometheus format at
+                        /metrics. Disabled when None.
+        progress_interval
+                        Seconds between two race progress lines.
+        robots          Whether to obey robots.txt rules of the root URL.
+        sitemaps        Sitemaps or sitemap indexes seeding the frontier.
+                        An empty list seeds from sitemaps listed in
+                        robots.txt, or /sitemap.xml. No seeding when None.
+        modified_since  Datetime before which pages of sitemaps are known
+                        not to have changed. Pages whose lastmod is older
+                        are skipped.
+        graph           Optional graph.LinkGraph recording parsed pages and
+                        their links. Only links it returns are followed, see
+                        LinkGraph.record().
     """
     def __init__(
             self, root_url, expected_urls,
             error_rate, max_redirects, max_engines,
-            limit, collect_all,
+            limit, collect_all, results_size=1000, min_engines=None,
+            checkpoint=None, checkpoint_interval=60,
+            per_host_engines=None, host_delay=0, priority=None,
+            max_retries=3, retry_backoff=1.0, connector_options=None,
+            trace_configs=None, parse_workers=0, parse_budget=None,
+            max_page_size=5 * 2 ** 20,
+            link_engine='sax',
+            dedup='scalable', dedup_path=None, canonicalize=None,
+            http_cache=None, metrics_port=None, progress_interval=10,
+            robots=False, sitemaps=None, modified_since=None, graph=None,
+            transport='aiohttp', dns_ttl=None, redirect_cache_size=10000,
     ):
+        check_transport(transport)
         self.root_url = root_url
         self.max_engines = max_engines
         self.max_redirects = max_redirects
+        self.redirect_cache_size = redirect_cache_size
         self.limit = limit
-        self.q = Queue()
-        self.seen_urls = BloomFilter(
-            max_elements=expected_urls, error_rate=error_rate)
+        self.concurrency = AdaptiveConcurrency(
+            min(min_engines, max_engines), max_engines) \
+            if min_engines else None
+        self.q = HostScheduler(
+            per_host=per_host_engines or max_engines, delay=host_delay)
+        self.priority = priority or UrlPriority()
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.seen_urls = DEDUP_BACKENDS[dedup](
+            expected_urls, error_rate, path=dedup_path)
         self.collect_all = collect_all
-
-        # Set authorship in requests
-        headers = {"User-Agent": USER_AGENT}
-
-        self.session = aiohttp.ClientSession(headers=headers)
+        self.canonicalize = canonicalize or Canonicalizer()
+        self.http_cache = http_cache
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.connector_options = connector_options or {}
+        self.trace_configs = trace_configs
+        self.parse_workers = parse_workers
+        self.parse_budget = parse_budget or parse_workers * 2
+        self.max_page_size = max_page_size
+        self.link_engine = link_engine
+        self.metrics_port = metrics_port
+        self.progress_interval = progress_interval
+        self.robots = robots
+        self.sitemaps = sitemaps
+        self.modified_since = modified_since
+        self.graph = graph
+        self.transport = transport
+        self.dns_ttl = dns_ttl
+
+        # Rules and sitemaps of robots.txt are read in drive().
+        self.robots_rules = None
+        self.robots_sitemaps = []
+
+        # Parse pool and budget are created in drive().
+        self.parse_pool = None
+        self.parse_slots = None
+
+        # HTTP session and resolver are bound to the running event loop,
+        # see drive().
+        self.session = None
+        self.resolver = None
+
+        # Tasks of engines, monitoring and reporting, started in drive().
+        self.engines = []
 
         # Initialize error counters
         self.fives = 0
         self.fours = 0
         self.threes = 0
         self.twos = 0
+        self.failures = 0
+
+        # Initialize retry counters
+        self.retries = 0
 
         # Initialize progress counters
         self.remaining = 0
         self.crawled = 0
 
-        # Initialize results
-        self.results = []
+        # Initialize HTTP cache counters
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Initialize redirect chains, by canonical URL, and their counters
+        self.redirect_cache = OrderedDict()
+        self.redirect_hits = 0
+        self.redirect_misses = 0
+
+        # Initialize requests being fetched
+        self.in_flight = 0
 
-    def update_results_and_log(self, url, status_code, store=False):
+        # Initialize seeding counters
+        self.seeded = 0
+        self.skipped = 0
+
+        # Initialize metrics, read from counters above when rendered.
+        self.metrics = Registry()
+        self.register_metrics()
+
+        # Initialize results stream. A None item marks the end of the race.
+        self.results = Queue(maxsize=results_size)
+
+        # Restore race state when resuming.
+        self.pending = checkpoint.restore(self) if checkpoint else []
+
+    def register_metrics(self):
         """
-        Update results if necessary, then log to logger.
+        Declare race metrics. Counters are read from the driver when
+        rendered, histograms are observed along the race.
         """
-        # Update results.
+        metrics = self.metrics
+        metrics.callback(
+            'gt_urls_crawled_total', 'URLs crawled.',
+            lambda: self.crawled, kind='counter')
+        metrics.callback(
+            'gt_responses_total', 'Responses by status class.',
+            lambda: {('2xx',): self.twos, ('3xx',): self.threes,
+                     ('4xx',): self.fours, ('5xx',): self.fives},
+            kind='counter', labels=('status_class',))
+        metrics.callback(
+            'gt_failures_total', 'URLs failed without a response.',
+            lambda: self.failures, kind='counter')
+        metrics.callback(
+            'gt_retries_total', 'Fetches retried.',
+            lambda: self.retries, kind='counter')
+        metrics.callback(
+            'gt_http_cache_total', 'HTTP cache lookups by outcome.',
+            lambda: {('hit',): self.cache_hits,
+                     ('miss',): self.cache_misses},
+            kind='counter', labels=('outcome',))
+        metrics.callback(
+            'gt_redirect_cache_total', 'Redirect cache lookups by outcome.',
+            lambda: {('hit',): self.redirect_hits,
+                     ('miss',): self.redirect_misses},
+            kind='counter', labels=('outcome',))
+        metrics.callback(
+            'gt_queue_depth', 'URLs waiting in the frontier.',
+            self.q.qsize)
+        metrics.callback(
+            'gt_urls_remaining', 'URLs queued or being fetched.',
+            lambda: self.remaining)
+        metrics.callback(
+            'gt_in_flight_requests', 'Requests being fetched.',
+            lambda: self.in_flight)
+        metrics.callback(
+            'gt_concurrency_limit', 'Max number of requests in flight.',
+            lambda: self.concurrency.permits if self.concurrency
+            else self.max_engines)
+        metrics.callback(
+            'gt_results_pending', 'Results waiting to be collected.',
+            lambda: self.results.qsize())
+        metrics.callback(
+            'gt_seen_urls_fill_ratio', 'Fill ratio of the seen-set.',
+            lambda: self.seen_urls.fill_ratio)
+        metrics.callback(
+            'gt_seen_urls_error_rate',
+            'Estimated false positive rate of the seen-set.',
+            lambda: self.seen_urls.error_rate)
+        self.fetch_latency = metrics.histogram(
+            'gt_fetch_latency_seconds',
+            'Seconds until response headers, by status class.',
+            labels=('status_class',))
+        self.parse_time = metrics.histogram(
+            'gt_parse_seconds', 'Seconds spent extracting links of a page.',
+            buckets=FAST_BUCKETS)
+        self.loop_lag = metrics.histogram(
+            'gt_event_loop_lag_seconds',
+            'Seconds the event loop wakes up late.',
+            buckets=FAST_BUCKETS)
+
+    async def update_results_and_log(self, url, status_code, store=False,
+                                     error='', latency=0, depth=0,
+                                     redirects=()):
+        """
+        Stream results if necessary and update progress counters. Progress
+        is logged periodically, see reporting(). Redirects are the hops
+        followed from url, see visit().
+        """
+        # Stream results. Waits here whenever collector is lagging behind.
         if self.collect_all or store:
-            self.results.append((url, status_code))
+            if self.checkpoint:
+                self.checkpoint.collect(url)
+            await self.results.put((url, status_code, error, latency, depth,
+                                    format_chain(redirects)))
         # Update counters.
         self.crawled += 1
         self.remaining -= 1
-        # Log everything.
-        partial_total = self.crawled + self.remaining
-        logger.warning(f"Race progress:\t{self.crawled} URLs Crawled"
-                       f"\t{self.remaining} URLs Remaining"
-                       f"\t{partial_total} Total URLs")
+        if self.graph:
+            self.graph.visit(url)
 
     async def drive(self):
         """
         Start the engines until all work is done.
         """
-        # Populate the queue.
-        await self.q.put((self.root_url, self.max_redirects))
-        self.remaining +=1
+        # Set authorship in requests
+        headers = {"User-Agent": USER_AGENT}
+        connector_options = self.connector_options
+        if self.dns_ttl is not None and self.transport == 'aiohttp':
+            if self.dns_ttl:
+                self.resolver = CachingResolver(self.dns_ttl)
+                await self.resolver.warm(
+                    self.root_url, connector_options.get('family', 0))
+            else:
+                connector_options = dict(
+                    connector_options, use_dns_cache=False)
+        self.session = client_session(
+            self.transport, headers, self.trace_configs, connector_options,
+            self.resolver)
+        if self.parse_workers:
+            self.parse_pool = ProcessPoolExecutor(self.parse_workers)
+            self.parse_slots = Semaphore(self.parse_budget)
+
+        # Populate the queue, picking up where we left if resuming.
+        for url, max_redirects in self.pending:
+            self.q.put_nowait(
+                (url, max_redirects, 0, 0), self.priority(url, 0))
+            self.remaining += 1
+        if self.robots or self.sitemaps is not None:
+            await self.read_robots()
+        self.discover(self.canonicalize(self.root_url), self.max_redirects)
+
+        # Start reporting.
+        runner = None
+        if self.metrics_port is not None:
+            runner = await start_server(self.metrics, self.metrics_port)
+        self.engines = [Task(self.monitoring()), Task(self.reporting())]
 
         # Start driving.
-        engines = [Task(self.start_track())
-                  for _ in range(self.max_engines)]
+        self.engines += [Task(self.start_track())
+                         for _ in range(self.max_engines)]
+        if self.checkpoint:
+            self.engines.append(Task(self.checkpointing()))
+
+        # Seed sitemaps while engines crawl what is found so far.
+        if self.sitemaps is not None:
+            await self.seed()
 
         # When all work is done, exit.
-        await self.q.join()
-        for engine in engines:
+        await self.finish_line()
+        for engine in self.engines:
             engine.cancel()
         await self.session.close()
+        if self.resolver:
+            await self.resolver.close()
+        if runner:
+            await runner.cleanup()
+        if self.parse_pool:
+            self.parse_pool.shutdown()
+        if self.http_cache:
+            self.http_cache.close()
+        if self.graph:
+            self.graph.close()
+        if self.checkpoint:
+            self.checkpoint.snapshot(self)()
+
+        # Let the collector know that no more results are coming.
+        await self.results.put(None)
+
+    def stop(self):
+        """
+        End the race early. Engines finish fetching what they started and
+        what is left in the frontier is dropped.
+        """
+        self.limit = 0
+        self.remaining -= self.q.clear()
 
     async def start_track(self):
         """
@@ -114,92 +497,479 @@ class AsyncDriver:
         """
         while True:
             # Gather next link from the queue.
-            url, max_redirects = await self.q.get()
+            url, max_redirects, depth, attempt = await self.q.get()
 
             # Gracefully complete tasks when limit is reached
             if self.crawled >= self.limit:
-                self.q.task_done()
+                self.task_done(url)
                 continue
 
-            # Download page and add new links to the queue.
-            await self.fetch(url, max_redirects)
-            self.q.task_done()
+            # Wait for a permit when concurrency is adaptive. Engines idle
+            # on an empty frontier hold none, so they do not look busy.
+            if self.concurrency:
+                await self.concurrency.acquire()
+            try:
+                # Download page and add new links to the queue.
+                done = await self.fetch(url, max_redirects, depth, attempt)
+                if self.checkpoint and done:
+                    self.checkpoint.crawl(url)
+                self.task_done(url)
+            finally:
+                if self.concurrency:
+                    self.concurrency.release()
+
+    async def finish_line(self):
+        """
+        Wait until all work is done.
+        """
+        await self.q.join()
+
+    def task_done(self, url):
+        """
+        Mark a URL taken from the frontier as done.
+        """
+        self.q.task_done(url)
+
+    async def checkpointing(self):
+        """
+        Periodically save race state to disk.
+        """
+        loop = get_event_loop()
+        while True:
+            await sleep(self.checkpoint_interval)
+            await loop.run_in_executor(None, self.checkpoint.snapshot(self))
+
+    async def monitoring(self, interval=0.1):
+        """
+        Measure how late the event loop wakes up from a sleep.
+        """
+        loop = get_event_loop()
+        while True:
+            started = loop.time()
+            await sleep(interval)
+            self.loop_lag.observe(max(0, loop.time() - started - interval))
+
+    async def reporting(self):
+        """
+        Periodically log race progress.
+        """
+        last_crawled = self.crawled
+        while True:
+            await sleep(self.progress_interval)
+            rate = (self.crawled - last_crawled) / self.progress_interval
+            last_crawled = self.crawled
+            logger.warning(f"Race progress:\t{self.crawled} URLs Crawled"
+                           f"\t{self.remaining} URLs Remaining"
+                           f"\t{self.crawled + self.remaining} Total URLs"
+                           f"\t{rate:.2f} URLs/s")
+
+    async def read_robots(self):
+        """
+        Fetch robots.txt of the root URL, for its rules and sitemaps. A
+        missing or unreachable file has no rules.
+        """
+        url = urljoin(self.root_url, '/robots.txt')
+        text = ''
+        try:
+            async with self.session.get(url, timeout=20) as response:
+                if response.status < 400:
+                    text = (await self.parse_response(response)).decode(
+                        response.charset or 'utf-8', errors='replace')
+                elif response.status >= 500:
+                    logger.warning(f"Failed {url}: {response.status}")
+        except Exception as e:
+            logger.warning(f"Failed {url}: {e!r}")
+        rules = RobotsRules(text)
+        if self.robots:
+            self.robots_rules = rules
+        self.robots_sitemaps = rules.sitemaps
+
+    async def seed(self):
+        """
+        Bulk load pages of sitemaps into the frontier through the seen-set,
+        following sitemap indexes, until the limit is covered.
+        """
+        sitemaps = deque(self.sitemaps or self.robots_sitemaps
+                         or [urljoin(self.root_url, '/sitemap.xml')])
+        found = set(sitemaps)
+        read = 0
+        while sitemaps and read < MAX_SITEMAPS:
+            url = sitemaps.popleft()
+            read += 1
+            try:
+                async with self.session.get(
+                        url,
+                        timeout=aiohttp.ClientTimeout(sock_read=20)) \
+                        as response:
+                    if response.status >= 400:
+                        logger.warning(f"Failed {url}: {response.status}")
+                        continue
+                    parser = SitemapParser()
+                    async for chunk in response.content.iter_chunked(
+                            CHUNK_SIZE):
+                        for entry in parser.feed(chunk):
+                            self.plant(*entry, sitemaps, found)
+                        if self.crawled + self.remaining >= self.limit:
+                            break
+                    else:
+                        for entry in parser.close():
+                            self.plant(*entry, sitemaps, found)
+            except Exception as e:
+                logger.warning(f"Failed {url}: {e!r}")
+            if self.crawled + self.remaining >= self.limit:
+                break
+        logger.warning(f"Seeded {self.seeded} URLs from {read} sitemaps, "
+                       f"skipped {self.skipped} unchanged pages")
+
+    def plant(self, kind, loc, lastmod, sitemaps, found):
+        """
+        Queue a page found in a sitemap, or a nested sitemap to be read.
+        """
+        if kind == 'sitemap':
+            if loc not in found:
+                found.add(loc)
+                sitemaps.append(loc)
+            return
+        if self.crawled + self.remaining >= self.limit:
+            return
+        if not loc.startswith(self.root_url) or STATIC_REGEX.search(loc):
+            return
+        url = self.canonicalize(loc)
+        if url in self.seen_urls or not self.allowed(url):
+            return
+        if self.modified_since and lastmod and lastmod < self.modified_since:
+            # Links to it are not followed either.
+            self.seen_urls.add(url)
+            self.skipped += 1
+            return
+        self.seeded += 1
+        self.discover(url, self.max_redirects, 1)
+
+    def allowed(self, url):
+        """
+        Whether robots.txt rules, if obeyed, let us fetch url.
+        """
+        return self.robots_rules is None or self.robots_rules.allowed(url)
+
+    def discover(self, url, max_redirects, depth=0):
+        """
+        Add URL to the frontier unless we have been there before.
+        """
+        if url in self.seen_urls:
+            return
+        self.seen_urls.add(url)
+        self.enqueue(url, max_redirects, depth)
+
+    def enqueue(self, url, max_redirects, depth=0, attempt=0, delay=0):
+        """
+        Add a URL to the frontier, after delay seconds if given.
+        """
+        self.q.put_nowait((url, max_redirects, depth, attempt),
+                          self.priority(url, depth), delay)
+        self.remaining += 1
+        # Retried URLs are already in the checkpoint, and not crawled.
+        if self.checkpoint and not attempt:
+            self.checkpoint.queue(url, max_redirects)
+
+    def retry(self, url, max_redirects, depth, attempt, delay=None):
+        """
+        Put a URL back into the frontier after a backoff delay, or the one
+        asked by the site if longer.
+        """
+        self.retries += 1
+        delay = max(delay or 0, backoff(attempt, self.retry_backoff))
+        # Current visit is over, the URL is queued again.
+        self.remaining -= 1
+        self.enqueue(url, max_redirects, depth, attempt + 1, delay)
+
+    def claim(self, url, max_redirects, depth=0):
+        """
+        Mark a redirect target as seen. Returns whether it is up to us to
+        crawl it, it is only probed otherwise, see visit().
+        """
+        if url in self.seen_urls:
+            return False
+        self.seen_urls.add(url)
+        # Crawled right away, but logged as queued until then, see follow().
+        if self.checkpoint:
+            self.checkpoint.queue(url, max_redirects)
+        return True
+
+    def remember(self, url, chain):
+        """
+        Keep the redirect chain of url, evicting least recently used ones.
+        Chains ending in a failure may not last, and are not kept.
+        """
+        if not self.redirect_cache_size or not chain[-1][0]:
+            return
+        self.redirect_cache[url] = chain
+        self.redirect_cache.move_to_end(url)
+        if len(self.redirect_cache) > self.redirect_cache_size:
+            self.redirect_cache.popitem(last=False)
+
+    async def fetch(self, url, max_redirects, depth=0, attempt=0):
+        """
+        Fetch a link and add new links to the queue, following redirects
+        on the way. Transient failures are retried later on, returns False
+        when so.
+        """
+        return await self.visit(url, max_redirects, depth, attempt) \
+            is not None
 
-    async def fetch(self, url, max_redirects):
+    async def visit(self, url, max_redirects, depth=0, attempt=0,
+                    probe=False, path=()):
         """
-        Fetch a link and add new links to the queue. Eventually 
-        follows redirects as needed.
+        Fetch a URL, then follow its redirects inline. Returns its redirect
+        chain, (status_code, url, latency) hops starting with url itself,
+        or None when it is retried later on. Probes resolve chains through
+        URLs crawled elsewhere: they do not read pages, retry, count or
+        record anything. Path holds URLs redirecting to this one.
         """
+        self.in_flight += 1
+        started = time.perf_counter()
+        answered = False
         try:
+            cached = self.http_cache.get(url) \
+                if self.http_cache and not probe else None
             async with self.session.get(
                     url,
+                    headers=self.http_cache.validators(cached)
+                    if cached else None,
                     allow_redirects=False, # Handle redirects ourselves.
                     timeout=20) as response:
+                answered = True
+                latency = time.perf_counter() - started
+                self.fetch_latency.observe(
+                    latency, (f'{response.status // 100}xx',))
+                congested = response.status == 429 or response.status >= 500
+                if self.concurrency:
+                    self.concurrency.observe(latency, congested)
+                delay = None
+                if congested:
+                    delay = retry_after(response.headers.get('Retry-After'))
+                    if delay:
+                        self.q.defer(url, delay)
+                if response.status in RETRY_STATUSES and not probe \
+                        and attempt < self.max_retries:
+                    self.retry(url, max_redirects, depth, attempt, delay)
+                    return None
+
+                # check whether page changed since last race or not
+                if cached and response.status == 304:
+                    self.cache_hits += 1
+                    self.twos += 1
+                    self.http_cache.touch(url)
+                    # Reuse links found last time, as filtered today.
+                    links = self.keep_links(filter_links(
+                        cached.links, url, self.root_url))
+                    if self.graph:
+                        links = self.graph.record(url, None, links)
+                    for link in links:
+                        self.discover(link, self.max_redirects, depth + 1)
+                    await self.update_results_and_log(
+                        url, cached.status, latency=latency, depth=depth)
+                    return ((cached.status, url, latency),)
+                if self.http_cache and not probe:
+                    self.cache_misses += 1
 
                 # check whether is redirecting or not
-                if response.status == 301 or response.status == 302:
-                    self.threes += 1
-
-                    if max_redirects > 0:
-                        next_url = response.headers['location']
-                        if next_url in self.seen_urls:
-                            # We have been down this path before.
-                            self.update_results_and_log(url, response.status)
-                            return
-
-                        # Remember we have seen this URL.
-                        self.seen_urls.add(next_url)
-
-                        # Follow the redirect. One less redirect remains.
-                        self.remaining += 1
-                        self.q.put_nowait((next_url, max_redirects - 1))
-                        self.update_results_and_log(url, response.status)
-                elif response.status >= 400:
-                    if response.status < 500:
+                status = response.status
+                if 300 <= status < 400:
+                    # Followed below, once the response is released.
+                    location = response.headers.get('Location')
+                    if status == 304 or max_redirects <= 0:
+                        location = None
+                    if not probe:
+                        self.threes += 1
+                elif probe:
+                    return ((status, url, latency),)
+                elif status >= 400:
+                    if status < 500:
                         self.fours += 1
-                        self.update_results_and_log(url, response.status, True)
-                        return
-                    if 500 <= response.status < 600:
+                    else:
                         self.fives += 1
-                        self.update_results_and_log(url, response.status, True)
-                        return
+                    await self.update_results_and_log(
+                        url, status, True, latency=latency, depth=depth)
+                    return ((status, url, latency),)
                 else:
-                    self.twos += 1
+                    if not self.is_html(response):
+                        # Nothing to follow, do not even download it.
+                        self.twos += 1
+                        await self.update_results_and_log(
+                            url, status, latency=latency, depth=depth)
+                        return ((status, url, latency),)
                     # Parse links from response
-                    html = await self.parse_response(response)
-                    links = self.parse_links(html)
+                    digest = self.graph.digest() if self.graph else None
+                    links = await self.parse_links(url, response, digest)
+                    # Count page once read, in case reading it fails.
+                    self.twos += 1
+                    if self.http_cache:
+                        self.http_cache.put(
+                            url, response.headers, status, links)
+                    if self.graph:
+                        links = self.graph.record(url, digest, links)
                     # Bloom-filter logic:
                     for link in links:
-                        if link not in self.seen_urls:
-                            self.q.put_nowait((link, self.max_redirects))
-                            self.seen_urls.add(link)
-                            self.remaining += 1
-                    self.update_results_and_log(url, response.status)
+                        self.discover(link, self.max_redirects, depth + 1)
+                    await self.update_results_and_log(
+                        url, status, latency=latency, depth=depth)
+                    return ((status, url, latency),)
 
         except Exception as e:
-            logger.warning("Exception: {}".format(e))
+            if not answered:
+                latency = time.perf_counter() - started
+                self.fetch_latency.observe(latency, ('error',))
+                if self.concurrency:
+                    self.concurrency.observe(latency, True)
+            if probe:
+                return ((0, url, latency),)
+            category, transient = classify_error(e)
+            if transient and attempt < self.max_retries:
+                self.retry(url, max_redirects, depth, attempt)
+                return None
+            logger.warning(f"Failed {url}: {category}: {e!r}")
+            self.failures += 1
+            await self.update_results_and_log(
+                url, 0, True, category, latency, depth)
+            return ((0, url, latency),)
+        finally:
+            self.in_flight -= 1
+
+        chain = ((status, url, latency),)
+        if location:
+            chain += await self.follow(
+                url, urljoin(url, location), max_redirects - 1, depth, probe,
+                path + (url,))
+            self.remember(url, chain)
+        if not probe:
+            # Redirects ending in an error are reported along with it.
+            final = chain[-1][0]
+            await self.update_results_and_log(
+                url, status, not 200 <= final < 400,
+                latency=sum(hop[2] for hop in chain), depth=depth,
+                redirects=chain[1:])
+        return chain
+
+    async def follow(self, url, location, max_redirects, depth=0,
+                     probe=False, path=()):
+        """
+        Redirect chain of location, where url redirects to, taken from the
+        redirect cache when there. Targets not claimed are probed, others
+        are crawled as if taken from the frontier. Empty when the target is
+        not allowed, loops back along path or is retried later on.
+        """
+        target = self.canonicalize(location)
+        claimed = False
+        if target == url and location not in path:
+            # Redirecting to a variant of itself (e.g. a trailing slash),
+            # fetch it as it is asked.
+            target = location
+        elif target in path:
+            return ()
+        else:
+            chain = self.redirect_cache.get(target)
+            if chain is not None:
+                self.redirect_hits += 1
+                self.redirect_cache.move_to_end(target)
+                return chain
+            self.redirect_misses += 1
+            if not self.allowed(target):
+                return ()
+            claimed = not probe and self.claim(target, max_redirects, depth)
+            probe = not claimed
+        if not probe:
+            # Visited as if queued, see update_results_and_log().
+            self.remaining += 1
+        chain = await self.visit(
+            target, max_redirects, depth, probe=probe, path=path)
+        if chain is None:
+            return ()
+        if claimed and self.checkpoint:
+            self.checkpoint.crawl(target)
+        self.remember(target, chain)
+        return chain
+
+    def is_html(self, resp):
+        """
+        Whether response may hold an HTML page with links.
+        """
+        if resp.content_length == 0:
+            return False
+        if 'Content-Type' not in resp.headers:
+            return True
+        return resp.content_type in HTML_CONTENT_TYPES
 
-    async def parse_response(self, resp):
+    async def iter_response(self, resp, digest=None):
+        """
+        Yield chunks of raw HTML from response, up to max_page_size bytes,
+        feeding them to digest if given.
+        """
+        remaining = self.max_page_size
+        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+            chunk = chunk[:remaining]
+            if digest is not None:
+                digest.update(chunk)
+            yield chunk
+            remaining -= len(chunk)
+            if remaining <= 0:
+                break
+
+    async def parse_response(self, resp, digest=None):
         """
-        Collects HTML text from response.
+        Collects raw HTML from response, up to max_page_size bytes.
         """
-        return await resp.text()
+        return b''.join(
+            [chunk async for chunk in self.iter_response(resp, digest)])
 
-    def parse_links(self, html):
+    async def parse_links(self, url, resp, digest=None):
         """
-        Collect all non-internal links in HTML DOM. Return those ones
-        not present in our bloom filter.
+        Collect all non-internal links of an HTML response, in their
+        canonical form. Parser events are fed as chunks arrive, unless
+        a DOM is built or the page is parsed in the parse pool, waiting
+        for a free slot in the parse budget. Contents are fed to digest
+        if given.
         """
-        found_links = set()
-        dom = lh.fromstring(html)
-        # Gather all links that does not contain hashtags
-        xpath_query = "//a[not(contains(@href, '#'))]/@href"
-        for href in dom.xpath(xpath_query):
-            link = urljoin(self.root_url, href)
-            # Skipping static links.
-            if STATIC_REGEX.search(link):
-                continue
-            # Add new links to results
-            if link not in self.seen_urls and link.startswith(self.root_url):
-                found_links.add(link)
-        return found_links
+        if self.parse_pool is not None:
+            html = await self.parse_response(resp, digest)
+            async with self.parse_slots:
+                started = time.perf_counter()
+                links = await get_event_loop().run_in_executor(
+                    self.parse_pool, extract_links, html, url,
+                    self.root_url, resp.charset, self.link_engine)
+                elapsed = time.perf_counter() - started
+        elif self.link_engine == 'sax':
+            parser = etree.HTMLParser(
+                target=LinkTarget(), encoding=resp.charset)
+            fed = False
+            # Only count time spent parsing, not waiting for chunks.
+            elapsed = 0
+            async for chunk in self.iter_response(resp, digest):
+                started = time.perf_counter()
+                parser.feed(chunk)
+                elapsed += time.perf_counter() - started
+                fed = fed or bool(chunk)
+            started = time.perf_counter()
+            if fed:
+                target = parser.close()
+                links = filter_links(
+                    target.hrefs, url, self.root_url, target.base)
+            else:
+                links = set()
+            elapsed += time.perf_counter() - started
+        else:
+            html = await self.parse_response(resp, digest)
+            started = time.perf_counter()
+            links = extract_links(
+                html, url, self.root_url, resp.charset, self.link_engine)
+            elapsed = time.perf_counter() - started
+        self.parse_time.observe(elapsed)
+        return self.keep_links(links)
+
+    def keep_links(self, links):
+        """
+        Canonical forms of links robots.txt rules, if obeyed, let us fetch.
+        """
+        links = set(map(self.canonicalize, links))
+        if self.robots_rules:
+            links = set(filter(self.robots_rules.allowed, links))
+        return links
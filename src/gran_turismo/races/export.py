@@ -0,0 +1,134 @@
+"""
+export.py - Stream results of a racing session into a file.
+
+Results are read through a server-side cursor and written chunk by chunk,
+as Parquet row groups, Arrow IPC record batches or CSV lines, so exports
+never hold a whole session in memory.
+"""
+import csv
+import gzip
+from itertools import islice
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Compressions available for each format, default first.
+FORMATS = {
+    'parquet': ('zstd', 'snappy', 'gzip', 'lz4', 'none'),
+    'arrow': ('zstd', 'lz4', 'none'),
+    'csv': ('gzip', 'none'),
+}
+
+# (column, queryset field, Arrow type name) for each storage
+COLUMNS = {
+    'full': (
+        ('url', 'url', 'string'),
+        ('status_code', 'status_code', 'uint16'),
+        ('error', 'error', 'string'),
+        ('latency', 'latency', 'uint32'),
+        ('redirects', 'redirects', 'string'),
+    ),
+    'compact': (
+        ('url', 'url__url', 'string'),
+        ('status_code', 'status_code', 'uint16'),
+        ('latency', 'latency', 'uint32'),
+        ('depth', 'depth', 'uint16'),
+        ('redirects', 'redirects', 'string'),
+    ),
+}
+
+# Orderings following indexes of each storage
+ORDERINGS = {
+    'full': ('-status_code', 'url', '-id'),
+    'compact': ('url',),
+}
+
+
+def format_of(path):
+    """
+    Export format matching the extension of path, None if unknown.
+    """
+    path = path.lower()
+    if path.endswith('.gz'):
+        path = path[:-3]
+    for extension, name in (('.parquet', 'parquet'), ('.arrow', 'arrow'),
+                            ('.feather', 'arrow'), ('.csv', 'csv')):
+        if path.endswith(extension):
+            return name
+    return None
+
+
+def export_session(session, path, format='parquet', compression=None,
+                   chunk_size=50000):
+    """
+    Write results of session to path. Returns the number of results.
+    """
+    columns = COLUMNS[session.storage]
+    compression = compression or FORMATS[format][0]
+    rows = (session.result_model.objects
+            .filter(session_id=session.id)
+            .order_by(*ORDERINGS[session.storage])
+            .values_list(*(field for _, field, _ in columns))
+            .iterator(chunk_size=chunk_size))
+    chunks = iter(lambda: list(islice(rows, chunk_size)), [])
+
+    if format == 'csv':
+        return write_csv(path, columns, chunks, compression)
+    if pyarrow is None:
+        raise RuntimeError(f"{format} export requires pyarrow")
+    schema = pyarrow.schema([
+        (name, getattr(pyarrow, kind)()) for name, _, kind in columns])
+    if format == 'parquet':
+        return write_parquet(path, schema, chunks, compression)
+    return write_arrow(path, schema, chunks, compression)
+
+
+def record_batch(schema, chunk):
+    return pyarrow.record_batch(
+        [pyarrow.array(values, field.type)
+         for field, values in zip(schema, zip(*chunk))],
+        schema=schema)
+
+
+def write_parquet(path, schema, chunks, compression):
+    exported = 0
+    with pyarrow.parquet.ParquetWriter(
+            path, schema, compression=compression) as writer:
+        for chunk in chunks:
+            # Every chunk makes a row group.
+            writer.write_table(pyarrow.Table.from_batches(
+                [record_batch(schema, chunk)]))
+            exported += len(chunk)
+    return exported
+
+
+def write_arrow(path, schema, chunks, compression):
+    exported = 0
+    options = pyarrow.ipc.IpcWriteOptions(
+        compression=None if compression == 'none' else compression)
+    with pyarrow.OSFile(path, 'wb') as sink, \
+            pyarrow.ipc.new_file(sink, schema, options=options) as writer:
+        for chunk in chunks:
+            writer.write_batch(record_batch(schema, chunk))
+            exported += len(chunk)
+    return exported
+
+
+def write_csv(path, columns, chunks, compression):
+    exported = 0
+    if compression == 'gzip':
+        f = gzip.open(path, 'wt', newline='', encoding='utf-8')
+    else:
+        f = open(path, 'w', newline='', encoding='utf-8')
+    with f:
+        writer = csv.writer(f)
+        writer.writerow([name for name, _, _ in columns])
+        for chunk in chunks:
+            writer.writerows(chunk)
+            exported += len(chunk)
+    return exported
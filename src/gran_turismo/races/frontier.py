@@ -0,0 +1,438 @@
+"""
+frontier.py - Frontier and seen-set shared by the nodes of a race.
+
+A coordinator seeds the frontier, absorbs what workers report and hands
+URLs of silent workers over to others. Workers lease batches of URLs and
+report results, crawled URLs and discovered links back, all at once.
+
+Every backend offers the same methods, all of them blocking:
+
+    Coordinator side: configure(), seed(), absorb(), reclaim(),
+                      outstanding(), counters(), finish().
+    Worker side:      config(), lease(), report(), over().
+
+Leases belong to a worker, which renews them every time it reports. Once
+a worker goes silent for longer than its lease TTL, the coordinator puts
+its leased URLs back into the queue, so a lost worker loses no work.
+"""
+from threading import Lock
+from urllib.parse import urlsplit
+import json
+import sqlite3
+import time
+
+from .resp import RespClient
+
+
+COUNTERS = (
+    'twos', 'threes', 'fours', 'fives', 'failures', 'crawled', 'retries',
+    'cache_hits', 'cache_misses', 'redirect_hits', 'redirect_misses',
+)
+
+
+class SqliteFrontier:
+    """
+    Frontier kept in a SQLite file, shared by the processes of one box.
+    One file holds a single race.
+
+    Init Attributes:
+        path            SQLite file holding the frontier.
+        race            Id of the racing session.
+    """
+    # States of a URL
+    QUEUED, LEASED, DONE, DROPPED = range(4)
+
+    def __init__(self, path, race):
+        self.path = path
+        self.race = race
+        self.lock = Lock()
+        # Connection is opened on first use, so the frontier can be handed
+        # to forked processes.
+        self.db = None
+
+    def connect(self):
+        self.db = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None,
+            check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS config ("
+            "race INTEGER NOT NULL, "
+            "options TEXT NOT NULL, "
+            "over INTEGER NOT NULL); "
+            "CREATE TABLE IF NOT EXISTS urls ("
+            "id INTEGER PRIMARY KEY, "
+            "url TEXT NOT NULL UNIQUE, "
+            "max_redirects INTEGER NOT NULL, "
+            "state INTEGER NOT NULL, "
+            "worker TEXT); "
+            "CREATE INDEX IF NOT EXISTS urls_state ON urls (state, id); "
+            "CREATE TABLE IF NOT EXISTS workers ("
+            "worker TEXT PRIMARY KEY, "
+            "expires REAL NOT NULL); "
+            "CREATE TABLE IF NOT EXISTS inbox ("
+            "id INTEGER PRIMARY KEY, "
+            "report TEXT NOT NULL); "
+            "CREATE TABLE IF NOT EXISTS counters ("
+            "name TEXT PRIMARY KEY, "
+            "value INTEGER NOT NULL);")
+
+    def transaction(self, statements):
+        """
+        Run statements in a single write transaction. Returns the cursor
+        of the last one.
+        """
+        with self.lock:
+            if self.db is None:
+                self.connect()
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = None
+                for sql, params in statements:
+                    if params and isinstance(params[0], (list, tuple)):
+                        cursor = self.db.executemany(sql, params)
+                    else:
+                        cursor = self.db.execute(sql, params)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            return cursor
+
+    def query(self, sql, params=()):
+        with self.lock:
+            if self.db is None:
+                self.connect()
+            return self.db.execute(sql, params).fetchall()
+
+    def configure(self, options):
+        """
+        Start a new race with options workers should race with.
+        """
+        self.transaction([
+            ("DELETE FROM config", ()),
+            ("DELETE FROM urls", ()),
+            ("DELETE FROM workers", ()),
+            ("DELETE FROM inbox", ()),
+            ("DELETE FROM counters", ()),
+            ("INSERT INTO config (race, options, over) VALUES (?, ?, 0)",
+             (self.race, json.dumps(options))),
+        ])
+
+    def config(self):
+        """
+        Options of the race, or None if it is not this race.
+        """
+        rows = self.query("SELECT race, options FROM config")
+        if not rows or rows[0][0] != self.race:
+            return None
+        return json.loads(rows[0][1])
+
+    def seed(self, items):
+        """
+        Queue (url, max_redirects) items not seen before.
+        """
+        if items:
+            self.transaction([(
+                "INSERT OR IGNORE INTO urls (url, max_redirects, state) "
+                "VALUES (?, ?, ?)",
+                [(url, max_redirects, self.QUEUED)
+                 for url, max_redirects in items])])
+
+    def lease(self, worker, count, ttl):
+        """
+        Take up to count queued URLs for worker. Returns (url,
+        max_redirects, token) items; tokens are given back on report.
+        """
+        if self.over():
+            return []
+        with self.lock:
+            if self.db is None:
+                self.connect()
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO workers (worker, expires) "
+                    "VALUES (?, ?)", (worker, time.time() + ttl))
+                rows = self.db.execute(
+                    "SELECT id, url, max_redirects FROM urls "
+                    "WHERE state = ? ORDER BY id LIMIT ?",
+                    (self.QUEUED, count)).fetchall()
+                self.db.executemany(
+                    "UPDATE urls SET state = ?, worker = ? WHERE id = ?",
+                    [(self.LEASED, worker, id_) for id_, _, _ in rows])
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return [(url, max_redirects, id_) for id_, url, max_redirects in rows]
+
+    def report(self, worker, ttl, done, results, links, counters):
+        """
+        Renew worker leases, release done tokens and hand results,
+        discovered (url, max_redirects) links and counter increments over
+        to the coordinator.
+        """
+        statements = [
+            ("INSERT OR REPLACE INTO workers (worker, expires) "
+             "VALUES (?, ?)", (worker, time.time() + ttl)),
+        ]
+        if done:
+            statements.append((
+                "UPDATE urls SET state = ? "
+                "WHERE id = ? AND state = ? AND worker = ?",
+                [(self.DONE, token, self.LEASED, worker) for token in done]))
+        if results or links:
+            statements.append((
+                "INSERT INTO inbox (report) VALUES (?)",
+                (json.dumps([results, links]),)))
+        increments = [(name, value, value)
+                      for name, value in counters.items() if value]
+        if increments:
+            statements.append((
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET value = value + ?",
+                increments))
+        self.transaction(statements)
+
+    def absorb(self):
+        """
+        Take worker reports, queueing discovered links not seen before.
+        Returns reported results.
+        """
+        with self.lock:
+            if self.db is None:
+                self.connect()
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.db.execute(
+                    "SELECT id, report FROM inbox ORDER BY id").fetchall()
+                results = []
+                for _, report in rows:
+                    report_results, links = json.loads(report)
+                    results.extend(map(tuple, report_results))
+                    self.db.executemany(
+                        "INSERT OR IGNORE INTO urls "
+                        "(url, max_redirects, state) VALUES (?, ?, ?)",
+                        [(url, max_redirects, self.QUEUED)
+                         for url, max_redirects in links])
+                if rows:
+                    self.db.execute(
+                        "DELETE FROM inbox WHERE id <= ?", (rows[-1][0],))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return results
+
+    def reclaim(self):
+        """
+        Queue again URLs leased by workers silent for longer than their
+        TTL. Returns the number of URLs queued again.
+        """
+        cursor = self.transaction([
+            ("CREATE TEMP TABLE IF NOT EXISTS expired (worker TEXT)", ()),
+            ("DELETE FROM expired", ()),
+            ("INSERT INTO expired SELECT worker FROM workers "
+             "WHERE expires < ?", (time.time(),)),
+            ("DELETE FROM workers WHERE worker IN "
+             "(SELECT worker FROM expired)", ()),
+            ("UPDATE urls SET state = ?, worker = NULL "
+             "WHERE state = ? AND worker IN (SELECT worker FROM expired)",
+             (self.QUEUED, self.LEASED)),
+        ])
+        return cursor.rowcount
+
+    def outstanding(self):
+        """
+        Number of URLs queued or leased, plus reports not absorbed yet.
+        """
+        (urls,), = self.query(
+            "SELECT COUNT(*) FROM urls WHERE state IN (?, ?)",
+            (self.QUEUED, self.LEASED))
+        (reports,), = self.query("SELECT COUNT(*) FROM inbox")
+        return urls + reports
+
+    def counters(self):
+        """
+        Counters of the race, summed across workers.
+        """
+        counters = dict.fromkeys(COUNTERS, 0)
+        counters.update(self.query("SELECT name, value FROM counters"))
+        return counters
+
+    def finish(self, drop=False):
+        """
+        Tell workers the race is over, dropping queued URLs if asked to.
+        """
+        statements = [("UPDATE config SET over = 1", ())]
+        if drop:
+            statements.append(
+                ("UPDATE urls SET state = ? WHERE state = ?",
+                 (self.DROPPED, self.QUEUED)))
+        self.transaction(statements)
+
+    def over(self):
+        rows = self.query("SELECT race, over FROM config")
+        return not rows or rows[0][0] != self.race or bool(rows[0][1])
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+class RedisFrontier:
+    """
+    Frontier kept in a Redis-compatible server, shared by nodes of any
+    box. Keys of a race live under the gt:{race}: namespace.
+
+    Init Attributes:
+        client          resp.RespClient of the server.
+        race            Id of the racing session.
+    """
+    def __init__(self, client, race):
+        self.client = client
+        self.race = race
+
+    def key(self, *parts):
+        return ':'.join(('gt', str(self.race)) + parts)
+
+    def encode(self, url, max_redirects):
+        return f'{max_redirects} {url}'
+
+    def decode(self, item):
+        max_redirects, url = item.split(' ', 1)
+        return url, int(max_redirects)
+
+    def workers(self):
+        pairs = self.client.execute('HGETALL', self.key('workers'))
+        return dict(zip(pairs[::2], map(float, pairs[1::2])))
+
+    def configure(self, options):
+        keys = [self.key(name) for name in (
+            'config', 'over', 'seen', 'queue', 'workers', 'inbox',
+            'counters')]
+        keys += [self.key('leased', worker) for worker in self.workers()]
+        self.client.pipeline([
+            ['DEL'] + keys,
+            ('SET', self.key('config'), json.dumps(options)),
+        ])
+
+    def config(self):
+        options = self.client.execute('GET', self.key('config'))
+        return json.loads(options) if options is not None else None
+
+    def seed(self, items):
+        items = list(items)
+        if not items:
+            return
+        added = self.client.pipeline(
+            [('SADD', self.key('seen'), url) for url, _ in items])
+        new = [self.encode(url, max_redirects)
+               for (url, max_redirects), fresh in zip(items, added) if fresh]
+        if new:
+            self.client.execute('LPUSH', self.key('queue'), *new)
+
+    def lease(self, worker, count, ttl):
+        if self.over():
+            return []
+        leased = self.key('leased', worker)
+        # Worker is registered before taking any URL, so its leases can
+        # always be found and reclaimed.
+        replies = self.client.pipeline(
+            [('HSET', self.key('workers'), worker, time.time() + ttl)]
+            + [('RPOPLPUSH', self.key('queue'), leased)] * count)
+        return [self.decode(item) + (item,)
+                for item in replies[1:] if item is not None]
+
+    def report(self, worker, ttl, done, results, links, counters):
+        commands = [
+            ('MULTI',),
+            ('HSET', self.key('workers'), worker, time.time() + ttl),
+        ]
+        leased = self.key('leased', worker)
+        commands += [('LREM', leased, 1, token) for token in done]
+        if results or links:
+            commands.append(('RPUSH', self.key('inbox'),
+                             json.dumps([results, links])))
+        commands += [('HINCRBY', self.key('counters'), name, value)
+                     for name, value in counters.items() if value]
+        commands.append(('EXEC',))
+        self.client.pipeline(commands)
+
+    def absorb(self):
+        _, _, _, (reports, _) = self.client.pipeline([
+            ('MULTI',),
+            ('LRANGE', self.key('inbox'), 0, -1),
+            ('DEL', self.key('inbox')),
+            ('EXEC',),
+        ])
+        results = []
+        links = []
+        for report in reports:
+            report_results, report_links = json.loads(report)
+            results.extend(map(tuple, report_results))
+            links.extend(map(tuple, report_links))
+        self.seed(links)
+        return results
+
+    def reclaim(self):
+        now = time.time()
+        reclaimed = 0
+        for worker, expires in self.workers().items():
+            if expires >= now:
+                continue
+            # Forget the worker first: should it come back and lease again,
+            # it registers itself anew.
+            self.client.execute('HDEL', self.key('workers'), worker)
+            leased = self.key('leased', worker)
+            while self.client.execute(
+                    'RPOPLPUSH', leased, self.key('queue')) is not None:
+                reclaimed += 1
+        return reclaimed
+
+    def outstanding(self):
+        workers = list(self.workers())
+        lengths = self.client.pipeline(
+            [('LLEN', self.key('queue')), ('LLEN', self.key('inbox'))]
+            + [('LLEN', self.key('leased', worker)) for worker in workers])
+        return sum(lengths)
+
+    def counters(self):
+        counters = dict.fromkeys(COUNTERS, 0)
+        pairs = self.client.execute('HGETALL', self.key('counters'))
+        counters.update(zip(pairs[::2], map(int, pairs[1::2])))
+        return counters
+
+    def finish(self, drop=False):
+        commands = [('SET', self.key('over'), 1)]
+        if drop:
+            commands.append(('DEL', self.key('queue')))
+        self.client.pipeline(commands)
+
+    def over(self):
+        over, config = self.client.pipeline([
+            ('GET', self.key('over')), ('EXISTS', self.key('config'))])
+        return over is not None or not config
+
+    def close(self):
+        self.client.close()
+
+
+def open_frontier(url, race):
+    """
+    Frontier backend of a race given its URL: sqlite:///path/to/file or
+    redis://host:port/db.
+    """
+    parts = urlsplit(url)
+    if parts.scheme == 'sqlite':
+        return SqliteFrontier(parts.path, race)
+    if parts.scheme == 'redis':
+        db = int(parts.path.strip('/') or 0)
+        client = RespClient(parts.hostname or 'localhost',
+                            parts.port or 6379, db)
+        return RedisFrontier(client, race)
+    raise ValueError(f"Unknown frontier backend: {url}")
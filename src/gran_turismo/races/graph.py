@@ -0,0 +1,257 @@
+"""
+graph.py - Link graph of a race, kept on disk.
+
+Every page parsed during a race is appended to three files of its graph
+directory, in the same order:
+
+    urls.txt    URL of the page, one per line.
+    pages.bin   (url id, content digest, number of links) signed 64 bits
+                triples.
+    edges.bin   Ids of URLs the page links to, signed 64 bits each.
+
+Ids are RacingUrl hashes of URLs. Files are only ever appended to, in
+chunks of array-backed buffers, and read back sequentially or, for links
+of a single page, with a seek.
+"""
+from array import array
+from hashlib import blake2b
+from itertools import accumulate
+import os
+
+from .models import RacingUrl
+
+
+URLS = 'urls.txt'
+PAGES = 'pages.bin'
+EDGES = 'edges.bin'
+
+# Pages read at once when scanning a graph.
+READ_CHUNK = 4096
+
+
+def session_referrers(session, urls):
+    """
+    URLs of pages linking to each of urls in the link graph of a racing
+    session. Sessions without a graph have no referrers.
+    """
+    if not session.graph:
+        return {url: [] for url in urls}
+    return LinkGraph(session.graph).referrers(urls)
+
+
+class LinkGraph:
+    """
+    Append-only store of the pages of a race, their content digests and
+    their links.
+
+    Init Attributes:
+        path            Directory of the graph.
+        previous        Optional LinkGraph of a previous race of the same
+                        site. Pages whose digest did not change since are
+                        not expanded again, and pages not parsed during the
+                        race are carried over from it when closed.
+        chunk_size      Number of links buffered before appending them to
+                        disk.
+    """
+    def __init__(self, path, previous=None, chunk_size=65536):
+        self.path = path
+        self.previous = previous
+        self.chunk_size = chunk_size
+        # Files are opened on first write.
+        self.files = None
+
+        # Initialize buffers of the next chunk
+        self.urls = []
+        self.pages = array('q')
+        self.edges = array('q')
+
+        # Ids of pages recorded and of URLs crawled during the race
+        self.recorded = set()
+        self.visited = set()
+
+        # Index of pages, see load().
+        self.index = None
+        self.digests = self.counts = self.offsets = None
+        self.edges_file = None
+
+        # Initialize progress counters
+        self.unchanged = 0
+        self.carried = 0
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.files = (
+            open(os.path.join(self.path, URLS), 'a', encoding='utf-8'),
+            open(os.path.join(self.path, PAGES), 'ab'),
+            open(os.path.join(self.path, EDGES), 'ab'),
+        )
+
+    @staticmethod
+    def digest():
+        """
+        Hash object to be fed page contents, see record().
+        """
+        return blake2b(digest_size=8)
+
+    def visit(self, url):
+        """
+        Remember that url was crawled during the race.
+        """
+        self.visited.add(RacingUrl.hash_url(url))
+
+    def record(self, url, digest, links):
+        """
+        Append a page, the digest() of its contents and its links. Returns
+        links to follow: those of new or changed pages which were not there
+        in the previous race. A None digest means the page is known to be
+        unchanged, e.g. from HTTP validators.
+        """
+        url_id = RacingUrl.hash_url(url)
+        link_ids = {RacingUrl.hash_url(link): link for link in links}
+        before = None
+        if self.previous is not None:
+            before = self.previous.page(url_id)
+        if digest is not None:
+            digest = int.from_bytes(digest.digest(), 'big', signed=True)
+        else:
+            digest = before[0] if before else 0
+
+        if url_id not in self.recorded:
+            self.recorded.add(url_id)
+            self.urls.append(url)
+            self.pages.extend((url_id, digest, len(link_ids)))
+            self.edges.extend(link_ids)
+            if len(self.edges) >= self.chunk_size:
+                self.flush()
+
+        if before is None:
+            return set(links)
+        if before[0] == digest:
+            self.unchanged += 1
+            return set()
+        known = set(self.previous.links(url_id))
+        return {link for link_id, link in link_ids.items()
+                if link_id not in known}
+
+    def flush(self):
+        """
+        Append buffered pages and links to disk.
+        """
+        if not self.urls:
+            return
+        if self.files is None:
+            self.open()
+        urls, pages, edges = self.files
+        # Links first, so pages never point past the end of edges.
+        self.edges.tofile(edges)
+        edges.flush()
+        self.pages.tofile(pages)
+        pages.flush()
+        urls.write(''.join(f'{url}\n' for url in self.urls))
+        urls.flush()
+        self.urls = []
+        self.pages = array('q')
+        self.edges = array('q')
+
+    def close(self):
+        """
+        Carry over pages of the previous race not crawled during this one,
+        then close files.
+        """
+        if self.previous is not None:
+            for url, url_id, digest, targets in self.previous.scan():
+                if url_id in self.recorded or url_id in self.visited:
+                    continue
+                self.recorded.add(url_id)
+                self.carried += 1
+                self.urls.append(url)
+                self.pages.extend((url_id, digest, len(targets)))
+                self.edges.extend(targets)
+                if len(self.edges) >= self.chunk_size:
+                    self.flush()
+            self.previous.close()
+        self.flush()
+        if self.files is not None:
+            for f in self.files:
+                f.close()
+            self.files = None
+        if self.edges_file is not None:
+            self.edges_file.close()
+            self.edges_file = None
+
+    def scan(self):
+        """
+        Yield (url, url id, digest, link ids) of every page on disk.
+        """
+        path = os.path.join(self.path, PAGES)
+        if not os.path.exists(path):
+            return
+        with open(os.path.join(self.path, URLS), encoding='utf-8') as urls, \
+                open(path, 'rb') as pages, \
+                open(os.path.join(self.path, EDGES), 'rb') as edges:
+            while True:
+                chunk = array('q', pages.read(READ_CHUNK * 24))
+                if not chunk:
+                    break
+                counts = chunk[2::3]
+                targets = array('q', edges.read(sum(counts) * 8))
+                start = 0
+                for i, count in enumerate(counts):
+                    yield (urls.readline().rstrip('\n'), chunk[i * 3],
+                           chunk[i * 3 + 1], targets[start:start + count])
+                    start += count
+
+    def load(self):
+        """
+        Index pages on disk, so their digest and links can be looked up.
+        """
+        self.index = {}
+        digests = array('q')
+        counts = array('q')
+        path = os.path.join(self.path, PAGES)
+        if os.path.exists(path):
+            with open(path, 'rb') as pages:
+                chunk = array('q', pages.read())
+            for i, url_id in enumerate(chunk[0::3]):
+                self.index[url_id] = i
+            digests = chunk[1::3]
+            counts = chunk[2::3]
+        self.digests = digests
+        self.counts = counts
+        # Offset of the first link of every page in edges.bin
+        self.offsets = array('q', [0])
+        self.offsets.extend(accumulate(counts))
+        return self
+
+    def page(self, url_id):
+        """
+        (digest, number of links) of a page on disk, None if absent.
+        """
+        i = self.index.get(url_id)
+        if i is None:
+            return None
+        return self.digests[i], self.counts[i]
+
+    def links(self, url_id):
+        """
+        Ids of URLs a page on disk links to.
+        """
+        i = self.index.get(url_id)
+        if i is None or not self.counts[i]:
+            return array('q')
+        if self.edges_file is None:
+            self.edges_file = open(os.path.join(self.path, EDGES), 'rb')
+        self.edges_file.seek(self.offsets[i] * 8)
+        return array('q', self.edges_file.read(self.counts[i] * 8))
+
+    def referrers(self, urls):
+        """
+        URLs of pages linking to each of urls, in one pass over the graph.
+        """
+        wanted = {RacingUrl.hash_url(url): url for url in urls}
+        found = {url: [] for url in urls}
+        for source, _, _, targets in self.scan():
+            for target in targets:
+                if target in wanted:
+                    found[wanted[target]].append(source)
+        return found
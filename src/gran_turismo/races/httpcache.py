@@ -0,0 +1,165 @@
+"""
+httpcache.py - Remember pages between races to skip unchanged ones.
+"""
+from collections import namedtuple
+import sqlite3
+import time
+import zlib
+
+
+CacheEntry = namedtuple('CacheEntry', 'etag last_modified status links')
+
+
+class HttpCache:
+    """
+    On-disk cache of page validators (ETag, Last-Modified), status and
+    outlinks, keyed by canonical URL. Lets a race ask for pages
+    conditionally and reuse their links when they did not change.
+
+    Changes are buffered and written in batches. Once the cache grows
+    past max_size, least recently used pages are evicted.
+
+    Init Attributes:
+        path            SQLite file where pages are kept.
+        max_size        Maximum number of bytes of cached links.
+        flush_size      Number of changes buffered before writing them.
+    """
+
+    def __init__(self, path, max_size=256 * 2 ** 20, flush_size=500):
+        self.path = path
+        self.max_size = max_size
+        self.flush_size = flush_size
+        # Connection is opened on first use, so the cache can be handed
+        # to forked processes.
+        self.db = None
+        self.size = None
+
+        # Initialize changes since last flush
+        self.entries = {}
+        self.touched = {}
+
+    def connect(self):
+        self.db = sqlite3.connect(self.path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS pages ("
+                            "url TEXT PRIMARY KEY, "
+                            "etag TEXT, "
+                            "last_modified TEXT, "
+                            "status INTEGER NOT NULL, "
+                            "links BLOB NOT NULL, "
+                            "size INTEGER NOT NULL, "
+                            "used REAL NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS pages_used "
+                            "ON pages (used)")
+        self.size = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    def get(self, url):
+        """
+        Cached entry of url, or None.
+        """
+        if self.db is None:
+            self.connect()
+        entry = self.entries.get(url)
+        if entry is not None:
+            return entry[0]
+        row = self.db.execute(
+            "SELECT etag, last_modified, status, links "
+            "FROM pages WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, status, links = row
+        links = zlib.decompress(links).decode().split('\n') if links else []
+        return CacheEntry(etag, last_modified, status, links)
+
+    @staticmethod
+    def validators(entry):
+        """
+        Headers asking for a page only if it changed since entry.
+        """
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def put(self, url, headers, status, links):
+        """
+        Cache a page, if it can be validated later on.
+        """
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        links = sorted(links)
+        blob = zlib.compress('\n'.join(links).encode())
+        self.entries[url] = (
+            CacheEntry(etag, last_modified, status, links), blob)
+        self.changed()
+
+    def touch(self, url):
+        """
+        Mark a page as recently used.
+        """
+        self.touched[url] = time.time()
+        self.changed()
+
+    def changed(self):
+        if len(self.entries) + len(self.touched) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write buffered changes, evicting pages if the cache is too large.
+        """
+        if not self.entries and not self.touched:
+            return
+        if self.db is None:
+            self.connect()
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO pages "
+                "(url, etag, last_modified, status, links, size, used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(url, entry.etag, entry.last_modified, entry.status,
+                  blob, len(blob), now)
+                 for url, (entry, blob) in self.entries.items()])
+            self.db.executemany(
+                "UPDATE pages SET used = ? WHERE url = ?",
+                [(used, url) for url, used in self.touched.items()])
+        # Replaced pages are counted twice, until next exact count.
+        self.size += sum(len(blob) for _, blob in self.entries.values())
+        self.entries = {}
+        self.touched = {}
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Drop least recently used pages until cache fits in max_size.
+        """
+        self.size = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        excess = self.size - self.max_size
+        if excess <= 0:
+            return
+        evicted = []
+        for url, size in self.db.execute(
+                "SELECT url, size FROM pages ORDER BY used"):
+            evicted.append((url,))
+            excess -= size
+            self.size -= size
+            if excess <= 0:
+                break
+        with self.db:
+            self.db.executemany("DELETE FROM pages WHERE url = ?", evicted)
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
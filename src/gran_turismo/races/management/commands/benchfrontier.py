@@ -0,0 +1,79 @@
+import json
+import logging
+import multiprocessing
+
+from django.core.management.base import BaseCommand, CommandError
+
+from races import synthetic
+from races.bench import run_frontier
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Measure memory taken by the frontier over a crawl of a "
+            "synthetic link graph, fetching nothing")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pages',
+            type=int,
+            default=1000000,
+            help='Number of pages of the site. Defaults to 1000000')
+        parser.add_argument(
+            '--fanout',
+            type=int,
+            default=10,
+            help='Number of links on every page. Defaults to 10')
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Seed of the link graph. Defaults to 0')
+        parser.add_argument(
+            '--root_url',
+            default='https://www.example.com/',
+            help='URL pages are found under. Defaults to '
+                 'https://www.example.com/')
+        parser.add_argument(
+            '--output',
+            help='File where the JSON report is written. Defaults to stdout')
+
+    def handle(self, *args, **options):
+        if options['pages'] < 1 or options['fanout'] < 0:
+            raise CommandError("--pages must be positive and --fanout not "
+                               "negative")
+        logger.warning(f"Building a link graph of {options['pages']} pages")
+        site = synthetic.SyntheticSite(
+            pages=options['pages'],
+            fanout=options['fanout'],
+            seed=options['seed'],
+        )
+
+        context = multiprocessing.get_context('fork')
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(
+            target=run_frontier, args=(site, options['root_url'], sender))
+        process.start()
+        sender.close()
+        try:
+            report = receiver.recv()
+        except EOFError:
+            raise CommandError("Frontier crawl died")
+        finally:
+            process.join()
+        logger.warning(
+            f"Crawled {report['crawled']} URLs, up to "
+            f"{report['peak_queued']} queued taking "
+            f"{report['peak_frontier_mb']} MB, "
+            f"{report['bytes_per_queued_url']} bytes per queued URL")
+
+        site_options = {name: options[name] for name in (
+            'pages', 'fanout', 'seed', 'root_url')}
+        report = json.dumps({'site': site_options, 'run': report}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report + '\n')
+        else:
+            self.stdout.write(report)
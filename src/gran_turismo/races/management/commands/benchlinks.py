@@ -0,0 +1,96 @@
+import logging
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from races import drivers
+from races.bench import current_rss, peak_rss
+
+
+logger = logging.getLogger(__name__)
+
+
+def run_engine(engine, pages, root_url, repeat, conn):
+    """
+    Extract links of every page repeat times with engine. Runs in its own
+    process, so its peak memory is not mixed with other engines.
+    """
+    baseline = current_rss()
+    links = 0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for page_url, html in pages:
+            links += len(drivers.extract_links(
+                html, page_url, root_url, engine=engine))
+    elapsed = time.perf_counter() - started
+    conn.send((elapsed, links // repeat, peak_rss() - baseline))
+    conn.close()
+
+
+class Command(BaseCommand):
+    help = "Compare link extraction engines over a corpus of saved pages"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'corpus',
+            help='Directory of saved HTML pages')
+        parser.add_argument(
+            '--root_url',
+            default='http://localhost/',
+            help='URL pages are resolved against and links are kept under. '
+                 'Defaults to http://localhost/')
+        parser.add_argument(
+            '--engines',
+            nargs='+',
+            choices=sorted(drivers.LINK_ENGINES),
+            default=sorted(drivers.LINK_ENGINES),
+            help='Engines to compare. Defaults to all of them')
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Number of passes over the corpus. Defaults to 5')
+
+    def handle(self, *args, **options):
+        corpus = options['corpus']
+        root_url = options['root_url']
+        if not os.path.isdir(corpus):
+            raise CommandError(f"Not a directory: {corpus}")
+
+        pages = []
+        for dirpath, _, filenames in os.walk(corpus):
+            for filename in sorted(filenames):
+                if not filename.endswith(('.html', '.htm')):
+                    continue
+                path = os.path.join(dirpath, filename)
+                with open(path, 'rb') as f:
+                    html = f.read()
+                relpath = os.path.relpath(path, corpus).replace(os.sep, '/')
+                pages.append((root_url + relpath, html))
+        if not pages:
+            raise CommandError(f"No HTML pages found in {corpus}")
+
+        size = sum(len(html) for _, html in pages)
+        logger.warning(f"Corpus: {len(pages)} pages, "
+                       f"{size / 2 ** 20:.2f} MB")
+
+        context = multiprocessing.get_context('fork')
+        for engine in options['engines']:
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(
+                target=run_engine,
+                args=(engine, pages, root_url, options['repeat'], sender),
+            )
+            process.start()
+            sender.close()
+            elapsed, links, peak = receiver.recv()
+            process.join()
+
+            processed = len(pages) * options['repeat']
+            logger.warning(
+                f"{engine}: {processed / elapsed:.2f} pages per second, "
+                f"{size * options['repeat'] / elapsed / 2 ** 20:.2f} MB/s, "
+                f"{links} links, "
+                f"peak memory +{peak / 2 ** 20:.2f} MB")
@@ -0,0 +1,201 @@
+from itertools import product
+from urllib.parse import urlparse
+import json
+import logging
+import multiprocessing
+
+from django.core.management.base import BaseCommand, CommandError
+
+from races import dedup, synthetic, transport
+from races.bench import run_race
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Benchmark crawling races against a local synthetic site"
+
+    def add_arguments(self, parser):
+        # Site options
+        parser.add_argument(
+            '--pages',
+            type=int,
+            default=2000,
+            help='Number of pages of the site. Defaults to 2000')
+        parser.add_argument(
+            '--fanout',
+            type=int,
+            default=10,
+            help='Number of links on every page. Defaults to 10')
+        parser.add_argument(
+            '--redirect_share',
+            type=float,
+            default=0.05,
+            help='Share of pages redirecting to their content. '
+                 'Defaults to 0.05')
+        parser.add_argument(
+            '--redirect_chain',
+            type=int,
+            default=2,
+            help='Number of redirects before reaching the content. '
+                 'Defaults to 2')
+        parser.add_argument(
+            '--client_errors',
+            type=float,
+            default=0.02,
+            help='Share of pages answering 404. Defaults to 0.02')
+        parser.add_argument(
+            '--server_errors',
+            type=float,
+            default=0.01,
+            help='Share of pages answering 500. Defaults to 0.01')
+        parser.add_argument(
+            '--latency',
+            type=float,
+            default=5,
+            help='Mean milliseconds before the site answers. Defaults to 5')
+        parser.add_argument(
+            '--latency_dist',
+            choices=synthetic.LATENCIES,
+            default='exponential',
+            help='Distribution of latency. Defaults to exponential')
+        parser.add_argument(
+            '--page_size',
+            type=int,
+            default=16,
+            help='Approximate size of every page in KB. Defaults to 16')
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Seed of the link graph. Defaults to 0')
+        parser.add_argument(
+            '--site_name',
+            default='127.0.0.1',
+            help='Host name races reach the site by, which must resolve '
+                 'to 127.0.0.1, e.g. localhost to measure name lookups. '
+                 'Defaults to 127.0.0.1')
+        # Matrix options
+        parser.add_argument(
+            '--max_engines',
+            type=int,
+            nargs='+',
+            default=[10, 50],
+            help='Numbers of engines to race with. Defaults to 10 50')
+        parser.add_argument(
+            '--dedup',
+            nargs='+',
+            choices=sorted(dedup.BACKENDS),
+            default=sorted(dedup.BACKENDS),
+            help='Seen-set backends to race with. Defaults to all of them')
+        parser.add_argument(
+            '--loop',
+            nargs='+',
+            choices=transport.LOOPS[1:],
+            default=['asyncio'],
+            help='Event loops to race on. Defaults to asyncio')
+        parser.add_argument(
+            '--transport',
+            nargs='+',
+            choices=transport.TRANSPORTS,
+            default=['aiohttp'],
+            help='HTTP clients to race with. Defaults to aiohttp')
+        parser.add_argument(
+            '--dns_ttl',
+            type=int,
+            nargs='+',
+            default=[0],
+            help='Seconds the caching resolver keeps addresses to race '
+                 'with, 0 leaving lookups to the connector. Defaults to 0')
+        # Report options
+        parser.add_argument(
+            '--output',
+            help='File where the JSON report is written. Defaults to stdout')
+
+    def handle(self, *args, **options):
+        try:
+            site = synthetic.SyntheticSite(
+                pages=options['pages'],
+                fanout=options['fanout'],
+                redirect_share=options['redirect_share'],
+                redirect_chain=options['redirect_chain'],
+                client_errors=options['client_errors'],
+                server_errors=options['server_errors'],
+                latency=options['latency'] / 1000,
+                latency_dist=options['latency_dist'],
+                page_size=options['page_size'] * 2 ** 10,
+                seed=options['seed'],
+            )
+        except ValueError as e:
+            raise CommandError(e)
+        try:
+            for name in options['loop']:
+                transport.check_loop(name)
+            for name in options['transport']:
+                transport.check_transport(name)
+        except ValueError as e:
+            raise CommandError(e)
+
+        site_process, root_url = site.start()
+        root_url = (f"http://{options['site_name']}:"
+                    f"{urlparse(root_url).port}/")
+        logger.warning(f"Synthetic site serving {options['pages']} pages "
+                       f"at {root_url}")
+
+        runs = []
+        context = multiprocessing.get_context('fork')
+        try:
+            matrix = product(
+                options['max_engines'], options['dedup'], options['loop'],
+                options['transport'], options['dns_ttl'])
+            for max_engines, backend, loop, client, dns_ttl in matrix:
+                driver_options = dict(
+                    expected_urls=options['pages'],
+                    error_rate=0.001,
+                    max_redirects=options['redirect_chain'] + 1,
+                    max_engines=max_engines,
+                    limit=float('inf'),
+                    collect_all=True,
+                    dedup=backend,
+                    transport=client,
+                    dns_ttl=dns_ttl or None,
+                )
+                run = (f"{max_engines} engines, {backend} seen-set, {loop} "
+                       f"loop, {client} transport, DNS TTL {dns_ttl}")
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(
+                    target=run_race,
+                    args=(root_url, driver_options, sender, loop),
+                )
+                process.start()
+                sender.close()
+                try:
+                    report = receiver.recv()
+                except EOFError:
+                    raise CommandError(f"Race with {run} died")
+                finally:
+                    process.join()
+
+                report = dict(
+                    max_engines=max_engines, dedup=backend, loop=loop,
+                    transport=client, dns_ttl=dns_ttl, **report)
+                logger.warning(
+                    f"{run}: {report['pages_per_second']} pages per second")
+                runs.append(report)
+        finally:
+            site_process.terminate()
+            site_process.join()
+
+        site_options = {
+            name: options[name] for name in (
+                'pages', 'fanout', 'redirect_share', 'redirect_chain',
+                'client_errors', 'server_errors', 'latency', 'latency_dist',
+                'page_size', 'seed', 'site_name')
+        }
+        report = json.dumps({'site': site_options, 'runs': runs}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report + '\n')
+        else:
+            self.stdout.write(report)
@@ -0,0 +1,65 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from races import diff, models
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Compare results of two racing sessions: new errors, fixed "
+            "errors and changed statuses")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'before',
+            type=int,
+            help='Racing session to compare from, e.g. before a deploy')
+        parser.add_argument(
+            'after',
+            type=int,
+            help='Racing session to compare to')
+        parser.add_argument(
+            '--kind',
+            nargs='+',
+            choices=[kind for kind, _ in models.DIFF_KINDS],
+            default=[kind for kind, _ in models.DIFF_KINDS],
+            help='Kinds of differences to list. Defaults to all of them')
+        parser.add_argument(
+            '--refresh',
+            action='store_true',
+            help='Compare sessions again even if a diff of them is cached')
+
+    def handle(self, *args, **options):
+        sessions = models.RacingSession.objects.in_bulk(
+            [options['before'], options['after']])
+        for session_id in (options['before'], options['after']):
+            if session_id not in sessions:
+                raise CommandError(f"No race {session_id}")
+        if options['before'] == options['after']:
+            raise CommandError("Compare two different races")
+
+        try:
+            race_diff = diff.diff_sessions(
+                sessions[options['before']], sessions[options['after']],
+                refresh=options['refresh'])
+        except diff.RaceRunning as e:
+            raise CommandError(e)
+
+        entries = (models.RacingDiffEntry.objects
+                   .filter(diff=race_diff, kind__in=options['kind'])
+                   .order_by('-diff', 'kind', 'url', '-id')
+                   .values_list('kind', 'before_status', 'after_status',
+                                'url')
+                   .iterator())
+        for kind, before_status, after_status, url in entries:
+            self.stdout.write(
+                f"{kind}\t{'-' if before_status is None else before_status}"
+                f"\t{'-' if after_status is None else after_status}\t{url}")
+
+        logger.warning(f"Race {race_diff.before_id} -> "
+                       f"{race_diff.after_id}: {race_diff.new} new errors, "
+                       f"{race_diff.fixed} fixed errors, "
+                       f"{race_diff.changed} changed statuses")
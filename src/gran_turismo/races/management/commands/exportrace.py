@@ -0,0 +1,69 @@
+import logging
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from races import export, models
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Export results of a racing session into a columnar file"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'session_id',
+            type=int,
+            help='Racing session to export')
+        parser.add_argument(
+            'output',
+            help='File to write results to')
+        parser.add_argument(
+            '--format',
+            choices=sorted(export.FORMATS),
+            default=None,
+            help='Parquet, Arrow IPC or CSV. Falls back to CSV when pyarrow '
+                 'is not installed. Defaults to the output extension, or '
+                 'parquet')
+        parser.add_argument(
+            '--compression',
+            default=None,
+            help='zstd, lz4, snappy, gzip or none, depending on the format. '
+                 'Defaults to zstd, or gzip for CSV')
+        parser.add_argument(
+            '--chunk_size',
+            type=int,
+            default=50000,
+            help='Number of results read from DB and written at once. '
+                 'Defaults to 50000')
+
+    def handle(self, *args, **options):
+        try:
+            session = models.RacingSession.objects.get(
+                pk=options['session_id'])
+        except models.RacingSession.DoesNotExist:
+            raise CommandError(f"No race {options['session_id']}")
+
+        output = options['output']
+        format = options['format'] or export.format_of(output) or 'parquet'
+        compression = options['compression']
+        if format != 'csv' and export.pyarrow is None:
+            output = os.path.splitext(output)[0] + '.csv.gz'
+            logger.warning(f"pyarrow is not installed, exporting CSV to "
+                           f"{output} instead")
+            format, compression = 'csv', None
+        if compression and compression not in export.FORMATS[format]:
+            raise CommandError(
+                f"{format} compression must be one of: "
+                f"{', '.join(export.FORMATS[format])}")
+
+        started = time.perf_counter()
+        exported = export.export_session(
+            session, output, format, compression, options['chunk_size'])
+        elapsed = time.perf_counter() - started
+        logger.warning(f"Exported {exported} results of race {session.id} "
+                       f"to {output} in {elapsed:.2f}s "
+                       f"({os.path.getsize(output) / 2 ** 20:.2f} MB)")
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from races import (
+    canonical, distributed, drivers, frontier, httpcache, scheduler,
+    transport,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Join a crawling race coordinated through a shared frontier"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'session_id',
+            type=int,
+            help='Racing session of the race to join')
+        parser.add_argument(
+            '--frontier',
+            required=True,
+            help='Frontier the race is coordinated through: '
+                 'sqlite:///path/to/file or redis://host:port/db')
+        parser.add_argument(
+            '--worker',
+            default=f'{socket.gethostname()}-{os.getpid()}',
+            help='Name of this worker, unique across the race. '
+                 'Defaults to hostname and process id')
+        parser.add_argument(
+            '--wait',
+            type=float,
+            default=30,
+            help='Max seconds to wait for the race to be started. '
+                 'Defaults to 30')
+        # Lease options
+        parser.add_argument(
+            '--lease_size',
+            type=int,
+            default=100,
+            help='Number of URLs leased at once. Defaults to 100')
+        parser.add_argument(
+            '--lease_ttl',
+            type=float,
+            default=60,
+            help='Seconds before URLs leased by this worker are handed over '
+                 'to others if it goes silent. Defaults to 60')
+        parser.add_argument(
+            '--flush_interval',
+            type=float,
+            default=1.0,
+            help='Seconds between two reports to the frontier. '
+                 'Defaults to 1.0')
+        # Driver options
+        parser.add_argument(
+            '--max_engines',
+            type=int,
+            default=10,
+            help='Max number of crawling engines to start. Defaults to 10')
+        parser.add_argument(
+            '--redirect_cache',
+            type=int,
+            default=10000,
+            help='Max number of redirect chains kept by the worker, so '
+                 'redirects to the same URLs are not followed again. '
+                 'Defaults to 10000')
+        parser.add_argument(
+            '--parse-workers',
+            type=int,
+            default=0,
+            help='Number of processes parsing HTML. Parsing happens in the '
+                 'event loop when 0. Defaults to 0')
+        parser.add_argument(
+            '--max_page_size',
+            type=int,
+            default=5 * 2 ** 10,
+            help='Max number of KB read from a page, the rest of it is '
+                 'ignored. Defaults to 5120')
+        parser.add_argument(
+            '--link_engine',
+            choices=sorted(drivers.LINK_ENGINES),
+            default='sax',
+            help='Extract links building a DOM of the page, or collecting '
+                 'hrefs from parser events. Defaults to sax')
+        parser.add_argument(
+            '--per_host_engines',
+            type=int,
+            default=None,
+            help='Max number of engines fetching from the same host at '
+                 'once. Defaults to max_engines')
+        parser.add_argument(
+            '--host_delay',
+            type=float,
+            default=0,
+            help='Min seconds between two requests to the same host. '
+                 'Defaults to 0')
+        parser.add_argument(
+            '--loop',
+            choices=transport.LOOPS,
+            default='auto',
+            help='Event loop of the worker. Defaults to auto, uvloop when '
+                 'installed')
+        parser.add_argument(
+            '--transport',
+            choices=transport.TRANSPORTS,
+            default='aiohttp',
+            help='HTTP client of the worker: aiohttp, or httpx over HTTP/2, '
+                 'which requires httpx and h2. Defaults to aiohttp')
+        parser.add_argument(
+            '--conn_limit',
+            type=int,
+            default=100,
+            help='Connection pool option. Max number of open connections, '
+                 '0 means no limit. Defaults to 100')
+        parser.add_argument(
+            '--http_cache',
+            default=None,
+            help='File caching page validators and links between races. '
+                 'Disabled by default')
+        parser.add_argument(
+            '--metrics_port',
+            type=int,
+            default=None,
+            help='Serve worker metrics in Prometheus format at /metrics on '
+                 'this port. Disabled by default')
+        parser.add_argument(
+            '--progress_interval',
+            type=float,
+            default=10,
+            help='Seconds between two race progress lines. Defaults to 10')
+
+    def handle(self, *args, **options):
+        try:
+            transport.check_transport(options['transport'])
+            transport.use_loop(options['loop'])
+        except ValueError as e:
+            raise CommandError(e)
+        try:
+            race_frontier = frontier.open_frontier(
+                options['frontier'], options['session_id'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        # Wait for the coordinator to start the race.
+        deadline = time.monotonic() + options['wait']
+        race = race_frontier.config()
+        while race is None:
+            if time.monotonic() > deadline:
+                raise CommandError(
+                    f"No race {options['session_id']} in "
+                    f"{options['frontier']}")
+            time.sleep(1)
+            race = race_frontier.config()
+
+        logger.warning(f"Joining race {options['session_id']} on "
+                       f"{race['root_url']} as {options['worker']}")
+        driver = distributed.FrontierDriver(
+            frontier=race_frontier,
+            worker=options['worker'],
+            lease_size=options['lease_size'],
+            lease_ttl=options['lease_ttl'],
+            flush_interval=options['flush_interval'],
+            root_url=race['root_url'],
+            expected_urls=options['lease_size'] * 10,
+            error_rate=None,
+            max_redirects=race['max_redirects'],
+            redirect_cache_size=options['redirect_cache'],
+            max_engines=options['max_engines'],
+            limit=race['limit'],
+            collect_all=race['collect_all'],
+            per_host_engines=options['per_host_engines'],
+            host_delay=options['host_delay'],
+            priority=scheduler.UrlPriority(race.get('priority', ())),
+            max_retries=race.get('max_retries', 3),
+            retry_backoff=race.get('retry_backoff', 1.0),
+            robots=race.get('robots', False),
+            connector_options={'limit': options['conn_limit']},
+            parse_workers=options['parse_workers'],
+            max_page_size=options['max_page_size'] * 2 ** 10,
+            link_engine=options['link_engine'],
+            canonicalize=canonical.Canonicalizer(
+                drop_params=race['drop_params'],
+                trailing_slash=race['trailing_slash'],
+            ),
+            http_cache=httpcache.HttpCache(options['http_cache'])
+            if options['http_cache'] else None,
+            metrics_port=options['metrics_port'],
+            progress_interval=options['progress_interval'],
+            transport=options['transport'],
+        )
+
+        loop = asyncio.get_event_loop()
+        try:
+            loop.run_until_complete(driver.drive())
+        finally:
+            race_frontier.close()
+        loop.close()
+        logger.warning(f"Race over, crawled {driver.crawled} URLs")
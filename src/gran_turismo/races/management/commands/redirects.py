@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from races import models
+
+
+class Command(BaseCommand):
+    help = ("List redirect chains followed in a racing session, slowest "
+            "first")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'session_id',
+            type=int,
+            help='Racing session to look into')
+        parser.add_argument(
+            '--min_hops',
+            type=int,
+            default=1,
+            help='Only list chains of at least this many redirects. '
+                 'Defaults to 1')
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=100,
+            help='Max number of chains listed. Defaults to 100')
+
+    def handle(self, *args, **options):
+        session = models.RacingSession.objects.filter(
+            pk=options['session_id']).first()
+        if session is None:
+            raise CommandError(f"No race {options['session_id']}")
+
+        url_field = 'url__url' if session.storage == 'compact' else 'url'
+        chains = (session.result_model.objects
+                  .filter(session_id=session.id)
+                  .exclude(redirects='')
+                  .order_by('-latency')
+                  .values_list(url_field, 'status_code', 'latency',
+                               'redirects')
+                  .iterator())
+        listed = 0
+        for url, status_code, latency, redirects in chains:
+            hops = redirects.split('\n')
+            if len(hops) < options['min_hops']:
+                continue
+            self.stdout.write('\t'.join(
+                [f"{latency}ms", f"{status_code} {url}"] + hops))
+            listed += 1
+            if listed >= options['limit']:
+                break
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from races import graph, models
+
+
+class Command(BaseCommand):
+    help = ("List pages linking to URLs of a racing session, from its link "
+            "graph")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'session_id',
+            type=int,
+            help='Racing session recorded with --graph_dir')
+        parser.add_argument(
+            'urls',
+            nargs='*',
+            metavar='URL',
+            help='URLs to look up. Defaults to every 4xx, 5xx or failed '
+                 'result of the session')
+
+    def handle(self, *args, **options):
+        session = models.RacingSession.objects.filter(
+            pk=options['session_id']).first()
+        if session is None:
+            raise CommandError(f"No race {options['session_id']}")
+        if not session.graph:
+            raise CommandError(f"Race {session.id} has no link graph")
+
+        urls = options['urls']
+        if not urls:
+            url_field = 'url__url' if session.storage == 'compact' else 'url'
+            urls = list(
+                session.result_model.objects
+                .filter(session_id=session.id)
+                .exclude(status_code__gte=200, status_code__lt=400)
+                .values_list(url_field, flat=True))
+
+        # One pass over the graph for all URLs.
+        for url, referrers in graph.session_referrers(session, urls).items():
+            for referrer in referrers:
+                self.stdout.write(f"{url}\t{referrer}")
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import os
+import signal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from races import runner, transport
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Run races queued from the admin or the runner API side by "
+            "side, streaming their progress")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--host',
+            default='127.0.0.1',
+            help='Interface to serve the runner API on. Defaults to '
+                 '127.0.0.1')
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=556,
+            help='Port to serve the runner API on. Defaults to 556')
+        parser.add_argument(
+            '--max_races',
+            type=int,
+            default=4,
+            help='Max number of races running at once. Defaults to 4')
+        parser.add_argument(
+            '--poll_interval',
+            type=float,
+            default=2.0,
+            help='Seconds between two looks for queued or cancelled races. '
+                 'Defaults to 2')
+        parser.add_argument(
+            '--event_interval',
+            type=float,
+            default=1.0,
+            help='Seconds between two progress events sent to watchers. '
+                 'Defaults to 1')
+        parser.add_argument(
+            '--token',
+            default=os.environ.get('RACE_RUNNER_TOKEN'),
+            help='Token API clients must send to use the API. Defaults to '
+                 '$RACE_RUNNER_TOKEN, races can only be queued and watched '
+                 'from the admin without one')
+        parser.add_argument(
+            '--loop',
+            choices=transport.LOOPS,
+            default='auto',
+            help='Event loop of the races. Defaults to auto, uvloop when '
+                 'installed')
+
+    def handle(self, *args, **options):
+        try:
+            loop_name = transport.use_loop(options['loop'])
+        except ValueError as e:
+            raise CommandError(e)
+        race_runner = runner.RaceRunner(
+            max_races=options['max_races'],
+            poll_interval=options['poll_interval'],
+            event_interval=options['event_interval'],
+            token=options['token'],
+        )
+        logger.warning(f"Running races on {loop_name}, API at "
+                       f"http://{options['host']}:{options['port']}"
+                       f"/runner/races")
+        loop = asyncio.get_event_loop()
+        serving = asyncio.ensure_future(
+            race_runner.serve(options['host'], options['port']))
+        # Containers are stopped with SIGTERM.
+        loop.add_signal_handler(signal.SIGTERM, serving.cancel)
+        try:
+            loop.run_until_complete(serving)
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            logger.warning("Stopping races")
+        finally:
+            serving.cancel()
+            loop.run_until_complete(race_runner.shutdown())
+            loop.close()
@@ -0,0 +1,37 @@
+import asyncio
+import logging
+
+from django.core.management.base import BaseCommand
+
+from races import resp
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Serve an in-memory, Redis-compatible stand-in for sharing a "
+            "frontier across nodes")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--host',
+            default='127.0.0.1',
+            help='Interface to listen on. Defaults to 127.0.0.1')
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=6379,
+            help='Port to listen on. Defaults to 6379')
+
+    def handle(self, *args, **options):
+        logger.warning(f"Serving frontier at redis://{options['host']}:"
+                       f"{options['port']}/0")
+        loop = asyncio.get_event_loop()
+        try:
+            loop.run_until_complete(resp.RespServer().serve(
+                options['host'], options['port']))
+        except KeyboardInterrupt:
+            logger.warning("Frontier server stopped")
+        finally:
+            loop.close()
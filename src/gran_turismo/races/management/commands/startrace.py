@@ -1,15 +1,46 @@
 from datetime import datetime
 import asyncio
 import logging
+import os
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from races import drivers, models, collector
+from races import (
+    canonical, checkpoint, dedup, distributed, drivers, frontier, graph,
+    httpcache, models, collector, scheduler, shards, transport,
+)
 
 
 logger = logging.getLogger(__name__)
 
 
+def parse_weights(priorities):
+    """
+    (glob pattern, weight) pairs of --priority PATTERN=WEIGHT options.
+    """
+    weights = []
+    for priority in priorities:
+        pattern, _, weight = priority.rpartition('=')
+        try:
+            weights.append((pattern, int(weight)))
+        except ValueError:
+            raise CommandError(f"Invalid --priority {priority}, "
+                               f"expected PATTERN=WEIGHT")
+    return weights
+
+
+def unchanged_since(root_url):
+    """
+    Starting time of the last finished race of root_url, None if there is
+    none. Pages of sitemaps not modified since are skipped.
+    """
+    return (models.RacingSession.objects
+            .filter(base_url=root_url, state='finished',
+                    starting_time__isnull=False)
+            .order_by('-starting_time')
+            .values_list('starting_time', flat=True).first())
+
+
 class Command(BaseCommand):
     help = "Start a crawling race"
 
@@ -21,24 +52,198 @@ class Command(BaseCommand):
             type=int,
             default=10,
             help='Max number of redirects to follow. Defaults to 10')
+        parser.add_argument(
+            '--redirect_cache',
+            type=int,
+            default=10000,
+            help='Max number of redirect chains kept in memory, so '
+                 'redirects to the same URLs are not followed again. 0 '
+                 'disables it. Defaults to 10000')
         parser.add_argument(
             '--max_engines',
             type=int,
             default=10,
             help='Max number of crawling engines to start. Defaults to 10')
-        # Bloom filter options
+        parser.add_argument(
+            '--min_engines',
+            type=int,
+            default=None,
+            help='Min number of engines fetching at once. When given, the '
+                 'number of engines adapts to latency and 429/5xx/timeout '
+                 'rate of the site, between min and max engines. '
+                 'Disabled by default')
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of processes sharing the race, each one with its '
+                 'own engines. Defaults to 1')
+        parser.add_argument(
+            '--parse-workers',
+            type=int,
+            default=0,
+            help='Number of processes parsing HTML for each worker. '
+                 'Parsing happens in the event loop when 0. Defaults to 0')
+        parser.add_argument(
+            '--parse-budget',
+            type=int,
+            default=None,
+            help='Max number of documents being parsed at once. Defaults '
+                 'to twice the parse workers')
+        parser.add_argument(
+            '--max_page_size',
+            type=int,
+            default=5120,
+            help='Max number of KB read from a page, the rest of it is '
+                 'ignored. Defaults to 5120')
+        parser.add_argument(
+            '--link_engine',
+            choices=sorted(drivers.LINK_ENGINES),
+            default='sax',
+            help='Extract links building a DOM of the page, or collecting '
+                 'hrefs from parser events. Defaults to sax')
+        parser.add_argument(
+            '--frontier',
+            default=None,
+            help='Coordinate a race crawled by workers (see joinrace) '
+                 'sharing this frontier: sqlite:///path/to/file or '
+                 'redis://host:port/db. Disabled by default')
+        # Politeness options
+        parser.add_argument(
+            '--per_host_engines',
+            type=int,
+            default=None,
+            help='Max number of engines fetching from the same host at '
+                 'once. Defaults to max_engines')
+        parser.add_argument(
+            '--host_delay',
+            type=float,
+            default=0,
+            help='Min seconds between two requests to the same host. '
+                 'Defaults to 0')
+        # Retry and priority options
+        parser.add_argument(
+            '--max_retries',
+            type=int,
+            default=3,
+            help='Max number of times a URL is fetched again after a '
+                 'timeout, a connection error, a 429 or a 502/503/504. '
+                 'Defaults to 3')
+        parser.add_argument(
+            '--retry_backoff',
+            type=float,
+            default=1.0,
+            help='Base seconds of the exponential backoff between retries, '
+                 'unless the site sends a Retry-After. Defaults to 1.0')
+        parser.add_argument(
+            '--priority',
+            action='append',
+            default=[],
+            metavar='PATTERN=WEIGHT',
+            help='Crawl URLs whose path and query match this glob pattern '
+                 'later, or earlier with a negative weight. URLs are '
+                 'crawled by depth plus weight of the first matching '
+                 'pattern. Can be repeated, e.g. --priority "*page=*=5"')
+        # Transport options
+        parser.add_argument(
+            '--loop',
+            choices=transport.LOOPS,
+            default='auto',
+            help='Event loop of the race. Defaults to auto, uvloop when '
+                 'installed')
+        parser.add_argument(
+            '--transport',
+            choices=transport.TRANSPORTS,
+            default='aiohttp',
+            help='HTTP client of the race: aiohttp, or httpx multiplexing '
+                 'requests to a host over a single HTTP/2 connection, '
+                 'which requires httpx and h2. Defaults to aiohttp')
+        # Connection pool options
+        parser.add_argument(
+            '--conn_limit',
+            type=int,
+            default=100,
+            help='Connection pool option. Max number of open connections, '
+                 '0 means no limit. Defaults to 100')
+        parser.add_argument(
+            '--conn_limit_per_host',
+            type=int,
+            default=0,
+            help='Connection pool option. Max number of open connections '
+                 'to the same host, 0 means no limit. Defaults to 0')
+        parser.add_argument(
+            '--ttl_dns_cache',
+            type=int,
+            default=10,
+            help='Connection pool option. Seconds DNS lookups are cached, '
+                 'the starting point being looked up ahead of the race. '
+                 '0 disables caching. Lookups go through aiodns when '
+                 'installed. Defaults to 10')
+        parser.add_argument(
+            '--keepalive_timeout',
+            type=float,
+            default=15,
+            help='Connection pool option. Seconds idle connections are '
+                 'kept alive. Defaults to 15')
+        # Seen-set options
+        parser.add_argument(
+            '--dedup',
+            choices=sorted(dedup.BACKENDS),
+            default='scalable',
+            help='Seen-set backend: fixed size bloom filter, scalable '
+                 'bloom filter, exact set of URL hashes or exact set kept '
+                 'in a memory-mapped file. Defaults to scalable')
+        parser.add_argument(
+            '--dedup_dir',
+            default=None,
+            help='Directory for memory-mapped seen-sets. Defaults to the '
+                 'system temporary directory')
         parser.add_argument(
             '--bf_expected_urls',
             type=int,
             default=1000,
-            help='Bloom filter option. Expected number of ' 
-                 'URLs in the bloom filter. Defaults to 1000')
+            help='Seen-set option. Expected number of URLs in the '
+                 'seen-set, bloom filter capacity. Defaults to 1000')
         parser.add_argument(
             '--bf_error_rate',
-            type=int,
+            type=float,
             default=0.001,
             help='Bloom filter option. Desired error rate '
                  'in false positives. Defaults to 0.001')
+        # URL canonicalization options
+        parser.add_argument(
+            '--drop_params',
+            default=','.join(canonical.DROP_PARAMS),
+            help='Comma separated glob patterns of query parameters '
+                 'dropped from URLs. Defaults to tracking and session '
+                 'parameters')
+        parser.add_argument(
+            '--trailing_slash',
+            choices=canonical.Canonicalizer.TRAILING_SLASH,
+            default='keep',
+            help='Keep, strip or add trailing slashes of URL paths. '
+                 'Defaults to keep')
+        # Seeding options
+        parser.add_argument(
+            '--robots',
+            action='store_true',
+            default=False,
+            help='Obey robots.txt rules of the starting point. Disabled by '
+                 'default')
+        parser.add_argument(
+            '--sitemap',
+            nargs='*',
+            default=None,
+            metavar='URL',
+            help='Seed the frontier with pages of sitemaps or sitemap '
+                 'indexes, gzipped or not. Without URLs, those listed in '
+                 'robots.txt or /sitemap.xml. Disabled by default')
+        parser.add_argument(
+            '--skip_unchanged',
+            action='store_true',
+            default=False,
+            help='Skip pages of sitemaps whose lastmod is older than the '
+                 'last finished race of the starting point')
         parser.add_argument(
             '--limit',
             type=int,
@@ -50,6 +255,99 @@ class Command(BaseCommand):
             default=False,
             help='By default GT only stores 4xx and 5xx URLs. Enabling '
                  'this flag it would also collect other URLs')
+        # Collector options
+        parser.add_argument(
+            '--batch_size',
+            type=int,
+            default=250,
+            help='Collector option. Number of results stored into DB '
+                 'at once, at first when batches are sized by '
+                 '--commit_target. Defaults to 250')
+        parser.add_argument(
+            '--flush_interval',
+            type=float,
+            default=5.0,
+            help='Collector option. Max seconds a result waits before '
+                 'being stored into DB. Defaults to 5.0')
+        parser.add_argument(
+            '--commit_target',
+            type=float,
+            default=0.5,
+            help='Collector option. Seconds storing a batch of results '
+                 'should take, batches growing or shrinking towards it. 0 '
+                 'keeps --batch_size. Defaults to 0.5')
+        parser.add_argument(
+            '--results_size',
+            type=int,
+            default=1000,
+            help='Collector option. Max number of results waiting to be '
+                 'stored. Engines slow down when it is reached. '
+                 'Defaults to 1000')
+        parser.add_argument(
+            '--storage',
+            choices=[name for name, _ in models.STORAGES],
+            default='full',
+            help='Collector option. Store full results, or compact ones '
+                 'with latency and depth, pointing to URLs stored once for '
+                 'all races. Defaults to full')
+        # HTTP cache options
+        parser.add_argument(
+            '--http_cache',
+            default=None,
+            help='File caching page validators and links between races, '
+                 'so unchanged pages are not downloaded again. Disabled '
+                 'by default')
+        parser.add_argument(
+            '--http_cache_size',
+            type=int,
+            default=256,
+            help='Max size of the HTTP cache in MB. Least recently used '
+                 'pages are evicted. Defaults to 256')
+        # Checkpoint options
+        parser.add_argument(
+            '--checkpoint-dir',
+            default=None,
+            help='Keep race state in this directory so the race can be '
+                 'resumed later. Disabled by default')
+        parser.add_argument(
+            '--checkpoint-interval',
+            type=int,
+            default=60,
+            help='Seconds between two checkpoints. Defaults to 60')
+        parser.add_argument(
+            '--resume',
+            type=int,
+            default=None,
+            metavar='SESSION_ID',
+            help='Resume the race of given session from its checkpoint. '
+                 'Requires --checkpoint-dir')
+        # Link graph options
+        parser.add_argument(
+            '--graph_dir',
+            default=None,
+            help='Record which pages link to which URLs into a link graph '
+                 'in this directory. Disabled by default')
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            default=False,
+            help='Only expand pages whose content changed since the last '
+                 'race of the starting point with a link graph, and links '
+                 'new to them. Results and links of pages not crawled '
+                 'again are carried over. Requires --graph_dir')
+        # Monitoring options
+        parser.add_argument(
+            '--metrics_port',
+            type=int,
+            default=None,
+            help='Serve race metrics in Prometheus format at /metrics on '
+                 'this port. With several workers, each one serves its own '
+                 'on consecutive ports. Disabled by default')
+        parser.add_argument(
+            '--progress_interval',
+            type=float,
+            default=10,
+            help='Seconds between two race progress lines. Defaults to 10')
 
     def handle(self, *args, **options):
         # Prepare logging
@@ -57,51 +355,246 @@ class Command(BaseCommand):
         if int(options['verbosity']) > 1:
             root_logger.setLevel(logging.DEBUG)
 
+        if options['resume'] and not options['checkpoint_dir']:
+            raise CommandError("--resume requires --checkpoint-dir")
+        if options['workers'] > 1 and options['checkpoint_dir']:
+            raise CommandError("--checkpoint-dir requires a single worker")
+        if options['frontier'] and (options['workers'] > 1
+                                    or options['checkpoint_dir']):
+            raise CommandError("--frontier already shares and keeps the "
+                               "race, drop --workers and --checkpoint-dir")
+        if options['skip_unchanged'] and options['sitemap'] is None:
+            raise CommandError("--skip_unchanged requires --sitemap")
+        if options['frontier'] and options['sitemap'] is not None:
+            raise CommandError("--sitemap cannot seed a --frontier race")
+        if options['graph_dir'] and (options['workers'] > 1
+                                     or options['frontier']
+                                     or options['resume']):
+            raise CommandError("--graph_dir requires a single worker and a "
+                               "new race")
+        if options['incremental'] and not options['graph_dir']:
+            raise CommandError("--incremental requires --graph_dir")
+        try:
+            transport.check_transport(options['transport'])
+            loop_name = transport.use_loop(options['loop'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        weights = parse_weights(options['priority'])
+        modified_since = None
+        if options['skip_unchanged']:
+            modified_since = unchanged_since(options['root_url'])
+            logger.warning(f"Skipping pages unchanged since {modified_since}")
+        driver_options = self.driver_options(
+            options, weights, modified_since)
+
         start = datetime.now()
         logger.warning("Starting at: {}".format(start))
 
+        # Store session, results stream into it during the race.
+        if options['resume']:
+            try:
+                session = models.RacingSession.objects.get(
+                    pk=options['resume'], base_url=options['root_url'])
+            except models.RacingSession.DoesNotExist:
+                raise CommandError(
+                    f"No race {options['resume']} for {options['root_url']}")
+            logger.warning(f"Resuming race {session.id}")
+            models.RacingSession.objects.filter(pk=session.id).update(
+                state='running')
+        else:
+            session = models.RacingSession.objects.create(
+                base_url=options["root_url"],
+                starting_time=start,
+                storage=options['storage'],
+                state='running',
+            )
+
+        race_checkpoint = None
+        if options['checkpoint_dir']:
+            race_checkpoint = checkpoint.Checkpoint(
+                os.path.join(options['checkpoint_dir'], str(session.id)))
+
+        race_graph = previous = None
+        if options['graph_dir']:
+            if options['incremental']:
+                previous = (models.RacingSession.objects
+                            .filter(base_url=options['root_url'],
+                                    state='finished')
+                            .exclude(graph='')
+                            .order_by('-starting_time').first())
+                if previous is None:
+                    logger.warning("No previous race with a link graph, "
+                                   "crawling everything")
+                else:
+                    logger.warning(f"Crawling what changed since race "
+                                   f"{previous.id}")
+            race_graph = graph.LinkGraph(
+                os.path.abspath(
+                    os.path.join(options['graph_dir'], str(session.id))),
+                graph.LinkGraph(previous.graph).load() if previous else None)
+            models.RacingSession.objects.filter(pk=session.id).update(
+                graph=race_graph.path)
+
         # Start the race
-        logger.warning("Starting event loop...")
+        logger.warning(f"Starting {loop_name} event loop...")
         loop = asyncio.get_event_loop()
         logger.warning("Calling the driver...")
-        driver = drivers.AsyncDriver(
-            root_url=options['root_url'],
-            expected_urls=options['bf_expected_urls'],
-            error_rate=options['bf_error_rate'],
-            max_redirects=options['max_redirects'],
-            max_engines=options['max_engines'],
-            limit=options['limit'],
-            collect_all=options['collect_all'],
+        if options['frontier']:
+            try:
+                race_frontier = frontier.open_frontier(
+                    options['frontier'], session.id)
+            except ValueError as e:
+                raise CommandError(e)
+            driver = distributed.Coordinator(
+                frontier=race_frontier,
+                root_url=options['root_url'],
+                options={
+                    'max_redirects': options['max_redirects'],
+                    'limit': options['limit'],
+                    'collect_all': options['collect_all'],
+                    'drop_params': driver_options['canonicalize'].drop_params,
+                    'trailing_slash': options['trailing_slash'],
+                    'priority': weights,
+                    'max_retries': options['max_retries'],
+                    'retry_backoff': options['retry_backoff'],
+                    'robots': options['robots'],
+                },
+                canonicalize=driver_options['canonicalize'],
+                results_size=options['results_size'],
+            )
+            logger.warning(f"Waiting for workers: manage.py joinrace "
+                           f"{session.id} --frontier {options['frontier']}")
+        elif options['workers'] > 1:
+            driver = shards.MultiProcessDriver(
+                workers=options['workers'], **driver_options)
+        else:
+            try:
+                driver = drivers.AsyncDriver(
+                    checkpoint=race_checkpoint,
+                    checkpoint_interval=options['checkpoint_interval'],
+                    graph=race_graph,
+                    **driver_options,
+                )
+            except ValueError as e:
+                raise CommandError(e)
+        results_collector = collector.Collector(
+            session_id=session.id,
+            results=driver.results,
+            batch_size=options['batch_size'],
+            flush_interval=options['flush_interval'],
+            storage=session.storage,
+            commit_target=options['commit_target'],
+            # URLs are checkpointed as crawled once their results are stored.
+            on_commit=race_checkpoint.stored if race_checkpoint else None,
         )
         logger.warning("3...2...1...GO!!!")
-        loop.run_until_complete(driver.drive())
+        try:
+            loop.run_until_complete(asyncio.gather(
+                driver.drive(), results_collector.collect()))
+        finally:
+            # Update session counters and rollups, even if the race did not
+            # finish.
+            end = datetime.now()
+            if race_checkpoint:
+                # Log URLs whose results were stored after the driver's
+                # last snapshot.
+                race_checkpoint.snapshot(driver)()
+            carried = 0
+            if previous is not None:
+                carried = collector.carry_over(
+                    previous, session.id, session.storage,
+                    race_graph.visited)
+            collector.store_session(session.id, driver, end)
 
         # Race completed
         logger.warning("Race ended!")
         loop.close()
-        end = datetime.now()
         logger.warning("Ending at: {}".format(end))
 
-        # Store session
-        session = models.RacingSession.objects.create(
-            base_url=options["root_url"],
-            starting_time=start,
-            ending_time=end,
-            successes=driver.twos,
-            redirects=driver.threes,
-            soft_errors=driver.fours,
-            hard_errors=driver.fives,
-            crawled=driver.crawled,
-        )
-        # Store results
-        collector.Collector(session.id, driver.results).collect()
-
         # Some extra stats
-        logger.warning("Elapsed time: {}".format((end-start)))
+        elapsed = end - start
+        logger.warning("Elapsed time: {}".format(elapsed))
+        logger.warning("Pages per second: {:.2f}".format(
+            driver.crawled / max(elapsed.total_seconds(), 1e-6)))
         logger.warning(f"Found {driver.twos} 2xx")
         logger.warning(f"Found {driver.threes} 3xx")
         logger.warning(f"Found {driver.fours} 4xx")
         logger.warning(f"Found {driver.fives} 5xx")
+        logger.warning(f"Failed {driver.failures} URLs")
         logger.warning(f"Crawled {driver.crawled} URLs")
+        logger.warning(f"Retried {driver.retries} times")
+        if options['http_cache']:
+            logger.warning(f"HTTP cache: {driver.cache_hits} hits, "
+                           f"{driver.cache_misses} misses")
+        logger.warning(f"Redirect cache: {driver.redirect_hits} hits, "
+                       f"{driver.redirect_misses} misses")
+        resolver = getattr(driver, 'resolver', None)
+        if resolver is not None:
+            logger.warning(f"DNS cache: {resolver.hits} hits, "
+                           f"{resolver.misses} misses")
+        if race_graph:
+            logger.warning(f"Link graph: {race_graph.unchanged} unchanged "
+                           f"pages, {race_graph.carried} pages and {carried} "
+                           f"results carried over")
+        logger.warning(f"Seen-set fill ratio: "
+                       f"{driver.seen_urls.fill_ratio:.3f}")
+        logger.warning(f"Seen-set false positive rate: "
+                       f"{driver.seen_urls.error_rate:.2g}")
+        concurrency = getattr(driver, 'concurrency', None)
+        if concurrency is not None and concurrency.history:
+            logger.warning("Concurrency over time: " + ", ".join(
+                f"{permits} engines at {seconds}s"
+                for seconds, permits in concurrency.history))
+        logger.warning(f"Collected {results_collector.collected} results, "
+                       f"{results_collector.rate:.0f} per second spent "
+                       f"writing")
 
-        
+    def driver_options(self, options, weights, modified_since=None):
+        """
+        AsyncDriver options of a race given command options.
+        """
+        return dict(
+            root_url=options['root_url'],
+            expected_urls=options['bf_expected_urls'],
+            error_rate=options['bf_error_rate'],
+            max_redirects=options['max_redirects'],
+            redirect_cache_size=options['redirect_cache'],
+            max_engines=options['max_engines'],
+            min_engines=options['min_engines'],
+            limit=options['limit'],
+            collect_all=options['collect_all'],
+            results_size=options['results_size'],
+            per_host_engines=options['per_host_engines'],
+            host_delay=options['host_delay'],
+            priority=scheduler.UrlPriority(weights),
+            max_retries=options['max_retries'],
+            retry_backoff=options['retry_backoff'],
+            connector_options={
+                'limit': options['conn_limit'],
+                'limit_per_host': options['conn_limit_per_host'],
+                'keepalive_timeout': options['keepalive_timeout'],
+            },
+            parse_workers=options['parse_workers'],
+            parse_budget=options['parse_budget'],
+            max_page_size=options['max_page_size'] * 2 ** 10,
+            link_engine=options['link_engine'],
+            dedup=options['dedup'],
+            dedup_path=options['dedup_dir'],
+            canonicalize=canonical.Canonicalizer(
+                drop_params=[param for param in
+                             options['drop_params'].split(',') if param],
+                trailing_slash=options['trailing_slash'],
+            ),
+            http_cache=httpcache.HttpCache(
+                options['http_cache'],
+                max_size=options['http_cache_size'] * 2 ** 20,
+            ) if options['http_cache'] else None,
+            metrics_port=options['metrics_port'],
+            progress_interval=options['progress_interval'],
+            robots=options['robots'],
+            sitemaps=options['sitemap'],
+            modified_since=modified_since,
+            transport=options['transport'],
+            dns_ttl=options['ttl_dns_cache'],
+        )
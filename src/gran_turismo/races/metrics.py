@@ -0,0 +1,124 @@
+"""
+metrics.py - Counters and histograms of a running race, in Prometheus format.
+"""
+from bisect import bisect_left
+
+from aiohttp import web
+
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+FAST_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+)
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    """
+    Distribution of observed values over fixed buckets, per label values.
+    Observing is a bisect and two additions.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        # Label values -> [bucket counts..., +Inf count, sum]
+        self.series = {}
+
+    def observe(self, value, labels=()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = []
+        for values, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                labels = format_labels(self.labels, values, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.labels, values)
+            lines.append(f'{self.name}_sum{labels} {series[-1]}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Callback:
+    """
+    Counter or gauge whose value is read when rendered, so keeping it up
+    to date costs nothing. With labels, function returns a dict mapping
+    label values to values.
+    """
+    def __init__(self, name, help, function, kind='gauge', labels=()):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.kind = kind
+        self.labels = tuple(labels)
+
+    def render(self):
+        if not self.labels:
+            return [f'{self.name} {self.function()}']
+        return [f'{self.name}{format_labels(self.labels, values)} {value}'
+                for values, value in sorted(self.function().items())]
+
+
+class Registry:
+    """
+    Metrics of a race, rendered in Prometheus text format.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        metric = Histogram(name, help, buckets, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def callback(self, name, help, function, kind='gauge', labels=()):
+        metric = Callback(name, help, function, kind, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+async def start_server(registry, port, host='0.0.0.0'):
+    """
+    Serve registry at /metrics on the running event loop. Returns the
+    runner, to be cleaned up when done.
+    """
+    async def handle(request):
+        return web.Response(
+            text=registry.render(),
+            content_type='text/plain',
+            charset='utf-8',
+            headers={'X-Content-Type-Options': 'nosniff'},
+        )
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,43 @@
+# Generated by Django 2.2.1 on 2026-10-18 09:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('races', '0002_racingsession_base_url'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='racingsession',
+            name='crawled',
+            field=models.PositiveIntegerField(default=0, verbose_name='Crawled'),
+        ),
+        migrations.AlterField(
+            model_name='racingsession',
+            name='ending_time',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Ending time'),
+        ),
+        migrations.AlterField(
+            model_name='racingsession',
+            name='hard_errors',
+            field=models.PositiveIntegerField(default=0, verbose_name='5xx'),
+        ),
+        migrations.AlterField(
+            model_name='racingsession',
+            name='redirects',
+            field=models.PositiveIntegerField(default=0, verbose_name='3xx'),
+        ),
+        migrations.AlterField(
+            model_name='racingsession',
+            name='soft_errors',
+            field=models.PositiveIntegerField(default=0, verbose_name='4xx'),
+        ),
+        migrations.AlterField(
+            model_name='racingsession',
+            name='successes',
+            field=models.PositiveIntegerField(default=0, verbose_name='2xx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.1 on 2026-10-18 09:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('races', '0003_racingsession_streaming'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='racingresult',
+            name='error',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='racingsession',
+            name='failures',
+            field=models.PositiveIntegerField(default=0, verbose_name='Failed'),
+        ),
+    ]
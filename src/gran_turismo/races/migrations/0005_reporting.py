@@ -0,0 +1,62 @@
+# Generated by Django 2.2.1 on 2026-10-18 09:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def rollup_sessions(apps, schema_editor):
+    RacingResult = apps.get_model('races', 'RacingResult')
+    RacingStatusCount = apps.get_model('races', 'RacingStatusCount')
+    counts = (RacingResult.objects.order_by()
+              .values_list('session_id', 'status_code')
+              .annotate(models.Count('id')))
+    RacingStatusCount.objects.bulk_create(
+        RacingStatusCount(session_id=session_id, status_code=status_code,
+                          results=results)
+        for session_id, status_code, results in counts.iterator())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('races', '0004_failures'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RacingStatusCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status_code', models.PositiveSmallIntegerField()),
+                ('results', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='racingsession',
+            name='base_url',
+            field=models.CharField(db_index=True, max_length=512, verbose_name='Starting point'),
+        ),
+        migrations.AddIndex(
+            model_name='racingresult',
+            index=models.Index(fields=['-session', '-status_code', 'url', '-id'], name='result_admin_order'),
+        ),
+        migrations.AddIndex(
+            model_name='racingresult',
+            index=models.Index(fields=['status_code', 'error'], name='result_status_error'),
+        ),
+        migrations.AlterField(
+            model_name='racingresult',
+            name='session',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='races.RacingSession'),
+        ),
+        migrations.AddField(
+            model_name='racingstatuscount',
+            name='session',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_counts', to='races.RacingSession'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='racingstatuscount',
+            unique_together={('session', 'status_code')},
+        ),
+        migrations.RunPython(rollup_sessions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 2.2.1 on 2026-10-18 09:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('races', '0005_reporting'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RacingUrl',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.BigIntegerField(unique=True)),
+                ('url', models.CharField(max_length=1024)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='racingsession',
+            name='storage',
+            field=models.CharField(choices=[('full', 'Full'), ('compact', 'Compact')], default='full', max_length=8),
+        ),
+        migrations.CreateModel(
+            name='CompactResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status_code', models.PositiveSmallIntegerField()),
+                ('latency', models.PositiveIntegerField(verbose_name='Latency (ms)')),
+                ('depth', models.PositiveSmallIntegerField()),
+                ('session', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='races.RacingSession')),
+                ('url', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, to='races.RacingUrl')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='compactresult',
+            index=models.Index(fields=['-session', 'url'], name='compact_session_url'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 2.2.1 on 2026-10-18 09:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('races', '0006_compact'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RacingDiff',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('before_ending', models.DateTimeField()),
+                ('after_ending', models.DateTimeField()),
+                ('new', models.PositiveIntegerField(default=0, verbose_name='New errors')),
+                ('fixed', models.PositiveIntegerField(default=0, verbose_name='Fixed errors')),
+                ('changed', models.PositiveIntegerField(default=0, verbose_name='Changed status')),
+                ('after', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='races.RacingSession')),
+                ('before', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='races.RacingSession')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RacingDiffEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(max_length=1024)),
+                ('kind', models.CharField(choices=[('new', 'New error'), ('fixed', 'Fixed error'), ('changed', 'Changed status')], max_length=8)),
+                ('before_status', models.PositiveSmallIntegerField(null=True)),
+                ('after_status', models.PositiveSmallIntegerField(null=True)),
+                ('diff', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='races.RacingDiff')),
+            ],
+            options={
+                'verbose_name_plural': 'racing diff entries',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='racingdiffentry',
+            index=models.Index(fields=['-diff', 'kind', 'url', '-id'], name='diff_kind_url'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='racingdiff',
+            unique_together={('before', 'after')},
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.1 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('races', '0007_diffs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='racingsession',
+            name='arguments',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='racingsession',
+            name='state',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('cancelling', 'Cancelling'), ('cancelled', 'Cancelled'), ('finished', 'Finished'), ('failed', 'Failed')], default='finished', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='racingsession',
+            name='starting_time',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Starting time'),
+        ),
+    ]
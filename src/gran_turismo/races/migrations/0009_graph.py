@@ -0,0 +1,18 @@
+# Generated by Django 2.2.1 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('races', '0008_runner'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='racingsession',
+            name='graph',
+            field=models.CharField(blank=True, default='', max_length=512),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.1 on 2026-10-18 10:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('races', '0009_graph'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compactresult',
+            name='redirects',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='racingresult',
+            name='latency',
+            field=models.PositiveIntegerField(default=0, verbose_name='Latency (ms)'),
+        ),
+        migrations.AddField(
+            model_name='racingresult',
+            name='redirects',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -1,23 +1,223 @@
-from django.db import models
+from hashlib import blake2b
+
+from django.db import models, transaction
+
+
+# Where results of a racing session are stored: RacingResult rows, or
+# CompactResult rows pointing to interned RacingUrl rows.
+STORAGES = (
+    ('full', 'Full'),
+    ('compact', 'Compact'),
+)
+
+# Lifecycle of a racing session. Races run by the race runner are queued
+# first, and can be cancelled, see runner.py.
+RACE_STATES = (
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('cancelling', 'Cancelling'),
+    ('cancelled', 'Cancelled'),
+    ('finished', 'Finished'),
+    ('failed', 'Failed'),
+)
 
 
 class RacingSession(models.Model):
 
-    base_url = models.CharField(max_length=512, verbose_name="Starting point")
-    starting_time = models.DateTimeField(verbose_name='Starting time')
-    ending_time = models.DateTimeField(verbose_name='Ending time')
-    successes = models.PositiveIntegerField(verbose_name='2xx')
-    redirects = models.PositiveIntegerField(verbose_name='3xx')
-    soft_errors = models.PositiveIntegerField(verbose_name='4xx')
-    hard_errors = models.PositiveIntegerField(verbose_name='5xx')
-    crawled = models.PositiveIntegerField(verbose_name='Crawled')
+    base_url = models.CharField(
+        max_length=512, db_index=True, verbose_name="Starting point")
+    starting_time = models.DateTimeField(
+        null=True, blank=True, verbose_name='Starting time')
+    ending_time = models.DateTimeField(
+        null=True, blank=True, verbose_name='Ending time')
+    successes = models.PositiveIntegerField(default=0, verbose_name='2xx')
+    redirects = models.PositiveIntegerField(default=0, verbose_name='3xx')
+    soft_errors = models.PositiveIntegerField(default=0, verbose_name='4xx')
+    hard_errors = models.PositiveIntegerField(default=0, verbose_name='5xx')
+    failures = models.PositiveIntegerField(default=0, verbose_name='Failed')
+    crawled = models.PositiveIntegerField(default=0, verbose_name='Crawled')
+    storage = models.CharField(
+        max_length=8, choices=STORAGES, default='full')
+    state = models.CharField(
+        max_length=10, choices=RACE_STATES, default='finished')
+    # startrace options of races queued for the race runner
+    arguments = models.TextField(blank=True, default='')
+    # Directory of the link graph of the race, see graph.py
+    graph = models.CharField(max_length=512, blank=True, default='')
 
     def __str__(self):
         return self.base_url
 
+    @property
+    def result_model(self):
+        return CompactResult if self.storage == 'compact' else RacingResult
+
 
 class RacingResult(models.Model):
 
-    session = models.ForeignKey(RacingSession, on_delete=models.CASCADE)
+    # Indexed first thing by the indexes below.
+    session = models.ForeignKey(
+        RacingSession, on_delete=models.CASCADE, db_index=False)
     url = models.CharField(max_length=1024)
+    # 0 when the URL failed without a response, see error.
+    status_code = models.PositiveSmallIntegerField()
+    error = models.CharField(max_length=32, blank=True, default='')
+    # Including redirects followed from the URL.
+    latency = models.PositiveIntegerField(
+        default=0, verbose_name='Latency (ms)')
+    # Hops followed from the URL, one 'status_code url' line each.
+    redirects = models.TextField(blank=True, default='')
+
+    def referrers(self):
+        """
+        URLs of pages linking to this result, from the link graph of its
+        session.
+        """
+        from .graph import session_referrers
+        return session_referrers(self.session, [self.url])[self.url]
+
+    class Meta:
+        indexes = [
+            # Admin ordering, and session or status code filters
+            models.Index(
+                fields=['-session', '-status_code', 'url', '-id'],
+                name='result_admin_order'),
+            models.Index(
+                fields=['status_code', 'error'], name='result_status_error'),
+        ]
+
+
+class RacingStatusCount(models.Model):
+    """
+    Number of results of a racing session by status code, rolled up when
+    the race ends so reports never count results.
+    """
+
+    session = models.ForeignKey(
+        RacingSession, on_delete=models.CASCADE, related_name='status_counts')
     status_code = models.PositiveSmallIntegerField()
+    results = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('session', 'status_code')]
+
+    @classmethod
+    def rollup(cls, session_id):
+        """
+        Count results of a racing session again, replacing its rollup.
+        """
+        session = RacingSession.objects.get(pk=session_id)
+        counts = (session.result_model.objects.filter(session_id=session_id)
+                  .order_by().values_list('status_code')
+                  .annotate(models.Count('id')))
+        with transaction.atomic():
+            cls.objects.filter(session_id=session_id).delete()
+            cls.objects.bulk_create(
+                cls(session_id=session_id, status_code=status_code,
+                    results=results)
+                for status_code, results in counts)
+
+
+class RacingUrl(models.Model):
+    """
+    URL stored once for all compact racing sessions, looked up by hash.
+    """
+
+    hash = models.BigIntegerField(unique=True)
+    url = models.CharField(max_length=1024)
+
+    def __str__(self):
+        return self.url
+
+    @staticmethod
+    def hash_url(url):
+        """
+        Signed 64 bits hash of url.
+        """
+        return int.from_bytes(
+            blake2b(url.encode('utf-8'), digest_size=8).digest(), 'big',
+            signed=True)
+
+
+class CompactResult(models.Model):
+    """
+    Result of a racing session with compact storage.
+    """
+
+    session = models.ForeignKey(
+        RacingSession, on_delete=models.CASCADE, db_index=False)
+    url = models.ForeignKey(
+        RacingUrl, on_delete=models.PROTECT, db_index=False)
+    # 0 when the URL failed without a response.
+    status_code = models.PositiveSmallIntegerField()
+    # Including redirects followed from the URL.
+    latency = models.PositiveIntegerField(verbose_name='Latency (ms)')
+    depth = models.PositiveSmallIntegerField()
+    # Hops followed from the URL, one 'status_code url' line each.
+    redirects = models.TextField(blank=True, default='')
+
+    def referrers(self):
+        """
+        URLs of pages linking to this result, from the link graph of its
+        session.
+        """
+        from .graph import session_referrers
+        return session_referrers(self.session, [self.url.url])[self.url.url]
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['-session', 'url'], name='compact_session_url'),
+        ]
+
+
+# Kinds of differences between two racing sessions
+DIFF_KINDS = (
+    ('new', 'New error'),
+    ('fixed', 'Fixed error'),
+    ('changed', 'Changed status'),
+)
+
+
+class RacingDiff(models.Model):
+    """
+    Differences between results of two racing sessions, see diff.py. Kept
+    until either session ends again.
+    """
+
+    before = models.ForeignKey(
+        RacingSession, on_delete=models.CASCADE, related_name='+')
+    after = models.ForeignKey(
+        RacingSession, on_delete=models.CASCADE, related_name='+')
+    # Ending times of sessions when compared.
+    before_ending = models.DateTimeField()
+    after_ending = models.DateTimeField()
+    new = models.PositiveIntegerField(default=0, verbose_name='New errors')
+    fixed = models.PositiveIntegerField(
+        default=0, verbose_name='Fixed errors')
+    changed = models.PositiveIntegerField(
+        default=0, verbose_name='Changed status')
+
+    class Meta:
+        unique_together = [('before', 'after')]
+
+    def __str__(self):
+        return f'{self.before_id} -> {self.after_id}'
+
+
+class RacingDiffEntry(models.Model):
+
+    diff = models.ForeignKey(
+        RacingDiff, on_delete=models.CASCADE, db_index=False)
+    url = models.CharField(max_length=1024)
+    kind = models.CharField(max_length=8, choices=DIFF_KINDS)
+    # None when the URL has no result in that session.
+    before_status = models.PositiveSmallIntegerField(null=True)
+    after_status = models.PositiveSmallIntegerField(null=True)
+
+    class Meta:
+        verbose_name_plural = 'racing diff entries'
+        indexes = [
+            models.Index(
+                fields=['-diff', 'kind', 'url', '-id'], name='diff_kind_url'),
+        ]
@@ -0,0 +1,315 @@
+"""
+resp.py - Just enough of the Redis protocol to share a frontier.
+
+RespClient talks to Redis or to RespServer, an in-memory stand-in serving
+the commands used by frontier.RedisFrontier for single-box runs.
+"""
+from asyncio import start_server
+from collections import deque
+from threading import Lock
+import socket
+
+
+class RespError(Exception):
+    """
+    Error reply of the server.
+    """
+
+
+def encode_command(args):
+    parts = [f'*{len(args)}\r\n'.encode()]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(f'${len(arg)}\r\n'.encode())
+        parts.append(arg + b'\r\n')
+    return b''.join(parts)
+
+
+class RespClient:
+    """
+    Blocking client for a Redis-compatible server, safe to share between
+    threads. Replies are decoded to str, int, list or None.
+
+    Init Attributes:
+        host            Server host.
+        port            Server port.
+        db              Database index.
+        timeout         Socket timeout in seconds.
+    """
+    def __init__(self, host='localhost', port=6379, db=0, timeout=30):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.timeout = timeout
+        self.lock = Lock()
+        # Connection is opened on first use, so the client can be handed
+        # to forked processes.
+        self.sock = None
+        self.reader = None
+
+    def connect(self):
+        self.sock = socket.create_connection(
+            (self.host, self.port), timeout=self.timeout)
+        self.reader = self.sock.makefile('rb')
+        if self.db:
+            self.send([('SELECT', self.db)])
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                self.reader.close()
+                self.sock.close()
+                self.sock = self.reader = None
+
+    def execute(self, *args):
+        """
+        Run a command and return its reply.
+        """
+        return self.pipeline([args])[0]
+
+    def pipeline(self, commands):
+        """
+        Send several commands at once and return their replies. The server
+        runs all of them even if we die before reading the replies.
+        """
+        with self.lock:
+            if self.sock is None:
+                self.connect()
+            try:
+                return self.send(commands)
+            except (OSError, EOFError):
+                self.sock.close()
+                self.sock = self.reader = None
+                raise
+
+    def send(self, commands):
+        self.sock.sendall(b''.join(encode_command(args) for args in commands))
+        replies = [self.read() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def read(self):
+        line = self.reader.readline()
+        if not line:
+            raise EOFError("Connection closed by server")
+        kind, value = line[:1], line[1:-2]
+        if kind == b'+':
+            return value.decode()
+        if kind == b'-':
+            return RespError(value.decode())
+        if kind == b':':
+            return int(value)
+        if kind == b'$':
+            size = int(value)
+            if size < 0:
+                return None
+            return self.reader.read(size + 2)[:-2].decode()
+        if kind == b'*':
+            size = int(value)
+            if size < 0:
+                return None
+            return [self.read() for _ in range(size)]
+        raise RespError(f"Unexpected reply: {line!r}")
+
+
+class RespServer:
+    """
+    In-memory stand-in for Redis, serving strings, hashes, sets, lists and
+    transactions. Commands run one at a time on the event loop, so each
+    of them, and every MULTI/EXEC block, is atomic. Nothing is persisted.
+    """
+    def __init__(self):
+        self.data = {}
+
+    async def serve(self, host='127.0.0.1', port=6379):
+        server = await start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        queued = None
+        try:
+            while True:
+                args = await self.read_command(reader)
+                if args is None:
+                    break
+                name = args[0].upper()
+                if name == 'MULTI':
+                    queued = []
+                    reply = 'OK'
+                elif name == 'EXEC':
+                    if queued is None:
+                        reply = RespError('ERR EXEC without MULTI')
+                    else:
+                        reply = [self.run(command) for command in queued]
+                        queued = None
+                elif name == 'DISCARD':
+                    queued = None
+                    reply = 'OK'
+                elif queued is not None:
+                    queued.append(args)
+                    reply = 'QUEUED'
+                else:
+                    reply = self.run(args)
+                writer.write(self.encode_reply(reply))
+                await writer.drain()
+        except (ConnectionError, EOFError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            # Inline command, e.g. typed through telnet.
+            return line.decode().split() or ['PING']
+        args = []
+        for _ in range(int(line[1:-2])):
+            size = int((await reader.readline())[1:-2])
+            args.append((await reader.readexactly(size + 2))[:-2].decode())
+        return args
+
+    def encode_reply(self, reply):
+        if reply is None:
+            return b'$-1\r\n'
+        if isinstance(reply, RespError):
+            return f'-{reply}\r\n'.encode()
+        if isinstance(reply, bool):
+            reply = int(reply)
+        if isinstance(reply, int):
+            return f':{reply}\r\n'.encode()
+        if isinstance(reply, list):
+            return (f'*{len(reply)}\r\n'.encode()
+                    + b''.join(self.encode_reply(item) for item in reply))
+        if reply in ('OK', 'QUEUED', 'PONG'):
+            return f'+{reply}\r\n'.encode()
+        value = str(reply).encode()
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def run(self, args):
+        command = getattr(self, 'cmd_' + args[0].lower(), None)
+        if command is None:
+            return RespError(f"ERR unknown command '{args[0]}'")
+        try:
+            return command(*args[1:])
+        except TypeError:
+            return RespError(
+                f"ERR wrong number of arguments for '{args[0]}' command")
+
+    def get(self, key, kind):
+        value = self.data.get(key)
+        if value is None:
+            value = self.data[key] = kind()
+        return value
+
+    def cleanup(self, key):
+        if not self.data.get(key):
+            self.data.pop(key, None)
+
+    # Connection
+    def cmd_ping(self, *args):
+        return 'PONG'
+
+    def cmd_select(self, db):
+        return 'OK'
+
+    # Keys and strings
+    def cmd_del(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def cmd_exists(self, *keys):
+        return sum(key in self.data for key in keys)
+
+    def cmd_get(self, key):
+        return self.data.get(key)
+
+    def cmd_set(self, key, value):
+        self.data[key] = value
+        return 'OK'
+
+    # Hashes
+    def cmd_hset(self, key, *pairs):
+        hash_ = self.get(key, dict)
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in hash_
+            hash_[field] = value
+        return added
+
+    def cmd_hdel(self, key, *fields):
+        hash_ = self.data.get(key, {})
+        removed = sum(hash_.pop(field, None) is not None for field in fields)
+        self.cleanup(key)
+        return removed
+
+    def cmd_hgetall(self, key):
+        return [item for pair in self.data.get(key, {}).items()
+                for item in pair]
+
+    def cmd_hincrby(self, key, field, increment):
+        hash_ = self.get(key, dict)
+        hash_[field] = str(int(hash_.get(field, 0)) + int(increment))
+        return int(hash_[field])
+
+    # Sets
+    def cmd_sadd(self, key, *members):
+        set_ = self.get(key, set)
+        before = len(set_)
+        set_.update(members)
+        return len(set_) - before
+
+    def cmd_sismember(self, key, member):
+        return member in self.data.get(key, ())
+
+    def cmd_scard(self, key):
+        return len(self.data.get(key, ()))
+
+    # Lists
+    def cmd_lpush(self, key, *values):
+        list_ = self.get(key, deque)
+        list_.extendleft(values)
+        return len(list_)
+
+    def cmd_rpush(self, key, *values):
+        list_ = self.get(key, deque)
+        list_.extend(values)
+        return len(list_)
+
+    def cmd_llen(self, key):
+        return len(self.data.get(key, ()))
+
+    def cmd_lrange(self, key, start, stop):
+        list_ = list(self.data.get(key, ()))
+        start, stop = int(start), int(stop)
+        stop = len(list_) if stop == -1 else stop + 1
+        return list_[start:stop]
+
+    def cmd_lrem(self, key, count, value):
+        list_ = self.data.get(key)
+        if not list_:
+            return 0
+        count = int(count)
+        kept, removed = deque(), 0
+        for item in list_:
+            # Direction of removal does not matter to us.
+            if item == value and (count == 0 or removed < abs(count)):
+                removed += 1
+            else:
+                kept.append(item)
+        self.data[key] = kept
+        self.cleanup(key)
+        return removed
+
+    def cmd_rpoplpush(self, source, destination):
+        list_ = self.data.get(source)
+        if not list_:
+            return None
+        value = list_.pop()
+        self.cleanup(source)
+        self.get(destination, deque).appendleft(value)
+        return value
@@ -0,0 +1,48 @@
+"""
+retries.py - Tell transient failures from permanent ones and space retries.
+"""
+from asyncio import TimeoutError
+import random
+
+import aiohttp
+
+
+# Statuses worth asking again a bit later.
+RETRY_STATUSES = frozenset((429, 502, 503, 504))
+
+
+# (exception class, error category, whether it is transient), most
+# specific classes first.
+ERRORS = (
+    (TimeoutError, 'timeout', True),
+    (aiohttp.ServerTimeoutError, 'timeout', True),
+    (aiohttp.ClientSSLError, 'ssl', False),
+    (aiohttp.ClientConnectorError, 'connection', True),
+    (aiohttp.ServerDisconnectedError, 'connection', True),
+    (aiohttp.ClientOSError, 'connection', True),
+    (aiohttp.ClientPayloadError, 'payload', True),
+    (aiohttp.InvalidURL, 'invalid_url', False),
+    (aiohttp.ClientResponseError, 'protocol', False),
+    (aiohttp.ClientError, 'client', False),
+    (UnicodeError, 'encoding', False),
+    (ValueError, 'invalid_url', False),
+)
+
+
+def classify_error(exc):
+    """
+    Error category of an exception raised while fetching, and whether
+    it is worth retrying.
+    """
+    for cls, category, transient in ERRORS:
+        if isinstance(exc, cls):
+            return category, transient
+    return 'other', False
+
+
+def backoff(attempt, base=1.0, maximum=60.0):
+    """
+    Seconds to wait before retry number attempt + 1: exponential backoff
+    with full jitter.
+    """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
@@ -0,0 +1,454 @@
+"""
+runner.py - Run queued races side by side on one event loop.
+
+Races are queued as racing sessions holding their startrace options, from
+the admin or the runner API. A RaceRunner claims them from DB and drives
+each one with its own AsyncDriver, so every race keeps its own engines,
+connection pool and limits. Progress is streamed to watchers as
+server-sent events.
+"""
+from asyncio import (
+    FIRST_EXCEPTION, Event, Task, TimeoutError, get_event_loop, wait,
+    wait_for,
+)
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import json
+import logging
+import shlex
+import time
+
+from aiohttp import web
+from django.core import signing
+from django.core.management.base import CommandError
+from django.db import connections
+from django.utils import timezone
+
+from . import collector, drivers, models, transport
+from .management.commands import startrace
+
+
+logger = logging.getLogger(__name__)
+
+
+# startrace options of races run by the runner must keep their defaults.
+UNSUPPORTED = (
+    ('workers', '--workers'),
+    ('frontier', '--frontier'),
+    ('checkpoint_dir', '--checkpoint-dir'),
+    ('resume', '--resume'),
+    ('metrics_port', '--metrics_port'),
+    ('graph_dir', '--graph_dir'),
+    # The event loop is the one of the runner, see runraces --loop.
+    ('loop', '--loop'),
+)
+
+# States of races which may still change.
+ACTIVE_STATES = ('queued', 'running', 'cancelling')
+
+# Salt of tokens letting admin pages watch a race, see watch_token().
+WATCH_SALT = 'races.runner.watch'
+
+
+def watch_token(session_id):
+    """
+    Token letting a browser, which cannot send the API token along with
+    server-sent events, watch the race of given session.
+    """
+    return signing.dumps(session_id, salt=WATCH_SALT)
+
+
+def refuse_exit(status=0, message=None):
+    """
+    Stand-in for ArgumentParser.exit(), which would end the process on
+    --help or --version.
+    """
+    raise CommandError(
+        message or "Options printing help or version cannot be used")
+
+
+def parse_arguments(root_url, arguments):
+    """
+    startrace options of a race given its command line arguments. Raises
+    CommandError when they are invalid or not supported by the runner.
+    """
+    if urlparse(root_url).scheme not in ('http', 'https'):
+        raise CommandError(f"Not an HTTP URL: {root_url}")
+    try:
+        args = shlex.split(arguments)
+    except ValueError as e:
+        raise CommandError(e)
+    parser = startrace.Command().create_parser('manage.py', 'startrace')
+    # Help and version actions print then exit, raise instead.
+    parser._print_message = lambda message, file=None: None
+    parser.exit = refuse_exit
+    options = vars(parser.parse_args([root_url] + args))
+    defaults = vars(parser.parse_args([root_url]))
+    for name, flag in UNSUPPORTED:
+        if options[name] != defaults[name]:
+            raise CommandError(f"Races run by the runner cannot use {flag}")
+    if options['skip_unchanged'] and options['sitemap'] is None:
+        raise CommandError("--skip_unchanged requires --sitemap")
+    startrace.parse_weights(options['priority'])
+    try:
+        transport.check_transport(options['transport'])
+    except ValueError as e:
+        raise CommandError(e)
+    return options
+
+
+def queue_race(root_url, arguments=''):
+    """
+    Queue a race for the runner. Returns its racing session.
+    """
+    options = parse_arguments(root_url, arguments)
+    return models.RacingSession.objects.create(
+        base_url=root_url,
+        state='queued',
+        storage=options['storage'],
+        arguments=arguments,
+    )
+
+
+def cancel_races(sessions):
+    """
+    Cancel queued races right away, and ask the runner to end running
+    ones. Returns the number of races cancelled.
+    """
+    cancelled = sessions.filter(state='queued').update(
+        state='cancelled', ending_time=timezone.now())
+    return cancelled + sessions.filter(state='running').update(
+        state='cancelling')
+
+
+def session_progress(session_id):
+    """
+    Progress of a race as last stored in DB, None if there is no such race.
+    """
+    session = models.RacingSession.objects.filter(pk=session_id).values(
+        'state', 'crawled', 'successes', 'redirects', 'soft_errors',
+        'hard_errors', 'failures').first()
+    if session is None:
+        return None
+    return {
+        'id': session_id,
+        'state': session['state'],
+        'crawled': session['crawled'],
+        'twos': session['successes'],
+        'threes': session['redirects'],
+        'fours': session['soft_errors'],
+        'fives': session['hard_errors'],
+        'failures': session['failures'],
+    }
+
+
+class Race:
+    """
+    A race driven by the runner.
+
+    Init Attributes:
+        session_id      Id of the RacingSession of the race.
+        driver          AsyncDriver of the race.
+        collector       Collector storing its results.
+    """
+    def __init__(self, session_id, driver, collector):
+        self.session_id = session_id
+        self.driver = driver
+        self.collector = collector
+        self.cancelled = False
+        self.started = time.monotonic()
+        self.task = None
+
+    def cancel(self):
+        self.cancelled = True
+        self.driver.stop()
+
+    def progress(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            'id': self.session_id,
+            'state': 'cancelling' if self.cancelled else 'running',
+            'crawled': self.driver.crawled,
+            'remaining': self.driver.remaining,
+            'twos': self.driver.twos,
+            'threes': self.driver.threes,
+            'fours': self.driver.fours,
+            'fives': self.driver.fives,
+            'failures': self.driver.failures,
+            'retries': self.driver.retries,
+            'collected': self.collector.collected,
+            'elapsed': round(elapsed, 1),
+            'rate': round(self.driver.crawled / max(elapsed, 1e-6), 2),
+        }
+
+
+class RaceRunner:
+    """
+    Service running queued races at once on the current event loop, and
+    serving an HTTP API to queue, cancel and watch them.
+
+    Init Attributes:
+        max_races       Max number of races running at once, others wait
+                        in the queue.
+        poll_interval   Seconds between two looks at DB for queued and
+                        cancelled races.
+        event_interval  Seconds between two progress events sent to
+                        watchers.
+        token           Token API clients must send as a Bearer
+                        Authorization header to queue or cancel races.
+                        Only the admin can when None.
+    """
+    def __init__(self, max_races=4, poll_interval=2.0, event_interval=1.0,
+                 token=None):
+        self.max_races = max_races
+        self.poll_interval = poll_interval
+        self.event_interval = event_interval
+        self.token = token
+
+        # Races running, by session id
+        self.races = {}
+
+        # A single DB thread, as collectors do.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.wakeup = Event()
+        self.app_runner = None
+
+    async def db(self, function, *args):
+        return await get_event_loop().run_in_executor(
+            self.executor, function, *args)
+
+    async def serve(self, host, port):
+        """
+        Serve the API, then start queued races until stopped.
+        """
+        app = web.Application()
+        app.router.add_get('/runner/races', self.list_races)
+        app.router.add_post('/runner/races', self.queue_race)
+        app.router.add_post(
+            '/runner/races/{race_id:\\d+}/cancel', self.cancel_race)
+        app.router.add_get(
+            '/runner/races/{race_id:\\d+}/events', self.race_events)
+        self.app_runner = web.AppRunner(app, access_log=None)
+        await self.app_runner.setup()
+        await web.TCPSite(self.app_runner, host, port).start()
+
+        while True:
+            await self.poll()
+            try:
+                await wait_for(self.wakeup.wait(), self.poll_interval)
+            except TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    async def poll(self):
+        """
+        Start queued races if there is room, end cancelled ones.
+        """
+        claimed, cancelling = await self.db(
+            self.claim, self.max_races - len(self.races), list(self.races))
+        for session_id in cancelling:
+            logger.warning(f"Cancelling race {session_id}")
+            self.races[session_id].cancel()
+        for session in claimed:
+            await self.start(session)
+
+    def claim(self, free, running):
+        """
+        Take up to free queued races, and find running ones cancelled.
+        Runs in the DB thread.
+        """
+        cancelling = [
+            session_id for session_id in models.RacingSession.objects
+            .filter(pk__in=running, state='cancelling')
+            .values_list('id', flat=True)
+            if not self.races[session_id].cancelled]
+        claimed = []
+        if free > 0:
+            queued = (models.RacingSession.objects.filter(state='queued')
+                      .order_by('id')[:free])
+            for session in queued:
+                # Another runner may have taken it meanwhile.
+                if models.RacingSession.objects.filter(
+                        pk=session.id, state='queued').update(
+                            state='running', starting_time=timezone.now()):
+                    claimed.append(session)
+        return claimed, cancelling
+
+    async def start(self, session):
+        command = startrace.Command()
+        try:
+            options = parse_arguments(session.base_url, session.arguments)
+            modified_since = None
+            if options['skip_unchanged']:
+                modified_since = await self.db(
+                    startrace.unchanged_since, session.base_url)
+            driver = drivers.AsyncDriver(**command.driver_options(
+                options, startrace.parse_weights(options['priority']),
+                modified_since))
+        except Exception as e:
+            # e.g. a seen-set directory missing, the runner goes on.
+            logger.warning(f"Race {session.id} cannot start: {e!r}")
+            await self.db(self.fail, session.id)
+            return
+        logger.warning(f"Starting race {session.id} at {session.base_url}")
+        race = Race(session.id, driver, collector.Collector(
+            session_id=session.id,
+            results=driver.results,
+            batch_size=options['batch_size'],
+            flush_interval=options['flush_interval'],
+            storage=session.storage,
+            commit_target=options['commit_target'],
+        ))
+        race.task = Task(self.race(race))
+        self.races[session.id] = race
+
+    @staticmethod
+    def fail(session_id):
+        models.RacingSession.objects.filter(pk=session_id).update(
+            state='failed', ending_time=timezone.now())
+
+    async def race(self, race):
+        """
+        Drive a race and collect its results, then store how it went. A
+        race failing in any way is marked failed and makes room for others.
+        """
+        collecting = Task(race.collector.collect())
+        driving = Task(race.driver.drive())
+        state = 'failed'
+        try:
+            await wait([driving, collecting], return_when=FIRST_EXCEPTION)
+            if not driving.done():
+                # Collector failed, the driver would wait for it forever.
+                driving.cancel()
+                await collecting
+            try:
+                driving.result()
+            except Exception as e:
+                logger.warning(f"Race {race.session_id} failed: {e!r}")
+                # Let the collector store what came so far.
+                await race.driver.results.put(None)
+            else:
+                state = 'cancelled' if race.cancelled else 'finished'
+            await collecting
+            await self.db(collector.store_session, race.session_id,
+                          race.driver, timezone.now(), state)
+        except Exception as e:
+            logger.warning(f"Race {race.session_id} failed: {e!r}")
+            state = 'failed'
+            await self.db(self.fail, race.session_id)
+        finally:
+            driving.cancel()
+            collecting.cancel()
+            # Engines of a driver which did not finish are still running,
+            # and its HTTP session is still open.
+            for engine in race.driver.engines:
+                engine.cancel()
+            if race.driver.session is not None:
+                await race.driver.session.close()
+            del self.races[race.session_id]
+            # Make room for queued races right away, and let watchers
+            # know it ended.
+            self.wakeup.set()
+        logger.warning(f"Race {race.session_id} {state}, crawled "
+                       f"{race.driver.crawled} URLs")
+
+    async def shutdown(self):
+        """
+        End running races, storing what they did, and stop serving.
+        """
+        for race in self.races.values():
+            race.cancel()
+        if self.races:
+            await wait([race.task for race in self.races.values()])
+        if self.app_runner:
+            await self.app_runner.cleanup()
+        await self.db(connections.close_all)
+        self.executor.shutdown()
+
+    def authorize(self, request, session_id=None):
+        """
+        Raise HTTPForbidden unless request carries the API token, or a
+        watch token of session_id when given.
+        """
+        if session_id is not None and 'watch' in request.query:
+            try:
+                if signing.loads(request.query['watch'],
+                                 salt=WATCH_SALT) == session_id:
+                    return
+            except signing.BadSignature:
+                pass
+        if self.token is None or request.headers.get(
+                'Authorization') != f'Bearer {self.token}':
+            raise web.HTTPForbidden(text='Invalid or missing token\n')
+
+    async def list_races(self, request):
+        """
+        Progress of running races, and ids of queued ones.
+        """
+        self.authorize(request)
+        queued = await self.db(lambda: list(
+            models.RacingSession.objects.filter(state='queued')
+            .order_by('id').values_list('id', flat=True)))
+        return web.json_response({
+            'running': [race.progress() for race in self.races.values()],
+            'queued': queued,
+        })
+
+    async def queue_race(self, request):
+        """
+        Queue a race given JSON {"root_url": ..., "arguments": ...}, the
+        latter being startrace options as on the command line.
+        """
+        self.authorize(request)
+        try:
+            body = await request.json()
+            session = await self.db(
+                queue_race, body['root_url'], body.get('arguments', ''))
+        except (ValueError, KeyError, TypeError, CommandError) as e:
+            raise web.HTTPBadRequest(text=f'{e}\n')
+        self.wakeup.set()
+        return web.json_response({'id': session.id}, status=201)
+
+    async def cancel_race(self, request):
+        self.authorize(request)
+        session_id = int(request.match_info['race_id'])
+        cancelled = await self.db(lambda: cancel_races(
+            models.RacingSession.objects.filter(pk=session_id)))
+        if not cancelled:
+            raise web.HTTPConflict(text='No such race queued or running\n')
+        self.wakeup.set()
+        return web.json_response({'id': session_id})
+
+    async def race_events(self, request):
+        """
+        Stream progress of a race as server-sent events, until it ends.
+        """
+        session_id = int(request.match_info['race_id'])
+        self.authorize(request, session_id)
+        progress = await self.progress(session_id)
+        if progress is None:
+            raise web.HTTPNotFound()
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            # Tell nginx not to buffer events.
+            'X-Accel-Buffering': 'no',
+        })
+        await response.prepare(request)
+        while progress['state'] in ACTIVE_STATES:
+            await response.write(
+                f"data: {json.dumps(progress)}\n\n".encode('utf-8'))
+            try:
+                await wait_for(self.wakeup.wait(), self.event_interval)
+            except TimeoutError:
+                pass
+            progress = await self.progress(session_id)
+        await response.write(
+            f"event: end\ndata: {json.dumps(progress)}\n\n".encode('utf-8'))
+        return response
+
+    async def progress(self, session_id):
+        race = self.races.get(session_id)
+        if race is not None:
+            return race.progress()
+        return await self.db(session_progress, session_id)
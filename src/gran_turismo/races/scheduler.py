@@ -0,0 +1,235 @@
+"""
+scheduler.py - Decide which URL engines should fetch next.
+"""
+from asyncio import Event, TimeoutError, get_event_loop, wait_for
+from fnmatch import translate
+from heapq import heappop, heappush
+from itertools import count
+from urllib.parse import urlparse, urlsplit
+import re
+
+from .arena import UrlArena
+
+
+# Ids of frontier items stay below it, see HostScheduler.push().
+ID_SPACE = 2 ** 40
+
+
+class UrlPriority:
+    """
+    Callable scoring URLs for the frontier, lowest first: depth of the URL
+    plus the weight of the first glob pattern matching its path and query,
+    e.g. ('*page=*', 5) to leave pagination for later.
+
+    Init Attributes:
+        weights         (glob pattern, weight) pairs.
+        depth_weight    Weight of every level of depth.
+    """
+    def __init__(self, weights=(), depth_weight=1):
+        self.patterns = [(re.compile(translate(pattern)), weight)
+                         for pattern, weight in weights]
+        self.depth_weight = depth_weight
+
+    def __call__(self, url, depth):
+        score = depth * self.depth_weight
+        if self.patterns:
+            parts = urlsplit(url)
+            target = parts.path + ('?' + parts.query if parts.query else '')
+            for regex, weight in self.patterns:
+                if regex.match(target):
+                    score += weight
+                    break
+        return score
+
+
+class Host:
+    """
+    Frontier and politeness state of a single host.
+    """
+    __slots__ = ('name', 'queue', 'in_flight', 'next_time', 'scheduled')
+
+    def __init__(self, name):
+        self.name = name
+        # Heap of priority * ID_SPACE + arena id of items
+        self.queue = []
+        self.in_flight = 0
+        self.next_time = 0
+        self.scheduled = False
+
+
+class HostScheduler:
+    """
+    Frontier keeping one priority queue per host. Engines are handed URLs
+    from hosts that have a free slot and have waited long enough since
+    their last request, so a shared pool of engines never hammers one
+    origin. Within a host, URLs with the lowest priority go first. Items
+    can also be delayed, e.g. for retries, until their time comes.
+
+    Mimics the asyncio.Queue interface used by the driver, except that
+    task_done() expects the URL of the finished item. Items are (url,
+    max_redirects, depth, attempt) tuples with integer priorities, kept
+    in an arena.UrlArena until handed out.
+
+    Init Attributes:
+        per_host        Maximum number of concurrent requests per host.
+        delay           Minimum seconds between two requests to the same
+                        host.
+    """
+
+    def __init__(self, per_host, delay=0):
+        self.per_host = per_host
+        self.delay = delay
+        self.hosts = {}
+        self.arena = UrlArena()
+
+        # Heap of (ready time, sequence, host) for hosts able to serve.
+        self.ready = []
+        self.sequence = count()
+
+        # Heap of (time, key, host name) for delayed items, see push().
+        self.delayed = []
+
+        # Engines waiting for something to fetch.
+        self.waiters = []
+
+        # Initialize progress counters
+        self.queued = 0
+        self.unfinished = 0
+        self.finished = Event()
+        self.finished.set()
+
+    def qsize(self):
+        return self.queued
+
+    def empty(self):
+        return not self.queued
+
+    def put_nowait(self, item, priority=0, delay=0):
+        """
+        Add an item to the frontier of its host. Delayed items are only
+        handed out after delay seconds.
+        """
+        self.queued += 1
+        self.unfinished += 1
+        self.finished.clear()
+        # Ids grow as items are added, so they order items of the same
+        # priority first in first out.
+        key = priority * ID_SPACE + self.arena.add(item)
+        name = urlparse(item[0]).netloc
+        if delay > 0:
+            when = get_event_loop().time() + delay
+            heappush(self.delayed, (when, key, name))
+            # Let a waiting engine know when to look again.
+            self.wakeup()
+        else:
+            self.push(key, name)
+
+    def push(self, key, name):
+        host = self.hosts.get(name)
+        if host is None:
+            host = self.hosts[name] = Host(name)
+        heappush(host.queue, key)
+        self.schedule(host)
+
+    async def get(self):
+        """
+        Wait for next item whose host is allowed to be requested.
+        """
+        loop = get_event_loop()
+        while True:
+            timeout = None
+            now = loop.time()
+            while self.delayed and self.delayed[0][0] <= now:
+                _, key, name = heappop(self.delayed)
+                self.push(key, name)
+            if self.delayed:
+                timeout = self.delayed[0][0] - now
+            if self.ready:
+                when, _, host = self.ready[0]
+                if when <= now:
+                    heappop(self.ready)
+                    if host.next_time > now:
+                        # Host was deferred since it was scheduled.
+                        heappush(self.ready, (
+                            host.next_time, next(self.sequence), host))
+                        continue
+                    host.scheduled = False
+                    host.in_flight += 1
+                    host.next_time = now + self.delay
+                    self.queued -= 1
+                    item = self.arena.pop(heappop(host.queue) % ID_SPACE)
+                    self.schedule(host)
+                    return item
+                timeout = when - now if timeout is None \
+                    else min(timeout, when - now)
+            await self.wait(loop, timeout)
+
+    def task_done(self, url):
+        """
+        Release the slot taken by url on its host.
+        """
+        host = self.hosts[urlparse(url).netloc]
+        host.in_flight -= 1
+        self.unfinished -= 1
+        if not self.unfinished:
+            self.finished.set()
+        self.schedule(host)
+
+    def defer(self, url, seconds):
+        """
+        Ask nothing more from the host of url for some seconds, e.g. as
+        told by a Retry-After header.
+        """
+        host = self.hosts.get(urlparse(url).netloc)
+        if host is not None:
+            host.next_time = max(
+                host.next_time, get_event_loop().time() + seconds)
+
+    async def join(self):
+        await self.finished.wait()
+
+    def clear(self):
+        """
+        Drop every item not handed out yet, delayed ones included. Returns
+        the number of items dropped.
+        """
+        dropped = self.queued
+        for host in self.hosts.values():
+            host.queue.clear()
+            host.scheduled = False
+        self.ready.clear()
+        self.delayed.clear()
+        self.arena.clear()
+        self.queued = 0
+        self.unfinished -= dropped
+        if not self.unfinished:
+            self.finished.set()
+        return dropped
+
+    def schedule(self, host):
+        """
+        Make host available to engines if it has work and a free slot.
+        """
+        if host.scheduled or not host.queue \
+                or host.in_flight >= self.per_host:
+            return
+        host.scheduled = True
+        heappush(self.ready, (host.next_time, next(self.sequence), host))
+        self.wakeup()
+
+    async def wait(self, loop, timeout):
+        waiter = loop.create_future()
+        self.waiters.append(waiter)
+        try:
+            await wait_for(waiter, timeout)
+        except TimeoutError:
+            pass
+        finally:
+            self.waiters.remove(waiter)
+
+    def wakeup(self):
+        # Each scheduled host can serve one engine, wake just one up.
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+                return
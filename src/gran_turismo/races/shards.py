@@ -0,0 +1,289 @@
+"""
+shards.py - Spread a race across several processes.
+
+Every process drives a shard of the race, owning the URLs whose hash
+falls into it along with their part of the seen-set. Links discovered by
+a shard but owned by another one are routed through its inbox.
+"""
+from asyncio import (
+    Queue, Task, gather, get_event_loop, new_event_loop, set_event_loop,
+    sleep,
+)
+from queue import Empty
+import multiprocessing
+import zlib
+
+from django.db import connections
+
+from .drivers import AsyncDriver
+
+
+COUNTERS = (
+    'twos', 'threes', 'fours', 'fives', 'failures', 'crawled', 'retries',
+    'cache_hits', 'cache_misses', 'redirect_hits', 'redirect_misses',
+)
+
+
+def owner(url, shards):
+    """
+    Index of the shard owning url.
+    """
+    return zlib.crc32(url.encode()) % shards
+
+
+class SeenStats:
+    """
+    Fill ratio and false positive rate of the fullest shard seen-set.
+    """
+    def __init__(self):
+        self.fill_ratio = 0
+        self.error_rate = 0
+
+    def merge(self, fill_ratio, error_rate):
+        self.fill_ratio = max(self.fill_ratio, fill_ratio)
+        self.error_rate = max(self.error_rate, error_rate)
+
+
+class ShardedDriver(AsyncDriver):
+    """
+    A crawling driver only fetching the URLs of its own shard.
+
+    Init Attributes:
+        index           Index of the shard driven.
+        inboxes         multiprocessing.Queue per shard, where URLs owned
+                        by that shard are routed to.
+        outstanding     multiprocessing.Value counting work not done yet
+                        across all shards. Race ends when it reaches zero.
+        flush_interval  Max seconds routed URLs wait before being sent.
+        Any other AsyncDriver option.
+    """
+    def __init__(self, index, inboxes, outstanding,
+                 flush_interval=0.05, **options):
+        if options.get('metrics_port') is not None:
+            # Every shard serves its own metrics.
+            options['metrics_port'] += index
+        super().__init__(**options)
+        self.index = index
+        # Sitemaps are seeded once, by the first shard.
+        if index:
+            self.sitemaps = None
+        self.inboxes = inboxes
+        self.outstanding = outstanding
+        self.flush_interval = flush_interval
+        self.outgoing = [[] for _ in inboxes]
+
+    def add_outstanding(self, value):
+        with self.outstanding.get_lock():
+            self.outstanding.value += value
+
+    def discover(self, url, max_redirects, depth=0):
+        """
+        Add URL to the frontier, or route it to the shard owning it.
+        """
+        shard = owner(url, len(self.inboxes))
+        if shard == self.index:
+            super().discover(url, max_redirects, depth)
+        else:
+            self.add_outstanding(1)
+            self.outgoing[shard].append((url, max_redirects, depth))
+
+    def claim(self, url, max_redirects, depth=0):
+        """
+        Claim redirect targets this shard owns, route others to their owner.
+        """
+        if owner(url, len(self.inboxes)) == self.index:
+            return super().claim(url, max_redirects, depth)
+        self.discover(url, max_redirects, depth)
+        return False
+
+    def enqueue(self, url, max_redirects, depth=0, attempt=0, delay=0):
+        self.add_outstanding(1)
+        super().enqueue(url, max_redirects, depth, attempt, delay)
+
+    def task_done(self, url):
+        super().task_done(url)
+        self.add_outstanding(-1)
+
+    async def drive(self):
+        routing = [Task(self.send()), Task(self.receive())]
+        try:
+            await super().drive()
+        finally:
+            for task in routing:
+                task.cancel()
+
+    async def finish_line(self):
+        """
+        Wait until all work is done in every shard.
+        """
+        # Give back the token every shard holds until it has started.
+        self.add_outstanding(-1)
+        while self.outstanding.value:
+            await sleep(self.flush_interval)
+
+    async def send(self):
+        """
+        Periodically route URLs owned by other shards.
+        """
+        while True:
+            await sleep(self.flush_interval)
+            for shard, items in enumerate(self.outgoing):
+                if items:
+                    self.inboxes[shard].put(items)
+                    self.outgoing[shard] = []
+
+    async def receive(self):
+        """
+        Add URLs routed by other shards to the frontier.
+        """
+        loop = get_event_loop()
+        inbox = self.inboxes[self.index]
+        while True:
+            items = await loop.run_in_executor(None, self.read, inbox)
+            for url, max_redirects, depth in items:
+                super().discover(url, max_redirects, depth)
+            self.add_outstanding(-len(items))
+
+    def read(self, inbox):
+        try:
+            return inbox.get(timeout=self.flush_interval)
+        except Empty:
+            return []
+
+    async def forward(self, outbox, batch_size=250):
+        """
+        Send results to the main process in batches.
+        """
+        loop = get_event_loop()
+        batch = []
+        while True:
+            result = await self.results.get()
+            if result is not None:
+                batch.append(result)
+            if batch and (result is None or len(batch) >= batch_size
+                          or self.results.empty()):
+                await loop.run_in_executor(None, outbox.put, batch)
+                batch = []
+            if result is None:
+                break
+
+
+def run_shard(index, inboxes, outbox, outstanding, options):
+    """
+    Entry point of a shard process. Reports its counters when done.
+    """
+    loop = new_event_loop()
+    set_event_loop(loop)
+    driver = ShardedDriver(index, inboxes, outstanding, **options)
+    loop.run_until_complete(gather(driver.drive(), driver.forward(outbox)))
+    loop.close()
+    report = {name: getattr(driver, name) for name in COUNTERS}
+    report['fill_ratio'] = driver.seen_urls.fill_ratio
+    report['error_rate'] = driver.seen_urls.error_rate
+    outbox.put(report)
+
+
+class MultiProcessDriver:
+    """
+    Runs a race across several forked processes, each one driving a shard
+    of it. Exposes results and counters like AsyncDriver does, merging
+    those of every shard.
+
+    Init Attributes:
+        workers         Number of processes.
+        results_size    Maximum number of results waiting to be collected.
+        limit           Limit number of crawled URLs across all shards.
+        Any other AsyncDriver option.
+    """
+    def __init__(self, workers, limit, results_size=1000, **options):
+        self.workers = workers
+        self.options = dict(
+            options,
+            limit=-(-limit // workers),
+            results_size=results_size,
+        )
+
+        # Initialize error counters
+        self.fives = 0
+        self.fours = 0
+        self.threes = 0
+        self.twos = 0
+        self.failures = 0
+
+        # Initialize retry counters
+        self.retries = 0
+
+        # Initialize progress counters
+        self.crawled = 0
+
+        # Initialize HTTP cache counters
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Initialize redirect cache counters
+        self.redirect_hits = 0
+        self.redirect_misses = 0
+
+        # Initialize results stream. A None item marks the end of the race.
+        self.results = Queue(maxsize=results_size)
+
+        # Initialize seen-set stats
+        self.seen_urls = SeenStats()
+
+    async def drive(self):
+        """
+        Start a process per shard until all of them are done.
+        """
+        context = multiprocessing.get_context('fork')
+        inboxes = [context.Queue() for _ in range(self.workers)]
+        outbox = context.Queue(maxsize=self.workers * 4)
+        # Each shard holds a token until started, so no shard can see
+        # the race over before every shard had a chance to seed it.
+        outstanding = context.Value('q', self.workers)
+
+        # Forked processes must not share DB connections.
+        connections.close_all()
+        processes = [
+            context.Process(
+                target=run_shard,
+                args=(index, inboxes, outbox, outstanding, self.options),
+            ) for index in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+
+        loop = get_event_loop()
+        running = self.workers
+        while running:
+            message = await loop.run_in_executor(
+                None, self.read, outbox, processes)
+            if isinstance(message, dict):
+                # A shard is over, merge its counters.
+                for name in COUNTERS:
+                    setattr(self, name, getattr(self, name) + message[name])
+                self.seen_urls.merge(
+                    message['fill_ratio'], message['error_rate'])
+                running -= 1
+            else:
+                for result in message:
+                    await self.results.put(result)
+
+        for process in processes:
+            process.join()
+
+        # Let the collector know that no more results are coming.
+        await self.results.put(None)
+
+    def read(self, outbox, processes):
+        """
+        Wait for next message of any shard, failing if one of them died.
+        """
+        while True:
+            try:
+                return outbox.get(timeout=1)
+            except Empty:
+                for process in processes:
+                    if process.exitcode:
+                        raise RuntimeError(
+                            f"Shard process died with exit code "
+                            f"{process.exitcode}")
@@ -0,0 +1,173 @@
+"""
+sitemaps.py - Seed races from robots.txt and sitemaps.
+
+robots.txt rules of the group matching the driver are compiled into a
+single regular expression, so checking a link is one match. Sitemaps and
+sitemap indexes, gzipped or not, are parsed with an lxml pull parser as
+chunks arrive: every entry is dropped from the tree once read, so memory
+stays flat whatever their size.
+"""
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+import re
+import zlib
+
+from lxml import etree
+
+
+# Product token of the driver matched against robots.txt user agents.
+ROBOTS_AGENT = 'granturismoracingdriver'
+
+# Max number of sitemaps read in a race, indexes included.
+MAX_SITEMAPS = 1000
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def rule_regex(path):
+    """
+    Regular expression of a robots.txt path, with * and $ wildcards.
+    """
+    end = path.endswith('$')
+    if end:
+        path = path[:-1]
+    regex = '.*'.join(re.escape(part) for part in path.split('*'))
+    return regex + ('\\Z' if end else '')
+
+
+class RobotsRules:
+    """
+    Allow and Disallow rules of a robots.txt applying to the driver, and
+    sitemaps it lists. The longest matching rule wins, Allow on ties.
+
+    Init Attributes:
+        text            Content of the robots.txt file.
+        agent           Product token looked up in User-agent lines. Falls
+                        back on rules for every agent (*) when absent.
+    """
+    def __init__(self, text='', agent=ROBOTS_AGENT):
+        self.sitemaps = []
+        groups = {}
+        agents = []
+        in_rules = False
+        for line in text.splitlines():
+            field, _, value = line.split('#', 1)[0].partition(':')
+            field = field.strip().lower()
+            value = value.strip()
+            if field == 'user-agent':
+                # Consecutive User-agent lines share the rules below.
+                if in_rules:
+                    agents = []
+                    in_rules = False
+                agents.append(value.lower())
+            elif field in ('allow', 'disallow'):
+                in_rules = True
+                # An empty Disallow allows everything.
+                if value:
+                    for name in agents:
+                        groups.setdefault(name, []).append(
+                            (field == 'allow', value))
+            elif field == 'sitemap' and value:
+                self.sitemaps.append(value)
+
+        rules = next((rules for name, rules in groups.items()
+                      if name not in ('', '*') and name in agent),
+                     groups.get('*', []))
+        # Alternatives are tried in order: longest rules first, Allow first
+        # among rules of the same length.
+        rules = sorted(rules, key=lambda rule: (-len(rule[1]), not rule[0]))
+        self.allows = [allow for allow, _ in rules]
+        self.matcher = re.compile('|'.join(
+            f'({rule_regex(path)})' for _, path in rules)) if rules else None
+
+    def allowed(self, url):
+        """
+        Whether rules let the driver fetch url.
+        """
+        if self.matcher is None:
+            return True
+        parts = urlparse(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        match = self.matcher.match(path)
+        return match is None or self.allows[match.lastindex - 1]
+
+
+def parse_lastmod(text):
+    """
+    Aware datetime of a W3C datetime, as found in lastmod tags. None when
+    it cannot be read.
+    """
+    text = (text or '').strip()
+    try:
+        if len(text) == 4:
+            value = datetime(int(text), 1, 1)
+        elif len(text) == 7:
+            value = datetime(int(text[:4]), int(text[5:]), 1)
+        else:
+            if text.endswith('Z'):
+                text = text[:-1] + '+00:00'
+            value = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+class SitemapParser:
+    """
+    Incremental parser of sitemaps and sitemap indexes. Feed it chunks of
+    the file, gzipped or not, and read (kind, loc, lastmod) entries back,
+    kind being 'url' for pages and 'sitemap' for nested sitemaps.
+    """
+    def __init__(self):
+        self.parser = etree.XMLPullParser(
+            events=('end',), resolve_entities=False, no_network=True,
+            huge_tree=True)
+        self.decompressor = None
+        self.started = False
+
+    def feed(self, chunk):
+        """
+        Feed a chunk of the file. Returns entries completed by it.
+        """
+        if not self.started:
+            self.started = True
+            if chunk[:2] == GZIP_MAGIC:
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self.decompressor is not None:
+            chunk = self.decompressor.decompress(chunk)
+        self.parser.feed(chunk)
+        return self.entries()
+
+    def close(self):
+        """
+        End the file. Returns entries left.
+        """
+        if self.decompressor is not None:
+            self.parser.feed(self.decompressor.flush())
+        self.parser.close()
+        return self.entries()
+
+    def entries(self):
+        entries = []
+        for _, element in self.parser.read_events():
+            kind = etree.QName(element).localname
+            if kind not in ('url', 'sitemap'):
+                continue
+            loc = lastmod = None
+            for child in element:
+                name = etree.QName(child).localname
+                if name == 'loc':
+                    loc = (child.text or '').strip()
+                elif name == 'lastmod':
+                    lastmod = parse_lastmod(child.text)
+            if loc:
+                entries.append((kind, loc, lastmod))
+            # Drop entries read so far from the tree.
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        return entries
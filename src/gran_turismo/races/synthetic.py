@@ -0,0 +1,148 @@
+"""
+synthetic.py - A local stand-in site to race against in benchmarks.
+"""
+from asyncio import new_event_loop, set_event_loop, sleep
+import multiprocessing
+import random
+import socket
+
+from aiohttp import web
+
+
+LATENCIES = ('fixed', 'uniform', 'exponential')
+
+
+class SyntheticSite:
+    """
+    Site with a random but reproducible link graph. Every page links to
+    fanout other pages; some of them redirect through a chain of 302s
+    before serving their content, and some fail with a 4xx or 5xx.
+
+    Pages are served from /p/{index}, redirect hops from /r/{index}/{hop}
+    and redirected content from /c/{index}.
+
+    Init Attributes:
+        pages           Number of pages.
+        fanout          Number of links on every page.
+        redirect_share  Share of pages redirecting to their content.
+        redirect_chain  Number of redirects before reaching the content.
+        client_errors   Share of pages answering 404.
+        server_errors   Share of pages answering 500.
+        latency         Mean seconds before answering a request.
+        latency_dist    Distribution of latency, one of LATENCIES.
+        page_size       Approximate size in bytes of every page.
+        seed            Seed of the link graph.
+    """
+    def __init__(self, pages=1000, fanout=10, redirect_share=0.05,
+                 redirect_chain=1, client_errors=0.02, server_errors=0.01,
+                 latency=0.0, latency_dist='fixed', page_size=4096, seed=0):
+        if latency_dist not in LATENCIES:
+            raise ValueError(f"Unknown latency distribution: {latency_dist}")
+        self.pages = pages
+        self.fanout = fanout
+        self.redirect_chain = redirect_chain
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.page_size = page_size
+        self.random = random.Random(seed)
+
+        # Decide the fate of every page up front. Page 0 is the root.
+        self.statuses = [200] * pages
+        for index in range(1, pages):
+            draw = self.random.random()
+            if draw < client_errors:
+                self.statuses[index] = 404
+            elif draw < client_errors + server_errors:
+                self.statuses[index] = 500
+            elif draw < client_errors + server_errors + redirect_share:
+                self.statuses[index] = 302
+        self.links = [
+            [self.random.randrange(pages) for _ in range(fanout)]
+            for _ in range(pages)
+        ]
+
+    def delay(self):
+        if self.latency_dist == 'uniform':
+            return self.random.uniform(0, 2 * self.latency)
+        if self.latency_dist == 'exponential':
+            return self.random.expovariate(1 / self.latency)
+        return self.latency
+
+    def render(self, index):
+        links = ''.join(f'<li><a href="/p/{link}">Page {link}</a></li>'
+                        for link in self.links[index])
+        html = (f'<html><head><title>Page {index}</title></head>'
+                f'<body><h1>Page {index}</h1><ul>{links}</ul>')
+        padding = max(0, self.page_size - len(html) - 20)
+        return f'{html}<p>{"x" * padding}</p></body></html>'
+
+    async def wait(self):
+        if self.latency:
+            await sleep(self.delay())
+
+    async def page(self, request):
+        index = int(request.match_info['index'])
+        await self.wait()
+        if index >= self.pages:
+            raise web.HTTPNotFound()
+        status = self.statuses[index]
+        if status == 302:
+            location = (f'/r/{index}/1' if self.redirect_chain > 1
+                        else f'/c/{index}')
+            raise web.HTTPFound(location)
+        if status != 200:
+            return web.Response(status=status, text='Nope')
+        return web.Response(text=self.render(index), content_type='text/html')
+
+    async def hop(self, request):
+        index = int(request.match_info['index'])
+        hop = int(request.match_info['hop'])
+        await self.wait()
+        if hop + 1 < self.redirect_chain:
+            raise web.HTTPFound(f'/r/{index}/{hop + 1}')
+        raise web.HTTPFound(f'/c/{index}')
+
+    async def content(self, request):
+        index = int(request.match_info['index'])
+        await self.wait()
+        if index >= self.pages:
+            raise web.HTTPNotFound()
+        return web.Response(text=self.render(index), content_type='text/html')
+
+    async def content_root(self, request):
+        await self.wait()
+        return web.Response(text=self.render(0), content_type='text/html')
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/', self.content_root)
+        app.router.add_get('/p/{index:\\d+}', self.page)
+        app.router.add_get('/r/{index:\\d+}/{hop:\\d+}', self.hop)
+        app.router.add_get('/c/{index:\\d+}', self.content)
+        return app
+
+    def serve(self, sock):
+        """
+        Serve the site on a listening socket until killed.
+        """
+        loop = new_event_loop()
+        set_event_loop(loop)
+        web.run_app(self.app(), sock=sock, print=None, handle_signals=True)
+
+    def start(self, host='127.0.0.1', port=0):
+        """
+        Serve the site in a forked process. Returns the process along with
+        the root URL of the site.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(1024)
+        host, port = sock.getsockname()[:2]
+
+        context = multiprocessing.get_context('fork')
+        process = context.Process(target=self.serve, args=(sock,))
+        process.daemon = True
+        process.start()
+        sock.close()
+        return process, f'http://{host}:{port}/'
@@ -1,3 +1,1351 @@
-from django.test import TestCase
+from asyncio import (
+    Event, Queue, TimeoutError, gather, new_event_loop, set_event_loop, sleep,
+    start_server)
+from itertools import count
+from threading import Thread
+from types import SimpleNamespace
+from unittest import mock
+import csv
+import gzip
+import logging
+import os
+import shutil
+import tempfile
 
-# Create your tests here.
+from aiohttp import ClientSession, InvalidURL, ServerDisconnectedError, web
+from aiohttp.test_utils import TestServer
+from django.contrib.auth.models import User
+from django.core.management.base import CommandError
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from . import (
+    changelist, checkpoint, collector, dedup, diff, drivers, export, httpcache,
+    metrics, models, runner, transport)
+from .arena import UrlArena
+from .canonical import Canonicalizer
+from .concurrency import AdaptiveConcurrency, retry_after
+from .drivers import AsyncDriver, LINK_ENGINES, extract_links
+from .frontier import RedisFrontier, SqliteFrontier
+from .resp import RespClient, RespServer
+from .retries import backoff, classify_error
+from .scheduler import HostScheduler, UrlPriority
+from .sitemaps import RobotsRules
+
+
+class LoopTestCase(TransactionTestCase):
+    """
+    Test case running coroutines on an event loop of its own, and races
+    against local sites served on it. Results are stored from the
+    collector thread, so transactions are not wrapped.
+    """
+
+    def setUp(self):
+        self.loop = new_event_loop()
+        set_event_loop(self.loop)
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            self.run_loop(server.close())
+        self.loop.close()
+
+    def run_loop(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def serve(self, routes):
+        """
+        Serve a site of (path, handler) routes. Returns its root URL.
+        """
+        app = web.Application()
+        for path, handler in routes:
+            app.router.add_get(path, handler)
+        server = TestServer(app, host='127.0.0.1')
+        self.run_loop(server.start_server())
+        self.servers.append(server)
+        return str(server.make_url('/'))
+
+    def race(self, root_url, **options):
+        """
+        Race against root_url until the end, collecting every result.
+        Returns the driver and its results by path.
+        """
+        driver = AsyncDriver(root_url, 1000, 0.001, 10, 4, 1000, True,
+                             **options)
+        results = {}
+
+        async def drain():
+            while True:
+                result = await driver.results.get()
+                if result is None:
+                    break
+                results[result[0][len(root_url) - 1:]] = result
+
+        # Failures are expected, keep them out of test output.
+        logging.disable(logging.WARNING)
+        try:
+            self.run_loop(gather(driver.drive(), drain()))
+        finally:
+            logging.disable(logging.NOTSET)
+        return driver, results
+
+
+def page(*links, headers=None):
+    """
+    Handler serving an HTML page linking to links.
+    """
+    async def handler(request):
+        anchors = ''.join(f'<a href="{link}">{link}</a>' for link in links)
+        return web.Response(
+            text=f'<html><body>{anchors}</body></html>',
+            content_type='text/html', headers=headers)
+    return handler
+
+
+def create_session(**fields):
+    fields.setdefault('ending_time', timezone.now())
+    return models.RacingSession.objects.create(
+        base_url='http://example.com/', starting_time=timezone.now(),
+        **fields)
+
+
+class CollectorTests(LoopTestCase):
+
+    def collect(self, results, delay=0, **options):
+        """
+        Feed results to a collector, ending the race after delay seconds.
+        Returns the session, the collector and the number of results
+        stored before the race ended.
+        """
+        session = create_session(storage=options.get('storage', 'full'))
+        queue = Queue()
+        options.setdefault('commit_target', 0)
+        writer = collector.Collector(session.id, queue, **options)
+
+        async def race():
+            for result in results:
+                queue.put_nowait(result)
+            await sleep(delay)
+            collected = writer.collected
+            queue.put_nowait(None)
+            return collected
+
+        collected, _ = self.run_loop(gather(race(), writer.collect()))
+        return session, writer, collected
+
+    def results(self, count, status_code=404):
+        return [(f'http://a/{index}', status_code, '', 0.0123, 1,
+                 '301 http://b/') for index in range(count)]
+
+    def test_batches(self):
+        with mock.patch.object(collector.Collector, 'write', autospec=True,
+                               side_effect=collector.Collector.write) \
+                as write:
+            session, writer, _ = self.collect(
+                self.results(25), batch_size=10)
+        self.assertEqual([len(call[0][1]) for call in write.call_args_list],
+                         [10, 10, 5])
+        self.assertEqual(writer.collected, 25)
+        self.assertEqual(set(models.RacingResult.objects.filter(
+            session=session).values_list('url', 'status_code')),
+            {(url, 404) for url, *_ in self.results(25)})
+        result = models.RacingResult.objects.get(
+            session=session, url='http://a/0')
+        self.assertEqual((result.latency, result.redirects),
+                         (12, '301 http://b/'))
+
+    def test_commits_reported(self):
+        batches = []
+        self.collect(self.results(5), batch_size=2,
+                     on_commit=batches.append)
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(batches[0][0], self.results(1)[0])
+
+    def test_flush_interval(self):
+        _, writer, collected = self.collect(
+            self.results(1, 500), delay=0.5, flush_interval=0.1)
+        self.assertEqual(collected, 1)
+
+    def test_compact_storage(self):
+        session, writer, _ = self.collect(
+            self.results(5) + self.results(5), batch_size=4,
+            storage='compact')
+        self.assertEqual(writer.collected, 10)
+        result = models.CompactResult.objects.filter(
+            session=session).first()
+        self.assertEqual((result.latency, result.depth), (12, 1))
+        self.assertEqual(models.CompactResult.objects.filter(
+            session=session).count(), 10)
+        self.assertEqual(models.RacingUrl.objects.count(), 5)
+
+    def test_batch_size_follows_commit_time(self):
+        writer = collector.Collector(1, None, batch_size=1000)
+        writer.resize(1000, 0.1)
+        self.assertEqual(writer.batch_size, 2000)
+        writer.resize(2000, 1.6)
+        self.assertEqual(writer.batch_size, 1000)
+        writer.resize(1000, 0.5)
+        self.assertEqual(writer.batch_size, 1000)
+        writer.resize(1000, 100)
+        self.assertEqual(writer.batch_size, 500)
+        writer.batch_size = collector.MIN_BATCH
+        writer.resize(collector.MIN_BATCH, 100)
+        self.assertEqual(writer.batch_size, collector.MIN_BATCH)
+        writer.batch_size = collector.MAX_BATCH
+        writer.resize(collector.MAX_BATCH, 0.01)
+        self.assertEqual(writer.batch_size, collector.MAX_BATCH)
+
+    def test_bulk_insert(self):
+        urls = ['http://a/', 'http://a/tab\there']
+        rows = [(models.RacingUrl.hash_url(url), url) for url in urls]
+        collector.bulk_insert(models.RacingUrl, ('hash', 'url'), rows[:1])
+        # Conflicting rows are skipped, others inserted.
+        collector.bulk_insert(models.RacingUrl, ('hash', 'url'), rows,
+                              ignore_conflicts=True)
+        self.assertEqual(sorted(models.RacingUrl.objects.values_list(
+            'url', flat=True)), urls)
+
+    def test_copy_line(self):
+        self.assertEqual(collector.copy_line((1, None, 'a\tb\\c\n')),
+                         '1\t\\N\ta\\tb\\\\c\\n\n')
+
+
+class CheckpointTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def driver(self):
+        """
+        Driver resuming from the checkpoint directory.
+        """
+        return AsyncDriver(
+            'http://a/', 1000, 0.001, 10, 1, 100, False,
+            checkpoint=checkpoint.Checkpoint(self.directory.name))
+
+    def test_resume_pending_urls_and_counters(self):
+        driver = self.driver()
+        for url in ('http://a/', 'http://a/b', 'http://a/c'):
+            driver.seen_urls.add(url)
+            driver.checkpoint.queue(url, 10)
+        driver.checkpoint.crawl('http://a/')
+        driver.crawled = driver.twos = 1
+        driver.checkpoint.snapshot(driver)()
+
+        resumed = self.driver()
+        self.assertEqual(resumed.pending,
+                         [('http://a/b', 10), ('http://a/c', 10)])
+        self.assertEqual((resumed.crawled, resumed.twos), (1, 1))
+        self.assertIn('http://a/c', resumed.seen_urls)
+        self.assertNotIn('http://a/d', resumed.seen_urls)
+
+    def test_snapshots_append(self):
+        driver = self.driver()
+        driver.checkpoint.queue('http://a/', 10)
+        driver.checkpoint.snapshot(driver)()
+        driver.checkpoint.queue('http://a/b', 9)
+        driver.checkpoint.crawl('http://a/')
+        driver.checkpoint.snapshot(driver)()
+        self.assertEqual(self.driver().pending, [('http://a/b', 9)])
+
+    def test_crawled_once_results_are_stored(self):
+        driver = self.driver()
+        driver.checkpoint.queue('http://a/', 10)
+        driver.checkpoint.queue('http://a/b', 10)
+        driver.checkpoint.collect('http://a/')
+        driver.checkpoint.crawl('http://a/')
+        driver.checkpoint.crawl('http://a/b')
+        driver.checkpoint.snapshot(driver)()
+        # Results of the root were not stored when the race died.
+        self.assertEqual(self.driver().pending, [('http://a/', 10)])
+
+        driver.checkpoint.stored([('http://a/', 404, '', 0.1, 0, '')])
+        driver.checkpoint.snapshot(driver)()
+        self.assertEqual(self.driver().pending, [])
+
+
+class HostSchedulerTests(LoopTestCase):
+
+    def take(self, scheduler, count):
+        """
+        URLs of the next count items handed out by scheduler.
+        """
+        async def take():
+            return [(await scheduler.get())[0] for _ in range(count)]
+        return self.run_loop(take())
+
+    def test_lowest_priority_first_then_first_in(self):
+        scheduler = HostScheduler(per_host=10)
+        scheduler.put_nowait(('http://a/3', 10, 2, 0), 2)
+        scheduler.put_nowait(('http://a/1', 10, 1, 0), 1)
+        scheduler.put_nowait(('http://a/2', 10, 1, 0), 1)
+        scheduler.put_nowait(('http://a/0', 10, 0, 0), 0)
+        self.assertEqual(self.take(scheduler, 4), [
+            'http://a/0', 'http://a/1', 'http://a/2', 'http://a/3'])
+        self.assertTrue(scheduler.empty())
+
+    def test_busy_host_waits_for_its_slot(self):
+        scheduler = HostScheduler(per_host=1)
+        scheduler.put_nowait(('http://a/1', 10, 0, 0))
+        scheduler.put_nowait(('http://a/2', 10, 0, 0))
+        scheduler.put_nowait(('http://b/1', 10, 0, 0))
+        self.assertEqual(self.take(scheduler, 2),
+                         ['http://a/1', 'http://b/1'])
+        scheduler.task_done('http://a/1')
+        self.assertEqual(self.take(scheduler, 1), ['http://a/2'])
+        scheduler.task_done('http://a/2')
+        self.assertFalse(scheduler.finished.is_set())
+        scheduler.task_done('http://b/1')
+        self.assertTrue(scheduler.finished.is_set())
+
+    def test_host_delay(self):
+        scheduler = HostScheduler(per_host=10, delay=0.2)
+        scheduler.put_nowait(('http://a/1', 10, 0, 0))
+        scheduler.put_nowait(('http://a/2', 10, 0, 0))
+        started = self.loop.time()
+        self.take(scheduler, 2)
+        self.assertGreaterEqual(self.loop.time() - started, 0.2)
+
+    def test_delayed_items_wait(self):
+        scheduler = HostScheduler(per_host=10)
+        scheduler.put_nowait(('http://a/1', 10, 0, 1), delay=0.2)
+        scheduler.put_nowait(('http://a/2', 10, 0, 0))
+        started = self.loop.time()
+        self.assertEqual(self.take(scheduler, 2),
+                         ['http://a/2', 'http://a/1'])
+        self.assertGreaterEqual(self.loop.time() - started, 0.2)
+
+    def test_url_priority(self):
+        priority = UrlPriority([('*page=*', 5), ('/docs/*', -1)])
+        self.assertEqual(priority('http://a/list?page=2', 1), 6)
+        self.assertEqual(priority('http://a/docs/intro', 2), 1)
+        self.assertEqual(priority('http://a/about', 2), 2)
+
+    def test_clear_drops_items_left(self):
+        scheduler = HostScheduler(per_host=1)
+        for index in range(3):
+            scheduler.put_nowait((f'http://a/{index}', 10, 0, 0))
+        self.take(scheduler, 1)
+        self.assertEqual(scheduler.clear(), 2)
+        self.assertFalse(scheduler.finished.is_set())
+        scheduler.task_done('http://a/0')
+        self.assertTrue(scheduler.finished.is_set())
+
+
+class DedupTests(TestCase):
+
+    def check_backend(self, backend):
+        """
+        Fill a seen-set of backend past its capacity, and restore it from
+        a snapshot.
+        """
+        urls = [f'http://example.com/{index}' for index in range(2000)]
+        seen = dedup.BACKENDS[backend](500, 0.001)
+        for url in urls:
+            seen.add(url)
+        self.assertTrue(all(url in seen for url in urls))
+
+        restored = dedup.BACKENDS[backend](500, 0.001)
+        restored.restore(memoryview(seen.snapshot()))
+        self.assertTrue(all(url in restored for url in urls))
+        self.assertEqual(len(restored), len(seen))
+        return seen
+
+    def test_bloom(self):
+        seen = self.check_backend('bloom')
+        # Filled past its capacity.
+        self.assertGreater(seen.error_rate, 0.001)
+
+    def test_scalable(self):
+        seen = self.check_backend('scalable')
+        self.assertGreater(len(seen.slices), 1)
+        self.assertLess(seen.error_rate, 0.001)
+        self.assertLess(sum(f'http://example.org/{index}' in seen
+                            for index in range(2000)), 10)
+
+    def test_mmap(self):
+        with tempfile.TemporaryDirectory() as path:
+            seen = dedup.MmapHashSet(500, path=path)
+            for index in range(2000):
+                seen.add(f'http://example.com/{index}')
+            seen.add('http://example.com/0')
+            self.assertEqual(len(seen), 2000)
+            self.assertFalse(any(f'http://example.org/{index}' in seen
+                                 for index in range(2000)))
+        self.check_backend('mmap')
+
+    def test_restore_from_other_backend(self):
+        seen = dedup.BACKENDS['exact'](500, 0.001)
+        with self.assertRaises(ValueError):
+            dedup.BACKENDS['scalable'](500, 0.001).restore(seen.snapshot())
+
+
+class CanonicalizerTests(TestCase):
+
+    def setUp(self):
+        self.canonicalize = Canonicalizer()
+
+    def test_scheme_host_port_and_fragment(self):
+        self.assertEqual(
+            self.canonicalize('HTTP://Example.COM:80/Path#top'),
+            'http://example.com/Path')
+        self.assertEqual(
+            self.canonicalize('https://user:pw@[::1]:8443'),
+            'https://user:pw@[::1]:8443/')
+        # Broken ports are left alone.
+        self.assertEqual(self.canonicalize('http://a:port/'), 'http://a:port/')
+
+    def test_parameters_sorted_and_dropped(self):
+        self.assertEqual(
+            self.canonicalize(
+                'http://example.com/?b=2&utm_source=x&a=1&SID=1&gclid=3'),
+            'http://example.com/?a=1&b=2')
+        self.assertEqual(
+            Canonicalizer(drop_params=())('http://example.com/?sid=1'),
+            'http://example.com/?sid=1')
+        # Repeated parameters keep their order.
+        self.assertEqual(
+            self.canonicalize('http://example.com/?b=2&a=1&a=0'),
+            'http://example.com/?a=1&a=0&b=2')
+
+    def test_parameters_kept_as_written(self):
+        for query in ('a=1;b=2', 'flag', 'q=a%20b', 'q=a+b', 'b&a='):
+            url = f'http://example.com/?{query}'
+            self.assertEqual(
+                self.canonicalize(url).split('?', 1)[1],
+                '&'.join(sorted(query.split('&'))))
+
+    def test_trailing_slash(self):
+        url = 'http://example.com/a/'
+        self.assertEqual(self.canonicalize(url), url)
+        self.assertEqual(Canonicalizer(trailing_slash='strip')(url),
+                         'http://example.com/a')
+        self.assertEqual(Canonicalizer(trailing_slash='add')(
+            'http://example.com/a'), url)
+        self.assertEqual(Canonicalizer(trailing_slash='strip')(
+            'http://example.com/'), 'http://example.com/')
+        with self.assertRaises(ValueError):
+            Canonicalizer(trailing_slash='maybe')
+
+
+class HttpCacheTests(LoopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'cache.sqlite3')
+
+    def tearDown(self):
+        self.directory.cleanup()
+        super().tearDown()
+
+    def test_put_and_get(self):
+        cache = httpcache.HttpCache(self.path)
+        cache.put('http://a/', {'ETag': '"1"'}, 200,
+                  ['http://a/y', 'http://a/x'])
+        # Pages without validators cannot be asked conditionally.
+        cache.put('http://a/z', {}, 200, ['http://a/'])
+        self.assertEqual(cache.get('http://a/').links,
+                         ['http://a/x', 'http://a/y'])
+        cache.close()
+
+        cache = httpcache.HttpCache(self.path)
+        entry = cache.get('http://a/')
+        self.assertEqual(entry, httpcache.CacheEntry(
+            '"1"', None, 200, ['http://a/x', 'http://a/y']))
+        self.assertEqual(cache.validators(entry), {'If-None-Match': '"1"'})
+        self.assertIsNone(cache.get('http://a/z'))
+        cache.close()
+
+    def test_least_recently_used_evicted(self):
+        clock = SimpleNamespace(time=count(1).__next__)
+        with mock.patch.object(httpcache, 'time', clock):
+            cache = httpcache.HttpCache(self.path, flush_size=1)
+            for url in ('http://a/1', 'http://a/2'):
+                cache.put(url, {'Last-Modified': 'then'}, 200, ['http://a/'])
+            cache.touch('http://a/1')
+            cache.max_size = cache.size
+            cache.put('http://a/3', {'Last-Modified': 'then'}, 200,
+                      ['http://a/'])
+            self.assertIsNone(cache.get('http://a/2'))
+            self.assertIsNotNone(cache.get('http://a/1'))
+            self.assertIsNotNone(cache.get('http://a/3'))
+            cache.close()
+
+    def test_unchanged_pages_reuse_links(self):
+        links = page('/child', headers={'ETag': '"1"'})
+
+        async def root(request):
+            if request.headers.get('If-None-Match') == '"1"':
+                return web.Response(status=304)
+            return await links(request)
+
+        root_url = self.serve([('/', root), ('/child', page())])
+        driver, results = self.race(
+            root_url, http_cache=httpcache.HttpCache(self.path))
+        self.assertEqual((driver.cache_hits, driver.cache_misses), (0, 2))
+
+        driver, results = self.race(
+            root_url, http_cache=httpcache.HttpCache(self.path))
+        self.assertEqual((driver.cache_hits, driver.cache_misses), (1, 1))
+        self.assertEqual(results['/'][1], 200)
+        self.assertIn('/child', results)
+
+    def test_reused_links_obey_robots(self):
+        links = page('/child', '/private', headers={'ETag': '"1"'})
+
+        async def root(request):
+            if request.headers.get('If-None-Match') == '"1"':
+                return web.Response(status=304)
+            return await links(request)
+
+        async def robots(request):
+            return web.Response(text='User-agent: *\nDisallow: /private\n')
+
+        root_url = self.serve([('/', root), ('/robots.txt', robots),
+                               ('/child', page()), ('/private', page())])
+        driver, results = self.race(
+            root_url, http_cache=httpcache.HttpCache(self.path))
+        self.assertIn('/private', results)
+
+        driver, results = self.race(
+            root_url, http_cache=httpcache.HttpCache(self.path), robots=True)
+        self.assertEqual(driver.cache_hits, 1)
+        self.assertEqual(set(results), {'/', '/child'})
+
+
+class PageTests(LoopTestCase):
+
+    def test_non_html_not_read(self):
+        async def pdf(request):
+            return web.Response(body=b'<a href="/hidden">hidden</a>',
+                                content_type='application/pdf')
+
+        async def empty(request):
+            return web.Response(content_type='text/html')
+
+        root_url = self.serve([
+            ('/', page('/file.pdf', '/empty')), ('/file.pdf', pdf),
+            ('/empty', empty), ('/hidden', page())])
+        driver, results = self.race(root_url)
+        self.assertEqual(results['/file.pdf'][1], 200)
+        self.assertEqual(results['/empty'][1], 200)
+        self.assertNotIn('/hidden', results)
+        self.assertEqual(driver.twos, 3)
+
+    def test_pages_read_up_to_max_page_size(self):
+        async def large(request):
+            padding = 'x' * 4096
+            return web.Response(
+                text=f'<html><body><a href="/early">early</a>'
+                     f'<p>{padding}</p><a href="/late">late</a>'
+                     f'</body></html>',
+                content_type='text/html')
+
+        root_url = self.serve([
+            ('/', large), ('/early', page()), ('/late', page())])
+        _, results = self.race(root_url, max_page_size=1024)
+        self.assertIn('/early', results)
+        self.assertNotIn('/late', results)
+        _, results = self.race(root_url)
+        self.assertIn('/late', results)
+
+
+class LinkExtractionTests(LoopTestCase):
+
+    HTML = (b'<html><head><base href="/docs/"></head><body>'
+            b'<a href="intro">Intro</a><a href=" /about ">About</a>'
+            b'<a href="intro#top">Top</a><a href="logo.png">Logo</a>'
+            b'<a href="http://elsewhere/">Elsewhere</a><a>None</a>'
+            b'<a href="../up">Up</a></body></html>')
+
+    def test_engines_agree(self):
+        for engine in LINK_ENGINES:
+            self.assertEqual(
+                extract_links(self.HTML, 'http://a/page/x', 'http://a/',
+                              engine=engine),
+                {'http://a/docs/intro', 'http://a/about', 'http://a/up'},
+                engine)
+
+    def test_links_resolved_against_page(self):
+        html = b'<html><body><a href="y">Y</a></body></html>'
+        for engine in LINK_ENGINES:
+            self.assertEqual(
+                extract_links(html, 'http://a/page/x', 'http://a/',
+                              engine=engine),
+                {'http://a/page/y'}, engine)
+
+    def test_race_with_either_engine(self):
+        root_url = self.serve([
+            ('/', page('docs/')), ('/docs/', page('a', 'b')),
+            ('/docs/a', page('../')), ('/docs/b', page())])
+        for engine in LINK_ENGINES:
+            _, results = self.race(root_url, link_engine=engine)
+            self.assertEqual(set(results), {'/', '/docs/', '/docs/a',
+                                            '/docs/b'}, engine)
+
+
+class MetricsTests(LoopTestCase):
+
+    def registry(self):
+        registry = metrics.Registry()
+        registry.callback('gt_pages_total', 'Pages.', lambda: 3,
+                          kind='counter')
+        registry.callback('gt_hosts', 'Hosts.',
+                          lambda: {('b',): 2, ('a',): 1}, labels=('host',))
+        latency = registry.histogram('gt_latency_seconds', 'Latency.',
+                                     buckets=(0.1, 1), labels=('class',))
+        for value, labels in ((0.05, ('2xx',)), (0.5, ('2xx',)),
+                              (5, ('5xx',))):
+            latency.observe(value, labels)
+        return registry
+
+    def test_render(self):
+        self.assertEqual(self.registry().render(), '\n'.join([
+            '# HELP gt_pages_total Pages.',
+            '# TYPE gt_pages_total counter',
+            'gt_pages_total 3',
+            '# HELP gt_hosts Hosts.',
+            '# TYPE gt_hosts gauge',
+            'gt_hosts{host="a"} 1',
+            'gt_hosts{host="b"} 2',
+            '# HELP gt_latency_seconds Latency.',
+            '# TYPE gt_latency_seconds histogram',
+            'gt_latency_seconds_bucket{class="2xx",le="0.1"} 1',
+            'gt_latency_seconds_bucket{class="2xx",le="1"} 2',
+            'gt_latency_seconds_bucket{class="2xx",le="+Inf"} 2',
+            'gt_latency_seconds_sum{class="2xx"} 0.55',
+            'gt_latency_seconds_count{class="2xx"} 2',
+            'gt_latency_seconds_bucket{class="5xx",le="0.1"} 0',
+            'gt_latency_seconds_bucket{class="5xx",le="1"} 0',
+            'gt_latency_seconds_bucket{class="5xx",le="+Inf"} 1',
+            'gt_latency_seconds_sum{class="5xx"} 5',
+            'gt_latency_seconds_count{class="5xx"} 1',
+        ]) + '\n')
+
+    def test_served(self):
+        async def scrape():
+            app_runner = await metrics.start_server(
+                self.registry(), 0, host='127.0.0.1')
+            host, port = app_runner.addresses[0][:2]
+            try:
+                async with ClientSession() as session:
+                    async with session.get(
+                            f'http://{host}:{port}/metrics') as response:
+                        return response.content_type, await response.text()
+            finally:
+                await app_runner.cleanup()
+
+        content_type, text = self.run_loop(scrape())
+        self.assertEqual(content_type, 'text/plain')
+        self.assertEqual(text, self.registry().render())
+
+    def test_race_counters(self):
+        root_url = self.serve([('/', page('/a', '/b')), ('/a', page())])
+        driver, _ = self.race(root_url)
+        text = driver.metrics.render()
+        self.assertIn('gt_urls_crawled_total 3\n', text)
+        self.assertIn('gt_responses_total{status_class="2xx"} 2\n', text)
+        self.assertIn('gt_responses_total{status_class="4xx"} 1\n', text)
+        self.assertIn(
+            'gt_fetch_latency_seconds_count{status_class="4xx"} 1\n', text)
+
+
+class FrontierChecks:
+    """
+    Checks shared by every frontier backend, made by frontier().
+    """
+    def test_lease_and_report(self):
+        frontier = self.frontier()
+        frontier.configure({'max_redirects': 10})
+        self.assertEqual(frontier.config(), {'max_redirects': 10})
+        frontier.seed([('http://a/', 10), ('http://a/b', 10),
+                       ('http://a/', 10)])
+        leased = frontier.lease('w1', 10, 60)
+        self.assertEqual(sorted(url for url, _, _ in leased),
+                         ['http://a/', 'http://a/b'])
+        self.assertEqual(frontier.lease('w2', 10, 60), [])
+
+        tokens = {url: token for url, _, token in leased}
+        frontier.report('w1', 60, [tokens['http://a/']],
+                        [('http://a/', 200)],
+                        [('http://a/b', 9), ('http://a/c', 9)],
+                        {'twos': 1, 'crawled': 1})
+        self.assertEqual(frontier.absorb(), [('http://a/', 200)])
+        self.assertEqual(frontier.counters()['twos'], 1)
+        # Only the new link is queued, besides the lease still held.
+        self.assertEqual(frontier.outstanding(), 2)
+        self.assertEqual(frontier.lease('w2', 10, 60),
+                         [('http://a/c', 9, mock.ANY)])
+
+    def test_reclaim_expired_leases(self):
+        frontier = self.frontier()
+        frontier.configure({})
+        frontier.seed([('http://a/', 10), ('http://a/b', 10)])
+        frontier.lease('w1', 1, 60)
+        frontier.lease('w2', 1, -1)
+        self.assertEqual(frontier.reclaim(), 1)
+        self.assertEqual(frontier.reclaim(), 0)
+        self.assertEqual(len(frontier.lease('w3', 10, 60)), 1)
+
+    def test_completion(self):
+        frontier = self.frontier()
+        self.assertTrue(frontier.over())
+        frontier.configure({})
+        frontier.seed([('http://a/', 10), ('http://a/b', 10)])
+        self.assertFalse(frontier.over())
+        (_, _, token), = frontier.lease('w1', 1, 60)
+        frontier.report('w1', 60, [token], [], [], {})
+        self.assertEqual(frontier.outstanding(), 1)
+        frontier.finish(drop=True)
+        self.assertTrue(frontier.over())
+        self.assertEqual(frontier.outstanding(), 0)
+        self.assertEqual(frontier.lease('w1', 10, 60), [])
+
+
+class SqliteFrontierTests(FrontierChecks, TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def frontier(self):
+        path = os.path.join(self.directory.name, 'frontier.sqlite3')
+        frontier = SqliteFrontier(path, 1)
+        self.addCleanup(frontier.close)
+        return frontier
+
+
+class RedisFrontierTests(FrontierChecks, TestCase):
+    """
+    Frontier served by RespServer, whose loop runs on a thread of its own
+    as the client blocks.
+    """
+    def setUp(self):
+        self.loop = new_event_loop()
+        self.server = self.loop.run_until_complete(
+            start_server(RespServer().handle, '127.0.0.1', 0))
+        self.thread = Thread(target=self.loop.run_forever)
+        self.thread.start()
+        # Stopped on cleanup, after the clients opened later are closed
+        self.addCleanup(self.stop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    def frontier(self):
+        port = self.server.sockets[0].getsockname()[1]
+        frontier = RedisFrontier(RespClient('127.0.0.1', port), 1)
+        self.addCleanup(frontier.close)
+        return frontier
+
+
+class AdaptiveConcurrencyTests(TestCase):
+
+    def window(self, control, latency, errors=0, busiest=None):
+        """
+        Adjust control after a window of ten responses.
+        """
+        control.started = 0
+        control.latencies = [latency] * 10
+        control.errors = errors
+        control.busiest = control.permits if busiest is None else busiest
+        control.adjust(1)
+        return control.permits
+
+    def test_slow_start_then_additive_increase(self):
+        control = AdaptiveConcurrency(2, 100)
+        self.assertEqual([self.window(control, 0.1) for _ in range(3)],
+                         [4, 8, 16])
+        self.assertEqual(self.window(control, 0.1, errors=1), 11)
+        self.assertFalse(control.slow_start)
+        self.assertEqual([self.window(control, 0.1) for _ in range(2)],
+                         [12, 13])
+
+    def test_multiplicative_decrease_on_latency(self):
+        control = AdaptiveConcurrency(2, 100)
+        control.limit = 10.0
+        self.window(control, 0.1, busiest=0)
+        self.assertEqual(self.window(control, 0.5), 7)
+        self.assertEqual(control.history[-1], (1, 7))
+
+    def test_bounds(self):
+        control = AdaptiveConcurrency(2, 5)
+        self.assertEqual([self.window(control, 0.1) for _ in range(3)],
+                         [4, 5, 5])
+        self.assertEqual([self.window(control, 0.1, errors=10)
+                          for _ in range(4)], [3, 2, 2, 2])
+
+    def test_idle_permits_not_increased(self):
+        control = AdaptiveConcurrency(2, 100)
+        self.assertEqual(self.window(control, 0.1, busiest=1), 2)
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after('120'), 120)
+        self.assertEqual(retry_after('9999'), 300)
+        self.assertEqual(retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+        self.assertIsNone(retry_after('soon'))
+        self.assertIsNone(retry_after(None))
+
+
+def flaky(*statuses, headers=None):
+    """
+    Handler answering with statuses in turn, then serving an empty page.
+    """
+    statuses = iter(statuses)
+
+    async def handler(request):
+        status = next(statuses, None)
+        if status is None:
+            return await page()(request)
+        return web.Response(status=status, headers=headers)
+    return handler
+
+
+class RetryTests(LoopTestCase):
+
+    def test_classify_error(self):
+        self.assertEqual(classify_error(TimeoutError()), ('timeout', True))
+        self.assertEqual(classify_error(ServerDisconnectedError()),
+                         ('connection', True))
+        self.assertEqual(classify_error(InvalidURL('http://[')),
+                         ('invalid_url', False))
+        self.assertEqual(classify_error(UnicodeError()), ('encoding', False))
+        self.assertEqual(classify_error(KeyError()), ('other', False))
+
+    def test_backoff(self):
+        with mock.patch('races.retries.random.uniform',
+                        side_effect=lambda low, high: (low, high)):
+            self.assertEqual(backoff(0), (0, 1))
+            self.assertEqual(backoff(3, 0.5), (0, 4))
+            self.assertEqual(backoff(10), (0, 60))
+        for attempt in range(5):
+            self.assertLessEqual(0, backoff(attempt, 0.1))
+            self.assertLessEqual(backoff(attempt, 0.1), 0.1 * 2 ** attempt)
+
+    def test_transient_statuses_retried(self):
+        root_url = self.serve([
+            ('/', page('/busy', '/down')),
+            ('/busy', flaky(429, 503)),
+            ('/down', flaky(502)),
+        ])
+        driver, results = self.race(root_url, retry_backoff=0.001)
+        self.assertEqual(results['/busy'][1:3], (200, ''))
+        self.assertEqual(results['/down'][1:3], (200, ''))
+        self.assertEqual((driver.retries, driver.twos), (3, 3))
+
+    def test_retry_after_defers_host(self):
+        root_url = self.serve([
+            ('/', page('/busy')),
+            ('/busy', flaky(503, headers={'Retry-After': '1'})),
+        ])
+        with mock.patch.object(HostScheduler, 'defer', autospec=True,
+                               side_effect=HostScheduler.defer) as defer:
+            driver, results = self.race(root_url, retry_backoff=0.001)
+        defer.assert_called_once_with(mock.ANY, root_url + 'busy', 1)
+        self.assertEqual(results['/busy'][1], 200)
+
+    def test_given_up_after_max_retries(self):
+        async def disconnect(request):
+            request.transport.close()
+            return web.Response()
+
+        root_url = self.serve([
+            ('/', page('/down', '/gone')),
+            ('/down', flaky(*[503] * 10)),
+            ('/gone', disconnect),
+        ])
+        driver, results = self.race(
+            root_url, max_retries=2, retry_backoff=0.001)
+        self.assertEqual(results['/down'][1:3], (503, ''))
+        self.assertEqual(results['/gone'][1:3], (0, 'connection'))
+        self.assertEqual((driver.retries, driver.fives, driver.failures),
+                         (4, 1, 1))
+
+
+class KeysetChangeListTests(TestCase):
+
+    def setUp(self):
+        self.session = create_session()
+        models.RacingResult.objects.bulk_create(
+            models.RacingResult(session=self.session,
+                                url=f'http://example.com/{index:03}',
+                                status_code=404)
+            for index in range(150))
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def test_pages_walked_forward(self):
+        url = '/admin/races/racingresult/'
+        response = self.client.get(url)
+        cl = response.context['cl']
+        self.assertEqual(len(cl.result_list), 100)
+        self.assertEqual(cl.result_list[-1].url, 'http://example.com/099')
+        self.assertEqual((cl.result_count, cl.result_count_exact),
+                         (150, True))
+
+        response = self.client.get(url + cl.next_page_url())
+        cl = response.context['cl']
+        self.assertEqual([result.url for result in cl.result_list],
+                         [f'http://example.com/{index:03}'
+                          for index in range(100, 150)])
+        self.assertIsNone(cl.next_cursor)
+
+    def test_broken_cursor(self):
+        response = self.client.get(
+            '/admin/races/racingresult/', {changelist.CURSOR_VAR: 'nope'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_large_counts_capped(self):
+        queryset = models.RacingResult.objects.all()
+        with mock.patch.object(changelist, 'EXACT_COUNT', 100):
+            self.assertEqual(changelist.estimate_count(queryset),
+                             (100, None))
+            response = self.client.get('/admin/races/racingresult/')
+        self.assertContains(response, '100+ racing results')
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read_csv(self, name, opener=open):
+        with opener(os.path.join(self.directory.name, name), 'rt',
+                    newline='', encoding='utf-8') as f:
+            return list(csv.reader(f))
+
+    def test_csv(self):
+        session = create_session()
+        models.RacingResult.objects.bulk_create(
+            models.RacingResult(session=session, url=f'http://a/{index}',
+                                status_code=status_code)
+            for index, status_code in enumerate((200, 404, 404)))
+        path = os.path.join(self.directory.name, 'race.csv')
+        self.assertEqual(export.format_of(path + '.gz'), 'csv')
+        self.assertEqual(export.export_session(
+            session, path, 'csv', 'none', chunk_size=2), 3)
+        self.assertEqual(self.read_csv('race.csv'), [
+            ['url', 'status_code', 'error', 'latency', 'redirects'],
+            ['http://a/1', '404', '', '0', ''],
+            ['http://a/2', '404', '', '0', ''],
+            ['http://a/0', '200', '', '0', ''],
+        ])
+
+    def test_compact_csv(self):
+        session = create_session(storage='compact')
+        url = models.RacingUrl.objects.create(
+            hash=models.RacingUrl.hash_url('http://a/'), url='http://a/')
+        models.CompactResult.objects.create(
+            session=session, url=url, status_code=200, latency=15, depth=0)
+        path = os.path.join(self.directory.name, 'race.csv.gz')
+        self.assertEqual(export.export_session(session, path, 'csv'), 1)
+        self.assertEqual(self.read_csv('race.csv.gz', gzip.open), [
+            ['url', 'status_code', 'latency', 'depth', 'redirects'],
+            ['http://a/', '200', '15', '0', ''],
+        ])
+
+
+class DiffTests(TestCase):
+
+    def create_results(self, session, statuses):
+        if session.storage == 'compact':
+            urls = collector.Collector(session.id, None).intern(statuses)
+            models.CompactResult.objects.bulk_create(
+                models.CompactResult(session=session, url_id=urls[url],
+                                     status_code=status_code, latency=0,
+                                     depth=0)
+                for url, status_code in statuses.items())
+        else:
+            models.RacingResult.objects.bulk_create(
+                models.RacingResult(session=session, url=url,
+                                    status_code=status_code)
+                for url, status_code in statuses.items())
+
+    def test_sessions_compared_in_database(self):
+        before = create_session()
+        after = create_session(storage='compact')
+        self.create_results(before, {
+            'http://a/new': 200, 'http://a/fixed': 500,
+            'http://a/changed': 301, 'http://a/same': 404,
+            'http://a/gone': 503,
+        })
+        self.create_results(after, {
+            'http://a/new': 404, 'http://a/fixed': 200,
+            'http://a/changed': 302, 'http://a/same': 404,
+            'http://a/found': 0,
+        })
+        race_diff = diff.diff_sessions(before, after)
+        entries = set(models.RacingDiffEntry.objects.filter(diff=race_diff)
+                      .values_list('url', 'kind', 'before_status',
+                                   'after_status'))
+        self.assertEqual(entries, {
+            ('http://a/new', 'new', 200, 404),
+            ('http://a/found', 'new', None, 0),
+            ('http://a/fixed', 'fixed', 500, 200),
+            ('http://a/gone', 'fixed', 503, None),
+            ('http://a/changed', 'changed', 301, 302),
+        })
+        self.assertEqual(
+            (race_diff.new, race_diff.fixed, race_diff.changed), (2, 2, 1))
+        # Diffs are computed once.
+        self.assertEqual(diff.diff_sessions(before, after).id, race_diff.id)
+
+    def test_running_session(self):
+        before = create_session()
+        after = create_session(ending_time=None)
+        with self.assertRaises(diff.RaceRunning):
+            diff.diff_sessions(before, after)
+
+
+class RunnerTests(LoopTestCase):
+
+    def test_arguments(self):
+        options = runner.parse_arguments(
+            'http://a/', '--storage compact --max_retries 1')
+        self.assertEqual((options['storage'], options['max_retries']),
+                         ('compact', 1))
+        for root_url, arguments in (('ftp://a/', ''),
+                                    ('http://a/', '--workers 2'),
+                                    ('http://a/', '--storage "compact'),
+                                    ('http://a/', '--help'),
+                                    ('http://a/', '--version')):
+            with self.assertRaises(CommandError):
+                runner.parse_arguments(root_url, arguments)
+
+    def test_tokens(self):
+        race_runner = runner.RaceRunner(token='secret')
+
+        def request(authorization='', **query):
+            return SimpleNamespace(
+                headers={'Authorization': authorization}, query=query)
+
+        race_runner.authorize(request('Bearer secret'))
+        race_runner.authorize(request(watch=runner.watch_token(1)), 1)
+        for denied, session_id in (
+                (request('Bearer nope'), None),
+                (request(watch=runner.watch_token(1)), None),
+                (request(watch=runner.watch_token(2)), 1),
+                (request(watch='forged'), 1)):
+            with self.assertRaises(web.HTTPForbidden):
+                race_runner.authorize(denied, session_id)
+        race_runner.executor.shutdown()
+
+    def test_queued_races_cancelled(self):
+        sessions = [runner.queue_race('http://a/') for _ in range(2)]
+        self.assertEqual(runner.cancel_races(
+            models.RacingSession.objects.filter(pk=sessions[0].id)), 1)
+        self.assertEqual(runner.session_progress(sessions[0].id)['state'],
+                         'cancelled')
+        self.assertEqual(runner.session_progress(sessions[1].id)['state'],
+                         'queued')
+
+    def run_race(self, root_url):
+        """
+        Queue a race and let a runner drive it to the end. Returns the
+        runner, the race and its progress as stored.
+        """
+        session = runner.queue_race(root_url, '--max_retries 0')
+        race_runner = runner.RaceRunner()
+        logging.disable(logging.WARNING)
+        try:
+            self.run_loop(race_runner.poll())
+            race = race_runner.races[session.id]
+            self.run_loop(race.task)
+            self.run_loop(race_runner.shutdown())
+        finally:
+            logging.disable(logging.NOTSET)
+        return race_runner, race, runner.session_progress(session.id)
+
+    def test_queued_race_run(self):
+        root_url = self.serve([('/', page('/a')), ('/a', page())])
+        race_runner, _, progress = self.run_race(root_url)
+        self.assertEqual(race_runner.races, {})
+        self.assertEqual((progress['state'], progress['crawled'],
+                          progress['twos']), ('finished', 2, 2))
+
+    def test_failing_races_cleaned_up(self):
+        # Errors are stored, so the collector has something to write.
+        root_url = self.serve([('/', page('/missing'))])
+        failures = (
+            (drivers.AsyncDriver, 'finish_line'),
+            (collector.Collector, 'write'),
+            (collector, 'store_session'),
+        )
+        for target, name in failures:
+            with mock.patch.object(target, name,
+                                   side_effect=RuntimeError(name)):
+                race_runner, race, progress = self.run_race(root_url)
+            self.assertEqual(progress['state'], 'failed', name)
+            self.assertEqual(race_runner.races, {})
+            self.assertTrue(race_runner.wakeup.is_set())
+            self.assertTrue(all(engine.done()
+                                for engine in race.driver.engines))
+
+
+class RobotsRulesTests(TestCase):
+
+    ROBOTS = '\n'.join([
+        'User-agent: *',
+        'Disallow: /',
+        '',
+        'User-agent: otherbot',
+        'User-agent: GranTurismoRacingDriver',
+        'Disallow: /private',
+        'Allow: /private/open',
+        'Disallow: /*.pdf$',
+        'Disallow: /search?q=  # no searches',
+        '',
+        'Sitemap: http://example.com/sitemap.xml',
+    ])
+
+    def test_driver_group(self):
+        rules = RobotsRules(self.ROBOTS)
+        self.assertTrue(rules.allowed('http://example.com/'))
+        self.assertFalse(rules.allowed('http://example.com/private/x'))
+        self.assertTrue(rules.allowed('http://example.com/private/open/x'))
+        self.assertFalse(rules.allowed('http://example.com/a/b.pdf'))
+        self.assertTrue(rules.allowed('http://example.com/a/b.pdf?page=2'))
+        self.assertFalse(rules.allowed('http://example.com/search?q=x'))
+        self.assertTrue(rules.allowed('http://example.com/search'))
+        self.assertEqual(rules.sitemaps, ['http://example.com/sitemap.xml'])
+
+    def test_every_agent_group(self):
+        rules = RobotsRules(self.ROBOTS, agent='somebot')
+        self.assertFalse(rules.allowed('http://example.com/'))
+
+    def test_no_rules(self):
+        self.assertTrue(RobotsRules('User-agent: *\nDisallow:\n').allowed(
+            'http://example.com/private'))
+
+
+class SitemapRaceTests(LoopTestCase):
+
+    def test_robots_and_sitemaps(self):
+        async def robots(request):
+            return web.Response(text='User-agent: *\nDisallow: /private\n')
+
+        async def sitemap(request):
+            locs = ''.join(f'<url><loc>{request.url.origin()}{path}</loc>'
+                           f'</url>' for path in ('/listed', '/private/2'))
+            return web.Response(
+                text=f'<urlset xmlns="http://www.sitemaps.org/schemas/'
+                     f'sitemap/0.9">{locs}</urlset>',
+                content_type='application/xml')
+
+        root_url = self.serve([
+            ('/', page('/private/1', '/open')),
+            ('/robots.txt', robots),
+            ('/sitemap.xml', sitemap),
+            ('/open', page()),
+            ('/listed', page()),
+            ('/private/{name}', page()),
+        ])
+        driver, results = self.race(root_url, robots=True, sitemaps=[])
+        self.assertEqual(set(results), {'/', '/open', '/listed'})
+        self.assertEqual(driver.seeded, 1)
+
+
+class CarryOverTests(TransactionTestCase):
+
+    def test_results_not_crawled_again(self):
+        for storage in ('full', 'compact'):
+            previous = create_session(storage=storage)
+            collector.Collector(previous.id, None, storage=storage).write([
+                (f'http://a/{index}', 404, '', 0.01, 1, '')
+                for index in range(7)])
+            session = create_session()
+            visited = {models.RacingUrl.hash_url('http://a/3')}
+            self.assertEqual(collector.carry_over(
+                previous, session.id, 'full', visited, batch_size=2), 6)
+            urls = set(models.RacingResult.objects.filter(session=session)
+                       .values_list('url', flat=True))
+            self.assertEqual(urls, {f'http://a/{index}'
+                                    for index in range(7) if index != 3})
+
+
+class UrlArenaTests(TestCase):
+
+    def test_items_packed_and_taken_out(self):
+        arena = UrlArena(segment_size=4)
+        items = [(f'http://example.com/{index}/ü', 10, index, index % 3)
+                 for index in range(10)]
+        ids = [arena.add(item) for item in items]
+        self.assertEqual(ids, list(range(10)))
+        self.assertEqual(len(arena.segments), 3)
+        for item_id in ids[:4]:
+            self.assertEqual(arena.pop(item_id), items[item_id])
+        # First segment was emptied, and dropped.
+        self.assertEqual(sorted(arena.segments), [1, 2])
+        self.assertEqual(arena.get(9), items[9])
+        self.assertEqual(len(arena), 6)
+
+    def test_clear_starts_new_segment(self):
+        arena = UrlArena(segment_size=4)
+        for index in range(5):
+            arena.add((f'http://a/{index}', 10, 0, 0))
+        arena.clear()
+        self.assertEqual(len(arena), 0)
+        self.assertEqual(arena.add(('http://a/', 10, 0, 0)), 8)
+
+
+def redirect(location):
+    """
+    Handler redirecting permanently to location.
+    """
+    async def handler(request):
+        raise web.HTTPMovedPermanently(location)
+    return handler
+
+
+class RedirectChainTests(LoopTestCase):
+
+    def test_chains_recorded_once(self):
+        root_url = self.serve([
+            ('/', page('/a', '/b', '/loop', '/broken')),
+            ('/a', redirect('/b')),
+            ('/b', redirect('/c')),
+            ('/c', page('/a', '/b', '/loop', '/broken')),
+            ('/loop', redirect('/loop2')),
+            ('/loop2', redirect('/loop')),
+            ('/broken', redirect('/missing')),
+        ])
+        driver, results = self.race(root_url, max_retries=0)
+        hops = {url: (result[1], result[5])
+                for url, result in results.items()}
+        self.assertEqual(hops['/a'], (
+            301, f'301 {root_url}b\n200 {root_url}c'))
+        # Targets reached through a chain are crawled on their own.
+        self.assertEqual(hops['/c'], (200, ''))
+        self.assertEqual(hops['/broken'], (
+            301, f'404 {root_url}missing'))
+        self.assertEqual(hops['/missing'], (404, ''))
+        self.assertEqual(hops['/loop'][0], 301)
+        self.assertEqual(driver.crawled, len(results))
+
+    def test_redirect_targets_resumed(self):
+        fetching, release = Event(), Event()
+
+        async def target(request):
+            fetching.set()
+            await release.wait()
+            return await page()(request)
+
+        root_url = self.serve([
+            ('/', page('/a')), ('/a', redirect('/b')), ('/b', target)])
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'race')
+        crashed = os.path.join(directory.name, 'crashed')
+
+        def driver(path):
+            return AsyncDriver(root_url, 1000, 0.001, 10, 4, 1000, False,
+                               checkpoint=checkpoint.Checkpoint(path))
+
+        async def crash():
+            # Race state as a crash would leave it, while /b is fetched
+            # inline from /a.
+            await fetching.wait()
+            race.checkpoint.snapshot(race)()
+            shutil.copytree(path, crashed)
+            release.set()
+
+        race = driver(path)
+        self.run_loop(gather(race.drive(), crash()))
+
+        resumed = driver(crashed)
+        self.assertEqual(resumed.pending,
+                         [(root_url + 'a', 10), (root_url + 'b', 9)])
+        self.run_loop(resumed.drive())
+        # The root page before the crash, and /b after it.
+        self.assertEqual(resumed.twos, 2)
+
+    def test_trailing_slash_variants_fetched(self):
+        root_url = self.serve([
+            ('/', page('/a', '/b/')),
+            ('/a', redirect('/a/')),
+            ('/a/', page('/deep-a')),
+            ('/b/', redirect('/b')),
+            ('/b', page('/deep-b')),
+            ('/deep-a', page()),
+            ('/deep-b', page()),
+        ])
+        for policy, source, target in (('strip', '/a', '/a/'),
+                                       ('add', '/b/', '/b')):
+            driver, results = self.race(
+                root_url, canonicalize=Canonicalizer(trailing_slash=policy))
+            # Redirects to a variant of the URL itself are followed.
+            self.assertEqual(results[source][1:6:4], (
+                301, f'200 {root_url[:-1]}{target}'))
+            self.assertEqual(results[target][1], 200)
+            # Links of both pages were found.
+            self.assertLessEqual({'/deep-a', '/deep-b'},
+                                 {path.rstrip('/') for path in results})
+
+
+class TransportTests(LoopTestCase):
+
+    def resolver(self, ttl):
+        """
+        CachingResolver whose lookups are counted, not sent.
+        """
+        async def create():
+            return transport.CachingResolver(ttl)
+
+        async def resolve(host, port, family):
+            self.lookups.append(host)
+            await sleep(0)
+            return [{'host': '127.0.0.1'}]
+
+        self.lookups = []
+        resolver = self.run_loop(create())
+        resolver.resolver = SimpleNamespace(resolve=resolve)
+        return resolver
+
+    def test_lookups_shared_and_cached(self):
+        resolver = self.resolver(60)
+        self.run_loop(gather(*[resolver.resolve('a', 80)
+                               for _ in range(3)]))
+        self.run_loop(resolver.resolve('a', 80))
+        self.run_loop(resolver.resolve('b', 80))
+        self.assertEqual((resolver.hits, resolver.misses), (3, 2))
+        self.assertEqual(self.lookups, ['a', 'b'])
+
+    def test_addresses_expire(self):
+        resolver = self.resolver(0.05)
+        self.run_loop(resolver.resolve('a', 80))
+        self.run_loop(sleep(0.1))
+        self.assertEqual(self.run_loop(resolver.resolve('a', 80)),
+                         [{'host': '127.0.0.1'}])
+        self.assertEqual((resolver.hits, resolver.misses), (0, 2))
+
+    def test_options_checked(self):
+        transport.check_loop('asyncio')
+        transport.check_transport('aiohttp')
+        for check, name in ((transport.check_loop, 'trio'),
+                            (transport.check_transport, 'http3')):
+            with self.assertRaises(ValueError):
+                check(name)
+
+    def test_dns_cache_off(self):
+        root_url = self.serve([('/', page())])
+        for dns_ttl, use_dns_cache in ((0, False), (None, None)):
+            with mock.patch('races.drivers.client_session',
+                            wraps=transport.client_session) as session:
+                driver, _ = self.race(root_url, dns_ttl=dns_ttl)
+            connector_options = session.call_args[0][3]
+            self.assertEqual(connector_options.get('use_dns_cache'),
+                             use_dns_cache)
+            self.assertIsNone(driver.resolver)
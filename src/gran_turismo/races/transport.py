@@ -0,0 +1,241 @@
+"""
+transport.py - Event loop, name resolution and HTTP clients of races.
+
+Races run on uvloop when it is installed, and resolve host names with a
+cache of their own, asking aiodns when it is installed. The HTTP/2
+transport multiplexes requests over one connection per origin, through
+an httpx client dressed up as the aiohttp session drivers expect.
+"""
+from asyncio import (
+    DefaultEventLoopPolicy, TimeoutError, ensure_future, get_event_loop,
+    new_event_loop, set_event_loop, set_event_loop_policy, shield,
+)
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+import socket
+
+from aiohttp.abc import AbstractResolver
+from aiohttp.helpers import is_ip_address, parse_mimetype
+from aiohttp.resolver import AsyncResolver, ThreadedResolver
+import aiohttp
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import aiodns
+except ImportError:
+    aiodns = None
+
+try:
+    import h2
+    import httpx
+except ImportError:
+    h2 = httpx = None
+
+
+# Event loops of races. 'auto' picks uvloop when installed.
+LOOPS = ('auto', 'asyncio', 'uvloop')
+
+# HTTP clients of races.
+TRANSPORTS = ('aiohttp', 'http2')
+
+
+def check_loop(name):
+    """
+    Raise ValueError unless event loop name can be used here.
+    """
+    if name not in LOOPS:
+        raise ValueError(f"Unknown event loop {name}")
+    if name == 'uvloop' and uvloop is None:
+        raise ValueError("uvloop is not installed")
+
+
+def use_loop(name='auto'):
+    """
+    Set the event loop policy of this process, and of processes forked
+    from it, along with a new event loop of the current thread. Returns
+    the name of the loop used.
+    """
+    check_loop(name)
+    if name == 'asyncio' or uvloop is None:
+        name = 'asyncio'
+        set_event_loop_policy(DefaultEventLoopPolicy())
+    else:
+        name = 'uvloop'
+        set_event_loop_policy(uvloop.EventLoopPolicy())
+    set_event_loop(new_event_loop())
+    return name
+
+
+def check_transport(name):
+    """
+    Raise ValueError unless transport name can be used here.
+    """
+    if name not in TRANSPORTS:
+        raise ValueError(f"Unknown transport {name}")
+    if name == 'http2' and (httpx is None or h2 is None):
+        raise ValueError("HTTP/2 transport requires httpx and h2")
+
+
+def client_session(transport='aiohttp', headers=None, trace_configs=None,
+                   connector_options=None, resolver=None):
+    """
+    HTTP session of a race. Must be called with the event loop running.
+    """
+    connector_options = dict(connector_options or {})
+    if transport == 'http2':
+        return Http2Session(
+            headers, trace_configs, connector_options.get('limit', 100))
+    if resolver is not None:
+        # Addresses are cached by the resolver itself.
+        connector_options.update(resolver=resolver, use_dns_cache=False)
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(**connector_options),
+        headers=headers, trace_configs=trace_configs)
+
+
+class CachingResolver(AbstractResolver):
+    """
+    Resolver keeping addresses of hosts for a while. Lookups go through
+    aiodns when installed, the default thread pool otherwise, and
+    concurrent lookups of the same host share a single query. Must be
+    created with the event loop running.
+
+    Init Attributes:
+        ttl             Seconds addresses of a host are reused.
+    """
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.resolver = AsyncResolver() if aiodns else ThreadedResolver()
+
+        # Addresses by (host, port, family), along with their expiry
+        self.cache = {}
+        # Lookups going on, by (host, port, family)
+        self.lookups = {}
+
+        # Initialize lookup counters
+        self.hits = 0
+        self.misses = 0
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        key = (host, port, family)
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] > get_event_loop().time():
+            self.hits += 1
+            return entry[1]
+        lookup = self.lookups.get(key)
+        if lookup is None:
+            self.misses += 1
+            lookup = self.lookups[key] = ensure_future(self.lookup(key))
+        else:
+            self.hits += 1
+        # A cancelled request must not cancel the lookup for others.
+        return await shield(lookup)
+
+    async def lookup(self, key):
+        try:
+            addresses = await self.resolver.resolve(*key)
+            self.cache[key] = (get_event_loop().time() + self.ttl, addresses)
+            return addresses
+        finally:
+            del self.lookups[key]
+
+    async def warm(self, url, family=socket.AF_UNSPEC):
+        """
+        Resolve the host of url ahead of the first request to it. Failures
+        are left for that request to report.
+        """
+        parts = urlparse(url)
+        if is_ip_address(parts.hostname):
+            return
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        try:
+            await self.resolve(parts.hostname, port, family)
+        except OSError:
+            pass
+
+    async def close(self):
+        await self.resolver.close()
+
+
+class Http2Response:
+    """
+    Response of an Http2Session, read as it arrives.
+    """
+    def __init__(self, response):
+        self.response = response
+        self.status = response.status_code
+        self.headers = response.headers
+        mimetype = parse_mimetype(response.headers.get('Content-Type', ''))
+        self.content_type = f'{mimetype.type}/{mimetype.subtype}' \
+            if mimetype.type else 'application/octet-stream'
+        self.charset = mimetype.parameters.get('charset')
+        length = response.headers.get('Content-Length', '')
+        self.content_length = int(length) if length.isdigit() else None
+        # Body is read through content.iter_chunked(), as with aiohttp.
+        self.content = self
+
+    def iter_chunked(self, size):
+        return self.response.aiter_bytes(size)
+
+
+class Http2Session:
+    """
+    Stand-in for aiohttp.ClientSession speaking HTTP/2 with httpx, only
+    offering what drivers use. Requests to an origin are multiplexed over
+    a single connection, and errors are raised as aiohttp ones so they are
+    retried and reported alike.
+
+    Init Attributes:
+        headers         Headers sent with every request.
+        trace_configs   Optional list of aiohttp.TraceConfig. Only request
+                        start, end and exception callbacks are called.
+        limit           Max number of connections, 0 for no limit.
+    """
+    def __init__(self, headers=None, trace_configs=None, limit=100):
+        if httpx is None or h2 is None:
+            raise ValueError("HTTP/2 transport requires httpx and h2")
+        self.trace_configs = trace_configs or []
+        limits = httpx.Limits(
+            max_connections=limit or None,
+            max_keepalive_connections=limit or None)
+        self.client = httpx.AsyncClient(
+            http2=True, headers=headers, limits=limits)
+
+    async def trace(self, signal, contexts):
+        for trace, context in contexts:
+            for callback in getattr(trace, signal):
+                await callback(self, context, None)
+
+    @asynccontextmanager
+    async def get(self, url, headers=None, allow_redirects=True,
+                  timeout=None):
+        contexts = [(trace, trace.trace_config_ctx())
+                    for trace in self.trace_configs]
+        await self.trace('on_request_start', contexts)
+        if isinstance(timeout, aiohttp.ClientTimeout):
+            timeout = httpx.Timeout(timeout.total, read=timeout.sock_read)
+        answered = False
+        try:
+            async with self.client.stream(
+                    'GET', url, headers=headers,
+                    follow_redirects=allow_redirects,
+                    timeout=timeout) as response:
+                answered = True
+                await self.trace('on_request_end', contexts)
+                yield Http2Response(response)
+        except (httpx.TimeoutException, httpx.InvalidURL,
+                httpx.TransportError) as e:
+            if not answered:
+                await self.trace('on_request_exception', contexts)
+            if isinstance(e, httpx.TimeoutException):
+                raise TimeoutError() from e
+            if isinstance(e, httpx.InvalidURL):
+                raise aiohttp.InvalidURL(url) from e
+            raise aiohttp.ClientOSError(str(e)) from e
+
+    async def close(self):
+        await self.client.aclose()
@@ -4,4 +4,5 @@ cd /app/gran_turismo/
 
 python3 manage.py migrate
 python3 manage.py collectstatic --no-input --clear
+python3 manage.py runraces --host 0.0.0.0 --port 556 &
 uwsgi --http :555 --module gran_turismo.wsgi